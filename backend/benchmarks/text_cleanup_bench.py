@@ -0,0 +1,45 @@
+# Бенчмарк очистки текстов: прежняя построчная очистка против backend.text_cleanup
+# Запуск: python -m backend.benchmarks.text_cleanup_bench [файл с ответами модели, по одному на строку]
+import re
+import sys
+import timeit
+from pathlib import Path
+
+from backend.text_cleanup import clean_text_formatting, clean_text_formatting_batch
+
+DEFAULT_CORPUS = Path(__file__).with_name("llm_outputs_sample.txt")
+REPEAT = 5
+
+
+def legacy_clean_text_formatting(text):
+    """Прежняя реализация: шаблоны компилируются (ищутся в кэше re) при каждом вызове."""
+    if not text:
+        return ""
+    text = re.sub(r'#{1,6}\s*\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?', '', text)
+    text = re.sub(r'^(?:\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?)', '', text)
+    text = re.sub(r'\*\*|\*|__|_|#{1,6}', '', text)
+    text = text.strip()
+    if text and len(text) > 0:
+        text = text[0].upper() + text[1:] if len(text) > 1 else text.upper()
+    return text
+
+
+def main():
+    path = Path(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CORPUS
+    lines = [line for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+    # Размер, сопоставимый с пересохранением таблицы идей целиком
+    corpus = (lines * (10000 // len(lines) + 1))[:10000]
+
+    mismatches = [t for t in lines if legacy_clean_text_formatting(t) != clean_text_formatting(t)]
+    if mismatches:
+        print(f"Результаты расходятся для {len(mismatches)} строк, например: {mismatches[0]!r}")
+
+    legacy = min(timeit.repeat(lambda: [legacy_clean_text_formatting(t) for t in corpus], number=1, repeat=REPEAT))
+    batch = min(timeit.repeat(lambda: clean_text_formatting_batch(corpus), number=1, repeat=REPEAT))
+    print(f"{len(corpus)} строк из {path.name}")
+    print(f"  построчно, re.sub:     {legacy * 1000:.1f} мс")
+    print(f"  пакетно, text_cleanup: {batch * 1000:.1f} мс ({legacy / batch:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
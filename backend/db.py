@@ -0,0 +1,100 @@
+# Асинхронный слой доступа к данным: клиент Supabase и пул asyncpg
+import os
+import asyncio
+import logging
+from typing import Optional, Dict, Any
+
+import asyncpg
+from supabase import AClient, acreate_client
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSupabaseRepository:
+    """
+    Обертка над асинхронным клиентом Supabase (AClient).
+    Клиент создается один раз при старте приложения; все запросы
+    выполняются через `await ...execute()` и не блокируют event loop.
+    """
+
+    def __init__(self):
+        self._client: Optional[AClient] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def configured(self) -> bool:
+        return bool(os.getenv("SUPABASE_URL") and os.getenv("SUPABASE_ANON_KEY"))
+
+    def __bool__(self) -> bool:
+        # Проверки `if not db` должны срабатывать и тогда, когда переменные заданы, но клиент не создался
+        return self._client is not None
+
+    async def init(self) -> Optional[AClient]:
+        """Создает асинхронный клиент Supabase, если он еще не создан."""
+        if self._client is not None or not self.configured:
+            return self._client
+        async with self._lock:
+            if self._client is None:
+                self._client = await acreate_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_ANON_KEY"))
+                logger.info("Асинхронный клиент Supabase инициализирован.")
+        return self._client
+
+    async def close(self):
+        self._client = None
+
+    @property
+    def client(self) -> AClient:
+        if self._client is None:
+            raise RuntimeError("Асинхронный клиент Supabase не инициализирован")
+        return self._client
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    def rpc(self, fn: str, params: Optional[Dict[str, Any]] = None):
+        return self.client.rpc(fn, params or {})
+
+    @property
+    def storage(self):
+        return self.client.storage
+
+
+db = AsyncSupabaseRepository()
+
+
+# --- Общий пул asyncpg для прямых запросов к Postgres ---
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+
+_pg_pool: Optional[asyncpg.Pool] = None
+_pg_pool_lock = asyncio.Lock()
+
+
+async def init_pg_pool(dsn: str) -> Optional[asyncpg.Pool]:
+    """Создает пул соединений asyncpg (один на процесс)."""
+    global _pg_pool
+    if _pg_pool is not None:
+        return _pg_pool
+    async with _pg_pool_lock:
+        if _pg_pool is None:
+            _pg_pool = await asyncpg.create_pool(dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE)
+            logger.info(f"Пул asyncpg создан (min={PG_POOL_MIN_SIZE}, max={PG_POOL_MAX_SIZE}).")
+    return _pg_pool
+
+
+async def get_pg_pool() -> asyncpg.Pool:
+    """Возвращает пул asyncpg, создавая его при первом обращении, если стартовая инициализация не удалась."""
+    if _pg_pool is not None:
+        return _pg_pool
+    from backend.main import normalize_db_url
+    db_url = os.getenv("SUPABASE_URL") or os.getenv("DATABASE_URL") or os.getenv("RENDER_DATABASE_URL")
+    if not db_url:
+        raise RuntimeError("Отсутствуют SUPABASE_URL, DATABASE_URL и RENDER_DATABASE_URL")
+    return await init_pg_pool(normalize_db_url(db_url))
+
+
+async def close_pg_pool():
+    global _pg_pool
+    if _pg_pool is not None:
+        await _pg_pool.close()
+        _pg_pool = None
@@ -0,0 +1,130 @@
+# Общий реестр долгоживущих HTTP-клиентов для исходящих запросов
+import os
+import logging
+import importlib.util
+from typing import Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 доступен только при установленном пакете h2 (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# Апстримы: имя -> (base_url или None, таймаут по умолчанию в секундах).
+# Таймаут каждого апстрима переопределяется переменной окружения HTTP_TIMEOUT_<ИМЯ>.
+UPSTREAMS = {
+    "openrouter": ("https://openrouter.ai/api/v1", 120.0),
+    "openai": (None, 60.0),
+    "unsplash": ("https://api.unsplash.com", 15.0),
+    "telegram_api": ("https://api.telegram.org", 15.0),
+    "telegram_web": ("https://t.me", 10.0),
+    "supabase_rest": (None, 10.0),
+    "supabase_storage": (None, 30.0),
+    "external": (None, 30.0),
+}
+
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+_openai_clients: Dict[str, AsyncOpenAI] = {}
+
+
+def _upstream_timeout(name: str) -> float:
+    default = UPSTREAMS[name][1]
+    return float(os.getenv(f"HTTP_TIMEOUT_{name.upper()}", default))
+
+
+def _build_http_client(name: str) -> httpx.AsyncClient:
+    base_url = UPSTREAMS[name][0]
+    if name in ("supabase_rest", "supabase_storage"):
+        supabase_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+        if supabase_url:
+            base_url = f"{supabase_url}/rest/v1" if name == "supabase_rest" else f"{supabase_url}/storage/v1"
+    timeout = _upstream_timeout(name)
+    kwargs = dict(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        follow_redirects=name == "external",
+    )
+    if base_url:
+        kwargs["base_url"] = base_url
+    return httpx.AsyncClient(**kwargs)
+
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """Возвращает общий httpx.AsyncClient для апстрима (создается при первом обращении)."""
+    if name not in UPSTREAMS:
+        raise ValueError(f"Неизвестный апстрим HTTP-клиента: {name}")
+    client = _http_clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_http_client(name)
+        _http_clients[name] = client
+        logger.info(f"Создан HTTP-клиент для апстрима '{name}' (http2={HTTP2_AVAILABLE})")
+    return client
+
+
+def get_openai_client(name: str = "openrouter") -> Optional[AsyncOpenAI]:
+    """Возвращает общий AsyncOpenAI для OpenRouter или OpenAI, либо None, если ключ не задан."""
+    client = _openai_clients.get(name)
+    if client is not None:
+        return client
+    if name == "openrouter":
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        base_url = UPSTREAMS["openrouter"][0]
+    elif name == "openai":
+        api_key = os.getenv("OPENAI_API_KEY")
+        base_url = None
+    else:
+        raise ValueError(f"Неизвестный LLM-апстрим: {name}")
+    if not api_key:
+        return None
+    # Для OpenAI SDK используем отдельный httpx-клиент без base_url, SDK сам подставляет свой
+    http_client = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(_upstream_timeout(name), connect=10.0),
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    kwargs = {"api_key": api_key, "http_client": http_client}
+    if base_url:
+        kwargs["base_url"] = base_url
+    client = AsyncOpenAI(**kwargs)
+    _openai_clients[name] = client
+    logger.info(f"Создан клиент LLM для апстрима '{name}'")
+    return client
+
+
+async def init_http_clients():
+    """Прогревает реестр клиентов при старте приложения."""
+    for name in UPSTREAMS:
+        get_http_client(name)
+    get_openai_client("openrouter")
+    get_openai_client("openai")
+
+
+async def close_http_clients():
+    """Закрывает все клиенты реестра при остановке приложения."""
+    for name, client in list(_http_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии HTTP-клиента '{name}': {e}")
+    _http_clients.clear()
+    for name, client in list(_openai_clients.items()):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии клиента LLM '{name}': {e}")
+    _openai_clients.clear()
@@ -0,0 +1,227 @@
+# Фоновые задачи генерации: POST ставит задачу в очередь и сразу отвечает id,
+# ограниченный пул воркеров выполняет обработчик, клиент получает результат через GET /jobs/{id} или SSE
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+from backend.db import db
+
+logger = logging.getLogger(__name__)
+
+# Сколько генераций выполняется одновременно и сколько может ждать в очереди
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100"))
+# Незавершенных задач на одного пользователя
+JOB_MAX_PENDING_PER_USER = int(os.getenv("JOB_MAX_PENDING_PER_USER", "3"))
+# Сколько хранить завершенные задачи в памяти (секунды)
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+# Дублировать состояние задач в таблицу generation_jobs (результат доступен другим процессам и после рестарта)
+JOBS_DB_BACKING = os.getenv("JOBS_DB_BACKING", "false").lower() == "true"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class Job:
+    """Задача генерации: состояние, результат или ошибка и событие завершения для ожидающих."""
+
+    def __init__(self, kind: str, user_id: int, fn: Callable[[], Awaitable[Any]]):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.user_id = user_id
+        self.fn = fn
+        self.status = JOB_QUEUED
+        self.result: Any = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.created_at = datetime.now(timezone.utc)
+        self.updated_at = self.created_at
+        self.finished_monotonic: Optional[float] = None
+        self.changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
+
+    def set_status(self, status: str):
+        self.status = status
+        self.updated_at = datetime.now(timezone.utc)
+        if self.finished:
+            self.finished_monotonic = time.monotonic()
+        # Будим всех ожидающих и сразу готовим событие к следующему изменению
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class JobQueue:
+    """Очередь задач с фиксированным числом воркеров и хранилищем состояний в памяти процесса."""
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopped = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        if self.started or self._stopped:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Очередь задач генерации запущена: {self.workers} воркеров, до {self.max_queued} задач в очереди")
+
+    async def stop(self):
+        """
+        Останавливает воркеры: выполняемые задачи прерываются, ожидающие в очереди помечаются
+        как неудавшиеся. Состояние сохраняется в БД, поэтому вызывать до закрытия соединений.
+        """
+        self._stopped = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        queue, self._queue = self._queue, None
+        while queue is not None and not queue.empty():
+            job: Job = queue.get_nowait()
+            job.fn = None
+            job.error = {"status_code": 503, "detail": "Задача прервана остановкой сервера"}
+            job.set_status(JOB_FAILED)
+            await _persist(job)
+
+    def _pending_for_user(self, user_id: int) -> int:
+        return sum(1 for job in self._jobs.values() if job.user_id == user_id and not job.finished)
+
+    def _evict_finished(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_monotonic is not None and now - job.finished_monotonic > JOB_RESULT_TTL]
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+
+    async def submit(self, kind: str, user_id: int, fn: Callable[[], Awaitable[Any]]) -> Job:
+        """Ставит задачу в очередь. 429 — у пользователя слишком много незавершенных задач, 503 — очередь заполнена или остановлена."""
+        await self.start()
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Сервер останавливается. Попробуйте позже.")
+        self._evict_finished()
+        if self._pending_for_user(user_id) >= JOB_MAX_PENDING_PER_USER:
+            raise HTTPException(status_code=429, detail="Слишком много незавершенных задач генерации. Дождитесь их завершения.")
+        job = Job(kind, user_id, fn)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Сервер перегружен задачами генерации. Попробуйте позже.")
+        self._jobs[job.id] = job
+        logger.info(f"Задача {kind} {job.id} пользователя {user_id} поставлена в очередь ({self._queue.qsize()} в очереди)")
+        await _persist(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Состояние задачи из памяти процесса, иначе (при JOBS_DB_BACKING) из таблицы generation_jobs."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return {**job.to_dict(), "user_id": job.user_id}
+        return await _load_persisted(job_id)
+
+    def get_local(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _worker(self, number: int):
+        while True:
+            job: Job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.set_status(JOB_RUNNING)
+        await _persist(job)
+        started = time.monotonic()
+        try:
+            job.result = jsonable_encoder(await job.fn())
+            job.set_status(JOB_SUCCEEDED)
+        except asyncio.CancelledError:
+            job.error = {"status_code": 503, "detail": "Задача прервана остановкой сервера"}
+            job.set_status(JOB_FAILED)
+            raise
+        except HTTPException as http_err:
+            job.error = {"status_code": http_err.status_code, "detail": http_err.detail}
+            job.set_status(JOB_FAILED)
+        except Exception as e:
+            logger.error(f"Ошибка выполнения задачи {job.kind} {job.id}: {e}", exc_info=True)
+            job.error = {"status_code": 500, "detail": f"Внутренняя ошибка сервера: {str(e)}"}
+            job.set_status(JOB_FAILED)
+        finally:
+            job.fn = None
+            logger.info(f"Задача {job.kind} {job.id} завершена со статусом {job.status} за {time.monotonic() - started:.1f} с")
+            await _persist(job)
+
+
+async def _persist(job: Job):
+    if not JOBS_DB_BACKING or not db:
+        return
+    try:
+        await db.table("generation_jobs").upsert({
+            "id": job.id,
+            "user_id": job.user_id,
+            "kind": job.kind,
+            "status": job.status,
+            "result": job.result,
+            "error": job.error,
+            "created_at": job.created_at.isoformat(),
+            "updated_at": job.updated_at.isoformat(),
+        }).execute()
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить состояние задачи {job.id} в БД: {e}")
+
+
+async def _load_persisted(job_id: str) -> Optional[Dict[str, Any]]:
+    if not JOBS_DB_BACKING or not db:
+        return None
+    try:
+        result = await db.table("generation_jobs").select("*").eq("id", job_id).limit(1).execute()
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать задачу {job_id} из БД: {e}")
+        return None
+    if not getattr(result, "data", None):
+        return None
+    row = result.data[0]
+    return {
+        "job_id": row.get("id"),
+        "kind": row.get("kind"),
+        "status": row.get("status"),
+        "result": row.get("result"),
+        "error": row.get("error"),
+        "created_at": row.get("created_at"),
+        "updated_at": row.get("updated_at"),
+        "user_id": row.get("user_id"),
+    }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,594 @@
+# Единый шлюз к LLM: маршрутизация моделей, дедлайны, ретраи с джиттером,
+# circuit breaker и автоматический переход на резервного провайдера
+import asyncio
+import os
+import random
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import openai
+
+from backend.http_clients import get_openai_client
+from backend.prompts import record_template_call, template_task
+from backend.singleflight import SingleFlight, hash_key
+
+logger = logging.getLogger(__name__)
+
+LLM_PRIMARY_MODEL = os.getenv("LLM_PRIMARY_MODEL", "google/gemini-2.5-flash-preview")
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gpt-3.5-turbo")
+
+# Общий бюджет времени на вызов и лимит на одну попытку (секунды)
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE", "60"))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "45"))
+# Попыток на одного провайдера и параметры экспоненциальной задержки с джиттером
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+# Circuit breaker: сколько ошибок подряд открывает цепь и на сколько секунд
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+OPENROUTER_EXTRA_HEADERS = {
+    "HTTP-Referer": "https://content-manager.onrender.com",
+    "X-Title": "Smart Content Assistant"
+}
+
+# Поддерживает ли резервная модель response_format с JSON-схемой (gpt-3.5-turbo — нет, только json_object)
+LLM_FALLBACK_STRUCTURED_OUTPUTS = os.getenv("LLM_FALLBACK_STRUCTURED_OUTPUTS", "false").lower() == "true"
+# Запрашивать usage в конце потока (stream_options.include_usage) для статистики токенов по шаблонам
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() == "true"
+
+# Маршрутизатор моделей OpenRouter: кандидаты для каждого класса задачи (keywords, analysis, plan, post)
+# через запятую в LLM_MODELS_<КЛАСС>, по умолчанию — LLM_ROUTER_MODELS
+LLM_ROUTER_MODELS = os.getenv("LLM_ROUTER_MODELS", f"{LLM_PRIMARY_MODEL},openai/gpt-4o-mini")
+LLM_TASKS = ("keywords", "analysis", "plan", "post")
+# Коэффициент сглаживания EWMA задержки и доли ошибок и окно последних задержек для p90
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.2"))
+LLM_ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "50"))
+# Модель с долей ошибок выше порога уходит в конец очереди кандидатов
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))
+# Хеджирование: если основная модель не ответила за p90 своей задержки, тот же запрос уходит второй модели
+LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "5"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "10"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+
+# Провайдеры в порядке приоритета: имя клиента в http_clients -> модель, доп. заголовки, поддержка JSON-схем
+# и выбор модели маршрутизатором
+PROVIDERS: Dict[str, Dict[str, Any]] = {
+    "openrouter": {"model": LLM_PRIMARY_MODEL, "extra_headers": OPENROUTER_EXTRA_HEADERS, "structured_outputs": True, "routed": True},
+    "openai": {"model": LLM_FALLBACK_MODEL, "extra_headers": None, "structured_outputs": LLM_FALLBACK_STRUCTURED_OUTPUTS, "routed": False},
+}
+PROVIDER_ORDER = ["openrouter", "openai"]
+
+
+class LLMGatewayError(Exception):
+    """Ни один из провайдеров не вернул ответ."""
+
+
+class EmptyCompletionError(Exception):
+    """Провайдер ответил, но без текста."""
+
+
+class LLMCompletion:
+    """Результат вызова complete(): текст и сведения о том, кто его сгенерировал."""
+
+    def __init__(self, text: str, provider: str, model: str, usage: Any = None, latency: float = 0.0,
+                 template: Optional[str] = None):
+        self.text = text
+        self.provider = provider
+        self.model = model
+        self.usage = usage
+        self.latency = latency
+        self.template = template
+
+    @property
+    def used_fallback(self) -> bool:
+        return self.provider != PROVIDER_ORDER[0]
+
+
+class CircuitBreaker:
+    """
+    Закрыт — запросы идут. После LLM_BREAKER_FAILURE_THRESHOLD ошибок подряд открывается
+    и отклоняет запросы без обращения к провайдеру. Через LLM_BREAKER_COOLDOWN секунд
+    пропускает один пробный запрос: успех закрывает цепь, ошибка открывает снова.
+    """
+
+    def __init__(self, name: str, threshold: int = LLM_BREAKER_FAILURE_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if asyncio.get_running_loop().time() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker '{self.name}' закрыт: провайдер снова отвечает")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Снимает пробный запрос без учета исхода: он отменен или не успел уйти к провайдеру."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = asyncio.get_running_loop().time()
+            logger.warning(f"Circuit breaker '{self.name}' открыт на {self.cooldown} с после {self.failures} ошибок подряд")
+
+
+class ModelStats:
+    """EWMA задержки успешных ответов и доли ошибок модели на одном классе задач, окно задержек для p90."""
+
+    def __init__(self):
+        self.samples = 0
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.recent: deque = deque(maxlen=LLM_ROUTER_WINDOW)
+
+    def record(self, latency: float, ok: bool):
+        alpha = LLM_ROUTER_EWMA_ALPHA
+        self.samples += 1
+        self.error_ewma = (1 - alpha) * self.error_ewma + alpha * (0.0 if ok else 1.0)
+        if ok:
+            self.latency_ewma = latency if self.latency_ewma is None else (1 - alpha) * self.latency_ewma + alpha * latency
+            self.recent.append(latency)
+
+    def record_censored(self, latency: float):
+        """
+        Запрос отменен, проиграв хеджирование: прошедшее время — лишь нижняя оценка задержки.
+        Оценка может только поднять EWMA задержки; доля ошибок и окно p90 не меняются.
+        """
+        self.samples += 1
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        elif latency > self.latency_ewma:
+            alpha = LLM_ROUTER_EWMA_ALPHA
+            self.latency_ewma = (1 - alpha) * self.latency_ewma + alpha * latency
+
+    def p90(self) -> Optional[float]:
+        if len(self.recent) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+
+class ModelRouter:
+    """
+    Порядок моделей для класса задачи: сначала еще не опробованные (по порядку в настройках),
+    затем по EWMA задержки с поправкой на долю ошибок; модели с долей ошибок выше
+    LLM_ROUTER_MAX_ERROR_RATE — в конце.
+    """
+
+    def __init__(self, task_models: Dict[str, List[str]]):
+        self.task_models = task_models
+        self._stats: Dict[Tuple[str, str], ModelStats] = {}
+
+    def _get(self, task: str, model: str) -> ModelStats:
+        return self._stats.setdefault((task, model), ModelStats())
+
+    def ranked(self, task: str) -> List[str]:
+        models = self.task_models.get(task) or [LLM_PRIMARY_MODEL]
+
+        def sort_key(item):
+            position, model = item
+            stats = self._stats.get((task, model))
+            if stats is None or stats.samples == 0:
+                return (0, 0.0, position)
+            if stats.latency_ewma is None or stats.error_ewma > LLM_ROUTER_MAX_ERROR_RATE:
+                return (2, stats.error_ewma, position)
+            return (1, stats.latency_ewma / max(0.05, 1.0 - stats.error_ewma), position)
+
+        return [model for _, model in sorted(enumerate(models), key=sort_key)]
+
+    def record(self, task: str, model: str, latency: float, ok: bool):
+        self._get(task, model).record(latency, ok)
+
+    def record_censored(self, task: str, model: str, latency: float):
+        self._get(task, model).record_censored(latency)
+
+    def hedge_delay(self, task: str, model: str) -> float:
+        stats = self._stats.get((task, model))
+        p90 = stats.p90() if stats else None
+        return max(LLM_HEDGE_MIN_DELAY, p90 if p90 is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        result: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for (task, model), stats in self._stats.items():
+            p90 = stats.p90()
+            result.setdefault(task, {})[model] = {
+                "samples": stats.samples,
+                "latency_ewma": round(stats.latency_ewma, 3) if stats.latency_ewma is not None else None,
+                "error_ewma": round(stats.error_ewma, 3),
+                "p90": round(p90, 3) if p90 is not None else None,
+            }
+        return result
+
+
+def _task_models() -> Dict[str, List[str]]:
+    models = {}
+    for task in LLM_TASKS:
+        configured = os.getenv(f"LLM_MODELS_{task.upper()}", LLM_ROUTER_MODELS)
+        models[task] = list(dict.fromkeys(m.strip() for m in configured.split(",") if m.strip()))
+    return models
+
+
+_breakers: Dict[str, CircuitBreaker] = {name: CircuitBreaker(name) for name in PROVIDERS}
+_router = ModelRouter(_task_models())
+# Одинаковые вызовы (тот же промпт и параметры), выполняющиеся одновременно, идут к провайдеру один раз
+_completion_flight = SingleFlight("llm")
+
+
+def breaker_states() -> Dict[str, str]:
+    return {name: breaker.state for name, breaker in _breakers.items()}
+
+
+def router_stats() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Статистика маршрутизатора: класс задачи -> модель -> EWMA задержки и ошибок, p90."""
+    return _router.snapshot()
+
+
+def _routed_models(provider: str, index: int, model: Optional[str], task: Optional[str]) -> List[str]:
+    """Кандидаты маршрутизатора для провайдера или пустой список, если модель задана явно или класс неизвестен."""
+    if not PROVIDERS[provider].get("routed") or task not in LLM_TASKS or (model and index == 0):
+        return []
+    return _router.ranked(task)
+
+
+def available_providers(providers: Optional[Sequence[str]] = None) -> List[str]:
+    """Провайдеры в порядке приоритета, для которых настроен API ключ."""
+    return [name for name in (providers or PROVIDER_ORDER) if get_openai_client(name) is not None]
+
+
+def is_llm_configured() -> bool:
+    return bool(available_providers())
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, EmptyCompletionError, openai.APITimeoutError,
+                          openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_delay(attempt: int) -> float:
+    """Full jitter: случайная задержка от 0 до base * 2^attempt (не больше LLM_RETRY_MAX_DELAY)."""
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def _request_kwargs(provider: str, model: Optional[str], messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    config = PROVIDERS[provider]
+    request = {"model": model or config["model"], "messages": messages, **kwargs}
+    if config["extra_headers"]:
+        request["extra_headers"] = {**config["extra_headers"], **(kwargs.get("extra_headers") or {})}
+    response_format = kwargs.get("response_format")
+    if response_format and response_format.get("type") == "json_schema" and not config["structured_outputs"]:
+        # Модель без structured outputs: просим просто JSON, схему проверяет вызывающий код
+        request["response_format"] = {"type": "json_object"}
+    return request
+
+
+def _extract_text(response: Any) -> str:
+    if response and response.choices and response.choices[0].message and response.choices[0].message.content:
+        return response.choices[0].message.content.strip()
+    error = getattr(response, "error", None)
+    if error:
+        raise EmptyCompletionError(getattr(error, "message", str(error)))
+    raise EmptyCompletionError("Провайдер вернул пустой ответ")
+
+
+async def _routed_create(client: Any, request: Dict[str, Any], models: List[str], timeout: float, task: str) -> Tuple[Any, str]:
+    """
+    Запрос к лучшей модели класса задачи. Если она не ответила за p90 своей задержки (или раньше вернула ошибку),
+    тот же запрос уходит следующей модели; побеждает первый успешный ответ, второй запрос отменяется.
+    Возвращает (ответ, модель). Задержка и исход каждого завершенного запроса учитываются маршрутизатором,
+    у отмененного проигравшего учитывается только нижняя оценка задержки.
+    """
+    loop = asyncio.get_running_loop()
+    hedge_lost = False
+
+    async def call(routed_model: str):
+        started_at = loop.time()
+        try:
+            response = await asyncio.wait_for(
+                client.chat.completions.create(timeout=timeout, **{**request, "model": routed_model}), timeout=timeout
+            )
+            _extract_text(response)
+        except asyncio.CancelledError:
+            # Проигрыш гонки — не ошибка модели: только цензурированная задержка; отмена самого вызова — никак
+            if hedge_lost:
+                _router.record_censored(task, routed_model, loop.time() - started_at)
+            raise
+        except Exception:
+            _router.record(task, routed_model, loop.time() - started_at, ok=False)
+            raise
+        _router.record(task, routed_model, loop.time() - started_at, ok=True)
+        return response, routed_model
+
+    primary = asyncio.create_task(call(models[0]))
+    pending = {primary}
+    try:
+        if not LLM_HEDGING or len(models) < 2:
+            return await primary
+        delay = _router.hedge_delay(task, models[0])
+        if delay < timeout:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done and primary.exception() is None:
+                hedge_lost = True
+                return primary.result()
+            if done:
+                logger.warning(f"Модель {models[0]} вернула ошибку ({task}), повторяем запрос моделью {models[1]}")
+            else:
+                logger.info(f"Модель {models[0]} не ответила за {delay:.1f} с ({task}), дублируем запрос модели {models[1]}")
+            pending.add(asyncio.create_task(call(models[1])))
+        error: Optional[BaseException] = primary.exception() if primary.done() else None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                if finished.exception() is None:
+                    hedge_lost = True
+                    return finished.result()
+                error = error or finished.exception()
+        raise error
+    finally:
+        for unfinished in pending:
+            unfinished.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def complete(
+    messages: List[Dict[str, str]],
+    *,
+    model: Optional[str] = None,
+    providers: Optional[Sequence[str]] = None,
+    deadline: Optional[float] = None,
+    attempt_timeout: Optional[float] = None,
+    coalesce: bool = True,
+    template: Optional[str] = None,
+    task: Optional[str] = None,
+    **kwargs: Any,
+) -> LLMCompletion:
+    """
+    Выполняет chat completion. Провайдеры перебираются по порядку (OpenRouter, затем OpenAI);
+    временные ошибки повторяются с джиттером, провайдер с открытым circuit breaker пропускается сразу.
+    `model` переопределяет модель только первого провайдера, `deadline` ограничивает весь вызов.
+    При `coalesce` одновременные вызовы с тем же промптом и параметрами получают один общий ответ.
+    `template` — id шаблона промпта из backend.prompts, по нему учитываются задержка и токены.
+    `task` — класс задачи для выбора модели OpenRouter (по умолчанию берется из шаблона);
+    если основная модель не ответила за p90 своей задержки, запрос дублируется следующей модели.
+    Остальные аргументы (temperature, max_tokens, response_format, ...) передаются в API как есть.
+    """
+    task = task or template_task(template)
+    if not coalesce:
+        return await _complete(messages, model, providers, deadline, attempt_timeout, template, task, kwargs)
+    key = hash_key(messages, model, list(providers or PROVIDER_ORDER), kwargs)
+    completion, shared = await _completion_flight.do(
+        key, lambda: _complete(messages, model, providers, deadline, attempt_timeout, template, task, kwargs)
+    )
+    if shared:
+        logger.info("Ответ LLM получен из уже выполнявшегося одинакового запроса")
+    return completion
+
+
+async def _complete(
+    messages: List[Dict[str, str]],
+    model: Optional[str],
+    providers: Optional[Sequence[str]],
+    deadline: Optional[float],
+    attempt_timeout: Optional[float],
+    template: Optional[str],
+    task: Optional[str],
+    kwargs: Dict[str, Any],
+) -> LLMCompletion:
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + (deadline or LLM_DEFAULT_DEADLINE)
+    attempt_timeout = attempt_timeout or LLM_ATTEMPT_TIMEOUT
+    chain = available_providers(providers)
+    if not chain:
+        raise LLMGatewayError("Не настроен ни один LLM-провайдер (OPENROUTER_API_KEY, OPENAI_API_KEY)")
+
+    errors = []
+    for index, provider in enumerate(chain):
+        if expires_at - loop.time() <= 0:
+            break
+        breaker = _breakers[provider]
+        # Пробный запрос half_open должен быть снят при любом выходе, в том числе при отмене
+        probing = breaker.state == "half_open"
+        if not breaker.allow():
+            errors.append(f"{provider}: circuit breaker открыт")
+            logger.warning(f"Провайдер {provider} пропущен: circuit breaker открыт")
+            continue
+        try:
+            completion = await _complete_with_provider(
+                provider, index, breaker, messages, model, expires_at, attempt_timeout, template, task, kwargs, errors
+            )
+        finally:
+            if probing:
+                breaker.release_probe()
+        if completion is not None:
+            return completion
+
+    raise LLMGatewayError("; ".join(errors) or "Дедлайн вызова LLM истек")
+
+
+async def _complete_with_provider(
+    provider: str,
+    index: int,
+    breaker: CircuitBreaker,
+    messages: List[Dict[str, str]],
+    model: Optional[str],
+    expires_at: float,
+    attempt_timeout: float,
+    template: Optional[str],
+    task: Optional[str],
+    kwargs: Dict[str, Any],
+    errors: List[str],
+) -> Optional[LLMCompletion]:
+    """Попытки одного провайдера с ретраями; None — провайдер не ответил, ошибки дописаны в errors."""
+    loop = asyncio.get_running_loop()
+    client = get_openai_client(provider).with_options(max_retries=0)
+    request = _request_kwargs(provider, model if index == 0 else None, messages, kwargs)
+    routed = bool(_routed_models(provider, index, model, task))
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        remaining = expires_at - loop.time()
+        if remaining <= 0:
+            break
+        timeout = min(remaining, attempt_timeout)
+        started_at = loop.time()
+        try:
+            if routed:
+                # Порядок пересчитывается на каждой попытке: ошибка прошлой попытки уже учтена
+                response, request["model"] = await _routed_create(client, request, _router.ranked(task), timeout, task)
+            else:
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(timeout=timeout, **request), timeout=timeout
+                )
+            text = _extract_text(response)
+        except Exception as e:
+            retryable = _is_retryable(e)
+            errors.append(f"{provider}: {type(e).__name__}: {e}")
+            logger.warning(f"Ошибка LLM {provider} (попытка {attempt + 1}/{LLM_MAX_ATTEMPTS}): {type(e).__name__}: {e}")
+            if not retryable:
+                # Ошибки запроса (400, 401 и т.п.) не означают деградацию провайдера
+                breaker.record_success()
+                break
+            breaker.record_failure()
+            # Сразу после ошибки цепь либо закрыта, либо только что открылась — пробный запрос здесь не берется
+            if breaker.state != "closed" or attempt + 1 >= LLM_MAX_ATTEMPTS:
+                break
+            await asyncio.sleep(min(_retry_delay(attempt), max(0.0, expires_at - loop.time())))
+            continue
+        breaker.record_success()
+        latency = loop.time() - started_at
+        if index > 0:
+            logger.info(f"Ответ получен от резервного провайдера {provider}")
+        usage = getattr(response, "usage", None)
+        record_template_call(template, provider, latency, usage)
+        return LLMCompletion(text, provider, request["model"], usage, latency, template)
+    return None
+
+
+async def stream(
+    messages: List[Dict[str, str]],
+    *,
+    model: Optional[str] = None,
+    providers: Optional[Sequence[str]] = None,
+    deadline: Optional[float] = None,
+    info: Optional[Dict[str, Any]] = None,
+    template: Optional[str] = None,
+    task: Optional[str] = None,
+    **kwargs: Any,
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация: отдает фрагменты текста по мере поступления.
+    На резервного провайдера переключается только до первого фрагмента.
+    Если передан словарь `info`, в него записываются provider и model.
+    `template` и `task` — как в complete(). Модель выбирается маршрутизатором, но поток не дублируется:
+    отданные клиенту фрагменты нельзя отозвать.
+    """
+    task = task or template_task(template)
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + (deadline or LLM_DEFAULT_DEADLINE)
+    chain = available_providers(providers)
+    if not chain:
+        raise LLMGatewayError("Не настроен ни один LLM-провайдер (OPENROUTER_API_KEY, OPENAI_API_KEY)")
+
+    if LLM_STREAM_USAGE and "stream_options" not in kwargs:
+        kwargs = {**kwargs, "stream_options": {"include_usage": True}}
+
+    errors = []
+    for index, provider in enumerate(chain):
+        remaining = expires_at - loop.time()
+        if remaining <= 0:
+            break
+        breaker = _breakers[provider]
+        probing = breaker.state == "half_open"
+        if not breaker.allow():
+            errors.append(f"{provider}: circuit breaker открыт")
+            continue
+        client = get_openai_client(provider).with_options(max_retries=0)
+        request = _request_kwargs(provider, model if index == 0 else None, messages, kwargs)
+        routed_models = _routed_models(provider, index, model, task)
+        if routed_models:
+            request["model"] = routed_models[0]
+        started = False
+        usage = None
+        started_at = loop.time()
+        response_stream = None
+        try:
+            response_stream = await asyncio.wait_for(
+                client.chat.completions.create(stream=True, timeout=remaining, **request), timeout=remaining
+            )
+            chunks = response_stream.__aiter__()
+            while True:
+                remaining = expires_at - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError("Дедлайн потоковой генерации истек")
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                # При include_usage последний фрагмент приходит без choices, но с usage
+                usage = getattr(chunk, "usage", None) or usage
+                delta = chunk.choices[0].delta.content if chunk.choices and chunk.choices[0].delta else None
+                if not delta:
+                    continue
+                if not started:
+                    started = True
+                    if info is not None:
+                        info.update(provider=provider, model=request["model"])
+                yield delta
+            if not started:
+                raise EmptyCompletionError("Провайдер вернул пустой поток")
+        except Exception as e:
+            errors.append(f"{provider}: {type(e).__name__}: {e}")
+            logger.warning(f"Ошибка потоковой генерации {provider}: {type(e).__name__}: {e}")
+            if routed_models:
+                _router.record(task, request["model"], loop.time() - started_at, ok=False)
+            if _is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if started:
+                raise LLMGatewayError(f"Поток {provider} прерван: {e}") from e
+            continue
+        finally:
+            # Потребитель ушел (GeneratorExit), вызов отменен или поток завершился — соединение закрывается,
+            # пробный запрос half_open снимается без учета исхода
+            if probing:
+                breaker.release_probe()
+            if response_stream is not None and hasattr(response_stream, "close"):
+                try:
+                    await response_stream.close()
+                except Exception as close_error:
+                    logger.debug(f"Не удалось закрыть поток {provider}: {close_error}")
+        breaker.record_success()
+        if routed_models:
+            _router.record(task, request["model"], loop.time() - started_at, ok=True)
+        record_template_call(template, provider, loop.time() - started_at, usage)
+        return
+
+    raise LLMGatewayError("; ".join(errors) or "Дедлайн вызова LLM истек")
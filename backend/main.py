@@ -40,7 +40,14 @@ import requests
 from bs4 import BeautifulSoup
 import telethon
 import aiohttp
-from backend.telegram_utils import get_telegram_posts_via_telethon, get_telegram_posts_via_http, get_sample_posts
+from backend.telegram_utils import get_telegram_posts_via_telethon, get_telegram_posts_via_http, get_sample_posts, telethon_gateway
+from backend.http_clients import get_http_client, init_http_clients, close_http_clients
+from backend.llm_gateway import complete as llm_complete, LLMGatewayError
+from backend.db import db, init_pg_pool, get_pg_pool, close_pg_pool
+from backend.jobs import job_queue
+from backend.prompts import registered_templates
+from backend.text_cleanup import clean_text_formatting, clean_text_formatting_batch_async
+from backend.schema_state import SCHEMA_RECONCILE_COMMANDS, SCHEMA_VERSION, ensure_schema, ensure_schema_verified, is_schema_verified, schema_fingerprint
 import backend.move_temp_files
 from datetime import datetime, timedelta
 import traceback
@@ -86,6 +93,7 @@ SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 SESSION_NAME = "telegram_session" # <-- Определяем имя файла сессии
 IMAGE_SEARCH_COUNT = 15 # Сколько изображений запрашивать у Unsplash
 IMAGE_RESULTS_COUNT = 5 # Сколько изображений показывать пользователю
+IMAGE_SEARCH_DEADLINE = float(os.getenv("IMAGE_SEARCH_DEADLINE", "8")) # Общий дедлайн (сек) на параллельный поиск изображений
 
 # --- Валидация переменных окружения без аварийного завершения --- 
 missing_keys = []
@@ -166,9 +174,9 @@ async def _execute_sql_direct(sql_query: str) -> Dict[str, Any]:
     }
     
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(url, json={"query": sql_query}, headers=headers)
-        
+        client = get_http_client("supabase_rest")
+        response = await client.post(url, json={"query": sql_query}, headers=headers)
+
         if response.status_code in [200, 204]:
             try:
                 return {"status_code": response.status_code, "data": response.json()}
@@ -214,14 +222,16 @@ app.add_middleware(
 )
 
 # --- Подключение роутеров ---
-from backend.routes import user_limits, analysis, ideas, posts, user_settings, images
+from backend.routes import user_limits, analysis, ideas, posts, user_settings, images, jobs
 # Импортируем новый роутер для проверки подписки на канал
 from backend.services.telegram_subscription_check import info_router as telegram_channel_info_router
+from backend.services.premium_status_service import get_premium_status, invalidate_premium_status
 
 app.include_router(user_limits.router)
 app.include_router(analysis.router)
 app.include_router(ideas.router)
 app.include_router(posts.router)
+app.include_router(jobs.router)
 app.include_router(user_settings.router, prefix="/api/user", tags=["User Settings"])
 app.include_router(images.router, prefix="/api", tags=["Images"])
 # Добавляем новый роутер для проверки подписки на канал
@@ -263,8 +273,8 @@ async def bot_style_premium_check(user_id: str, request: Request):
         "is_active": "eq.true"
     }
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(f"{supabase_url}/rest/v1/user_subscription", headers=headers, params=params)
+        client = get_http_client("supabase_rest")
+        resp = await client.get(f"{supabase_url}/rest/v1/user_subscription", headers=headers, params=params)
         if resp.status_code != 200:
             logger.error(f"[BOT-STYLE] Ошибка Supabase REST: {resp.status_code} - {resp.text}")
             return JSONResponse(status_code=500, content={"success": False, "error": f"Supabase REST error: {resp.status_code}"})
@@ -339,13 +349,13 @@ async def generate_invoice(request: Request):
             "prices": [{"label": "Подписка", "amount": amount * 100}],
             "photo_url": "https://smart-content-assistant.onrender.com/static/premium_sub.jpg"
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            tg_data = response.json()
-            if not tg_data.get("ok"):
-                logger.error(f"Ошибка Telegram API: {tg_data}")
-                raise HTTPException(status_code=500, detail=f"Ошибка Telegram API: {tg_data}")
-            invoice_url = tg_data["result"]
+        client = get_http_client("telegram_api")
+        response = await client.post(url, json=payload)
+        tg_data = response.json()
+        if not tg_data.get("ok"):
+            logger.error(f"Ошибка Telegram API: {tg_data}")
+            raise HTTPException(status_code=500, detail=f"Ошибка Telegram API: {tg_data}")
+        invoice_url = tg_data["result"]
         return {"invoice_url": invoice_url, "payment_id": payment_id}
     except Exception as e:
         logger.error(f"Ошибка при генерации инвойса: {e}")
@@ -379,12 +389,12 @@ async def send_stars_invoice(request: Request):
             "is_flexible": False,
             "photo_url": "https://smart-content-assistant.onrender.com/static/premium_sub.jpg"
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            tg_data = response.json()
-            if not tg_data.get("ok"):
-                logger.error(f"Ошибка Telegram API sendInvoice: {tg_data}")
-                return {"success": False, "message": f"Ошибка Telegram API: {tg_data}"}
+        client = get_http_client("telegram_api")
+        response = await client.post(url, json=payload)
+        tg_data = response.json()
+        if not tg_data.get("ok"):
+            logger.error(f"Ошибка Telegram API sendInvoice: {tg_data}")
+            return {"success": False, "message": f"Ошибка Telegram API: {tg_data}"}
         return {"success": True, "message": "Инвойс отправлен в чат с ботом. Проверьте Telegram и оплатите счёт."}
     except Exception as e:
         logger.error(f"Ошибка при отправке Stars-инвойса: {e}")
@@ -412,13 +422,13 @@ async def generate_stars_invoice_link(request: Request):
             "prices": [{"label": "XTR", "amount": amount}], # <--- Цена теперь 1
             "photo_url": "https://smart-content-assistant.onrender.com/static/premium_sub.jpg"
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            tg_data = response.json()
-            if not tg_data.get("ok"):
-                logger.error(f"Ошибка Telegram API createInvoiceLink: {tg_data}")
-                return {"success": False, "error": tg_data}
-            invoice_link = tg_data["result"]
+        client = get_http_client("telegram_api")
+        response = await client.post(url, json=payload)
+        tg_data = response.json()
+        if not tg_data.get("ok"):
+            logger.error(f"Ошибка Telegram API createInvoiceLink: {tg_data}")
+            return {"success": False, "error": tg_data}
+        invoice_link = tg_data["result"]
         return {"success": True, "invoice_link": invoice_link}
     except Exception as e:
         logger.error(f"Ошибка при генерации Stars invoice link: {e}")
@@ -501,12 +511,12 @@ async def telegram_webhook(request: Request):
             if not bot_token:
                 logger.error("[telegram_webhook] Нет TELEGRAM_BOT_TOKEN")
                 return {"ok": False, "error": "TELEGRAM_BOT_TOKEN не задан"}
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(
-                    f"https://api.telegram.org/bot{bot_token}/answerPreCheckoutQuery",
-                    json={"pre_checkout_query_id": query_id, "ok": True}
-                )
-                logger.info(f"[telegram_webhook] Ответ на pre_checkout_query: {resp.text}")
+            client = get_http_client("telegram_api")
+            resp = await client.post(
+                f"https://api.telegram.org/bot{bot_token}/answerPreCheckoutQuery",
+                json={"pre_checkout_query_id": query_id, "ok": True}
+            )
+            logger.info(f"[telegram_webhook] Ответ на pre_checkout_query: {resp.text}")
             return {"ok": True, "pre_checkout_query": True}
 
         # 2. Обработка успешной оплаты
@@ -529,10 +539,10 @@ async def telegram_webhook(request: Request):
             logger.info(f'[telegram_webhook] Успешная оплата: user_id={user_id} ({type(user_id)}), payment_id={payment_id}, start_date={start_date}, end_date={end_date}')
             try:
                 # Проверяем, есть ли уже подписка
-                existing = supabase.table("user_subscription").select("id").eq("user_id", user_id).execute()
+                existing = await db.table("user_subscription").select("id").eq("user_id", user_id).execute()
                 if existing and hasattr(existing, "data") and existing.data and len(existing.data) > 0:
                     # Обновляем
-                    supabase.table("user_subscription").update({
+                    await db.table("user_subscription").update({
                         "start_date": start_date.isoformat(),
                         "end_date": end_date.isoformat(),
                         "payment_id": payment_id,
@@ -541,7 +551,7 @@ async def telegram_webhook(request: Request):
                     }).eq("user_id", user_id).execute()
                 else:
                     # Создаём новую
-                    supabase.table("user_subscription").insert({
+                    await db.table("user_subscription").insert({
                         "user_id": user_id,
                         "start_date": start_date.isoformat(),
                         "end_date": end_date.isoformat(),
@@ -551,6 +561,8 @@ async def telegram_webhook(request: Request):
                         "updated_at": now.isoformat()
                     }).execute()
                 logger.info(f'[telegram_webhook] Подписка успешно активирована для user_id={user_id}')
+                # Сбрасываем кэш премиум-статуса, чтобы фронтенд сразу увидел подписку
+                invalidate_premium_status(user_id)
             except Exception as e:
                 logger.error(f'[telegram_webhook] Ошибка при активации подписки: {e}', exc_info=True)
             return {"ok": True, "successful_payment": True}
@@ -575,14 +587,14 @@ async def telegram_webhook(request: Request):
             # Проверяем премиум-статус пользователя через REST API вместо прямого подключения к БД
             try:
                 # Проверяем, инициализирован ли Supabase клиент
-                if not supabase:
+                if not db:
                     logger.error("Supabase клиент не инициализирован")
                     await send_telegram_message(user_id, "Ошибка сервера: не удалось подключиться к базе данных. Пожалуйста, сообщите администратору.")
                     return {"ok": True, "error": "Supabase client not initialized"}
                 
                 # Запрашиваем активные подписки для пользователя через REST API
                 try:
-                    subscription_query = supabase.table("user_subscription").select("*").eq("user_id", user_id).eq("is_active", True).execute()
+                    subscription_query = await db.table("user_subscription").select("*").eq("user_id", user_id).eq("is_active", True).execute()
                     logger.info(f"Результат запроса подписки через REST API: {subscription_query}")
                     has_premium = False
                     end_date_str = 'неизвестно'
@@ -627,49 +639,49 @@ async def telegram_webhook(request: Request):
                             "Authorization": f"Bearer {supabase_key}",
                             "Content-Type": "application/json"
                         }
-                        async with httpx.AsyncClient() as client:
-                            response = await client.get(
-                                f"{supabase_url}/rest/v1/user_subscription",
-                                headers=headers,
-                                params={
-                                    "select": "*",
-                                    "user_id": f"eq.{user_id}",
-                                    "is_active": "eq.true"
-                                }
-                            )
-                            if response.status_code == 200:
-                                subscriptions = response.json()
-                                from datetime import datetime, timezone
-                                current_date = datetime.now(timezone.utc)
-                                active_subscriptions = []
-                                for subscription in subscriptions:
-                                    end_date = subscription.get("end_date")
-                                    if end_date:
-                                        try:
-                                            if isinstance(end_date, str):
-                                                end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                                            if end_date > current_date:
-                                                active_subscriptions.append(subscription)
-                                        except Exception as e:
-                                            logger.error(f"Ошибка при обработке даты подписки {end_date}: {e}")
-                                has_premium = bool(active_subscriptions)
-                                end_date_str = 'неизвестно'
-                                if active_subscriptions:
-                                    latest_subscription = max(active_subscriptions, key=lambda x: x.get("end_date"))
-                                    end_date = latest_subscription.get("end_date")
-                                    if isinstance(end_date, str):
-                                        end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                                    end_date_str = end_date.strftime('%d.%m.%Y %H:%M')
-                                logger.info(f"Результат проверки подписки через httpx для {user_id}: has_premium={has_premium}, end_date={end_date_str}")
-                                if has_premium:
-                                    reply_text = f"✅ У вас активирован ПРЕМИУМ доступ!\nДействует до: {end_date_str}\nОбновите страницу приложения, чтобы увидеть изменения."
-                                else:
-                                    reply_text = "❌ У вас нет активной ПРЕМИУМ подписки.\nДля получения премиум-доступа оформите подписку в приложении."
-                                await send_telegram_message(user_id, reply_text)
-                                return {"ok": True, "has_premium": has_premium}
+                        client = get_http_client("supabase_rest")
+                        response = await client.get(
+                            f"{supabase_url}/rest/v1/user_subscription",
+                            headers=headers,
+                            params={
+                                "select": "*",
+                                "user_id": f"eq.{user_id}",
+                                "is_active": "eq.true"
+                            }
+                        )
+                        if response.status_code == 200:
+                            subscriptions = response.json()
+                            from datetime import datetime, timezone
+                            current_date = datetime.now(timezone.utc)
+                            active_subscriptions = []
+                            for subscription in subscriptions:
+                                end_date = subscription.get("end_date")
+                                if end_date:
+                                    try:
+                                        if isinstance(end_date, str):
+                                            end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+                                        if end_date > current_date:
+                                            active_subscriptions.append(subscription)
+                                    except Exception as e:
+                                        logger.error(f"Ошибка при обработке даты подписки {end_date}: {e}")
+                            has_premium = bool(active_subscriptions)
+                            end_date_str = 'неизвестно'
+                            if active_subscriptions:
+                                latest_subscription = max(active_subscriptions, key=lambda x: x.get("end_date"))
+                                end_date = latest_subscription.get("end_date")
+                                if isinstance(end_date, str):
+                                    end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+                                end_date_str = end_date.strftime('%d.%m.%Y %H:%M')
+                            logger.info(f"Результат проверки подписки через httpx для {user_id}: has_premium={has_premium}, end_date={end_date_str}")
+                            if has_premium:
+                                reply_text = f"✅ У вас активирован ПРЕМИУМ доступ!\nДействует до: {end_date_str}\nОбновите страницу приложения, чтобы увидеть изменения."
                             else:
-                                logger.error(f"Ошибка при запросе к Supabase REST API: {response.status_code} - {response.text}")
-                                raise Exception(f"HTTP Error: {response.status_code}")
+                                reply_text = "❌ У вас нет активной ПРЕМИУМ подписки.\nДля получения премиум-доступа оформите подписку в приложении."
+                            await send_telegram_message(user_id, reply_text)
+                            return {"ok": True, "has_premium": has_premium}
+                        else:
+                            logger.error(f"Ошибка при запросе к Supabase REST API: {response.status_code} - {response.text}")
+                            raise Exception(f"HTTP Error: {response.status_code}")
                     except Exception as httpx_error:
                         logger.error(f"Ошибка при проверке премиум-статуса через httpx: {httpx_error}")
                         await send_telegram_message(user_id, "Ошибка подключения к базе данных. Пожалуйста, попробуйте позже.")
@@ -712,22 +724,22 @@ async def send_telegram_message(chat_id, text, parse_mode="HTML"):
         return False
         
     telegram_api_url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(telegram_api_url, json={
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": parse_mode
-            })
-            if response.status_code == 200:
-                logger.info(f"Сообщение успешно отправлено пользователю {chat_id}")
-                return True
-            else:
-                logger.error(f"Ошибка при отправке сообщения: {response.status_code} {response.text}")
-                return False
-        except Exception as e:
-            logger.error(f"Исключение при отправке сообщения в Telegram: {e}")
+    client = get_http_client("telegram_api")
+    try:
+        response = await client.post(telegram_api_url, json={
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode
+        })
+        if response.status_code == 200:
+            logger.info(f"Сообщение успешно отправлено пользователю {chat_id}")
+            return True
+        else:
+            logger.error(f"Ошибка при отправке сообщения: {response.status_code} {response.text}")
             return False
+    except Exception as e:
+        logger.error(f"Исключение при отправке сообщения в Telegram: {e}")
+        return False
 
 # Добавляем прямой эндпоинт для проверки и обновления статуса подписки
 @app.get("/manual-check-premium/{user_id}")
@@ -737,17 +749,9 @@ async def manual_check_premium(user_id: int, request: Request, force_update: boo
     Параметр force_update=true позволяет принудительно обновить кэш для пользователя.
     """
     try:
-        db_url = os.getenv("SUPABASE_URL") or os.getenv("DATABASE_URL") or os.getenv("RENDER_DATABASE_URL")
-        if not db_url:
-            logger.error("Отсутствуют SUPABASE_URL, DATABASE_URL и RENDER_DATABASE_URL при ручной проверке премиума")
-            return {"success": False, "error": "Отсутствуют SUPABASE_URL, DATABASE_URL и RENDER_DATABASE_URL в переменных окружения"}
-            
-        # Нормализуем URL базы данных
-        db_url = normalize_db_url(db_url)
-            
-        # Подключаемся к БД
-        conn = await asyncpg.connect(db_url)
-        try:
+        # Берем соединение из общего пула asyncpg
+        pool = await get_pg_pool()
+        async with pool.acquire() as conn:
             # Проверяем наличие активной подписки
             query = """
             SELECT COUNT(*) 
@@ -784,9 +788,8 @@ async def manual_check_premium(user_id: int, request: Request, force_update: boo
                     }
             
             # Если force_update = true, принудительно обновляем статус во всех кэшах
-            if force_update and has_premium:
-                # Здесь можно добавить логику обновления кэша или других механизмов
-                # В этом примере мы просто логируем событие
+            if force_update:
+                invalidate_premium_status(user_id)
                 logger.info(f"Принудительное обновление премиум-статуса для пользователя {user_id}")
             
             return {
@@ -795,9 +798,6 @@ async def manual_check_premium(user_id: int, request: Request, force_update: boo
                 "has_premium": has_premium,
                 "subscription_details": subscription_details
             }
-            
-        finally:
-            await conn.close()
     except Exception as e:
         logger.error(f"Ошибка при ручной проверке премиум-статуса: {e}")
         return {"success": False, "error": str(e)}
@@ -922,13 +922,14 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
     """Анализ канала Telegram на основе запроса."""
     # Получение telegram_user_id из заголовков
     telegram_user_id = request.headers.get("X-Telegram-User-Id")
+    quota = None
     if telegram_user_id:
         logger.info(f"Анализ для пользователя Telegram ID: {telegram_user_id}")
-        # Проверка лимита анализа каналов
+        # Проверка и списание лимита анализа каналов одним запросом к БД
         from backend.services.supabase_subscription_service import SupabaseSubscriptionService
-        subscription_service = SupabaseSubscriptionService(supabase)
-        can_analyze = await subscription_service.can_analyze_channel(int(telegram_user_id))
-        if not can_analyze:
+        subscription_service = SupabaseSubscriptionService(db)
+        quota = await subscription_service.consume_quota(int(telegram_user_id), "analysis")
+        if not quota.get("allowed"):
             raise HTTPException(status_code=403, detail="Достигнут лимит анализа каналов для бесплатной подписки. Оформите подписку для снятия ограничений.")
     
     # Обработка имени пользователя
@@ -939,39 +940,10 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
     errors_list = []
     error_message = None
     
-    # --- НАЧАЛО: ПОПЫТКА ПОЛУЧЕНИЯ ЧЕРЕЗ HTTP (ПЕРВЫЙ ПРИОРИТЕТ) ---
-    try:
-        logger.info(f"Пытаемся получить посты канала @{username} через HTTP парсинг")
-        http_posts = await get_telegram_posts_via_http(username)
-        
-        if http_posts and len(http_posts) > 0:
-            posts = [{"text": post} for post in http_posts]
-            logger.info(f"Успешно получено {len(posts)} постов через HTTP парсинг")
-        else:
-            logger.warning(f"HTTP парсинг не вернул постов для канала @{username}, пробуем Telethon")
-            errors_list.append("HTTP: Не получены посты, пробуем Telethon")
-    except Exception as http_error:
-        logger.error(f"Ошибка при HTTP парсинге для канала @{username}: {http_error}")
-        errors_list.append(f"HTTP: {str(http_error)}")
-        logger.info("Переключаемся на метод Telethon")
-    
-    # --- НАЧАЛО: ПОПЫТКА ПОЛУЧЕНИЯ ЧЕРЕЗ TELETHON (ВТОРОЙ ПРИОРИТЕТ) ---
-    # Только если HTTP метод не дал результатов
-    if not posts:
-        try:
-            logger.info(f"Пытаемся получить посты канала @{username} через Telethon")
-            telethon_posts, telethon_error = await get_telegram_posts_via_telethon(username)
-            
-            if telethon_error:
-                logger.warning(f"Ошибка Telethon для канала @{username}: {telethon_error}")
-                errors_list.append(f"Telethon: {telethon_error}")
-            else:
-                # Если Telethon успешно получил посты
-                posts = telethon_posts
-                logger.info(f"Успешно получено {len(posts)} постов через Telethon")
-        except Exception as e:
-            logger.error(f"Непредвиденная ошибка при получении постов канала @{username} через Telethon: {e}")
-            errors_list.append(f"Ошибка Telethon: {str(e)}")
+    # --- ПОЛУЧЕНИЕ ПОСТОВ: HTTP и Telethon наперегонки (хеджированный запрос) ---
+    from backend.services.channel_fetch_service import fetch_channel_posts
+    posts, _, fetch_errors = await fetch_channel_posts(username, 20)
+    errors_list.extend(fetch_errors)
     
     # --- НАЧАЛО: ИСПОЛЬЗУЕМ ПРИМЕРЫ КАК ПОСЛЕДНИЙ ВАРИАНТ ---
     # Если не удалось получить посты ни через HTTP, ни через Telethon
@@ -998,37 +970,25 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
         # Подготовка списка текстов для анализа
         texts = [post.get("text", "") for post in posts if post.get("text")]
         
-        # Анализ через deepseek
-        analysis_result = await analyze_content_with_deepseek(texts, OPENROUTER_API_KEY)
+        # Анализ через deepseek (повторный анализ неизменившегося канала берется из кэша)
+        from backend.services.analysis_cache import get_or_compute_analysis
+        analysis_result, _ = await get_or_compute_analysis(
+            username, texts, lambda: analyze_content_with_deepseek(texts, OPENROUTER_API_KEY)
+        )
         
         # Извлекаем результаты из возвращаемого словаря
         themes = analysis_result.get("themes", [])
         styles = analysis_result.get("styles", [])
         
         # Сохранение результата анализа в базе данных (если есть telegram_user_id)
-        if telegram_user_id and supabase:
+        if telegram_user_id and db:
             try:
-                # Перед сохранением результатов анализа вызываем функцию исправления схемы
-                try:
-                    logger.info("Вызов функции fix_schema перед сохранением результатов анализа")
-                    schema_fix_result = await fix_schema()
-                    logger.info(f"Результат исправления схемы: {schema_fix_result}")
-                except Exception as schema_error:
-                    logger.warning(f"Ошибка при исправлении схемы: {schema_error}")
-                
-                # Увеличиваем счетчик анализа для пользователя
-                try:
-                    has_subscription = await subscription_service.has_active_subscription(int(telegram_user_id))
-                    if not has_subscription:
-                        logger.info(f"Увеличиваем счетчик анализа для пользователя {telegram_user_id}")
-                        await subscription_service.increment_analysis_usage(int(telegram_user_id))
-                        logger.info(f"Счетчик анализа успешно увеличен для пользователя {telegram_user_id}")
-                except Exception as counter_error:
-                    logger.error(f"Ошибка при увеличении счетчика анализа: {counter_error}")
-                    # Продолжаем работу, даже если не удалось увеличить счетчик
+                # Схема сверяется один раз за деплой, здесь только проверяем флаг
+                if not await ensure_schema_verified():
+                    logger.warning("Схема БД не сверена, сохраняем результаты анализа без сверки")
                 
                 # Проверяем, существует ли уже запись для этого пользователя и канала
-                analysis_check = supabase.table("channel_analysis").select("id").eq("user_id", telegram_user_id).eq("channel_name", username).execute()
+                analysis_check = await db.table("channel_analysis").select("id").eq("user_id", telegram_user_id).eq("channel_name", username).execute()
                 
                 # Получение текущей даты-времени в ISO формате для updated_at
                 current_datetime = datetime.now().isoformat()
@@ -1051,11 +1011,11 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
                     # Если запись существует, обновляем ее, иначе создаем новую
                     if hasattr(analysis_check, 'data') and len(analysis_check.data) > 0:
                         # Обновляем существующую запись
-                        result = supabase.table("channel_analysis").update(analysis_data).eq("user_id", telegram_user_id).eq("channel_name", username).execute()
+                        result = await db.table("channel_analysis").update(analysis_data).eq("user_id", telegram_user_id).eq("channel_name", username).execute()
                         logger.info(f"Обновлен результат анализа для канала @{username} пользователя {telegram_user_id}")
                     else:
                         # Создаем новую запись
-                        result = supabase.table("channel_analysis").insert(analysis_data).execute()
+                        result = await db.table("channel_analysis").insert(analysis_data).execute()
                         logger.info(f"Сохранен новый результат анализа для канала @{username} пользователя {telegram_user_id}")
                 except Exception as api_error:
                     logger.warning(f"Ошибка при сохранении через API: {api_error}. Пробуем прямой SQL запрос.")
@@ -1113,6 +1073,8 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
         
     except Exception as e:
         logger.error(f"Ошибка при анализе контента: {e}")
+        if quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "analysis")
         # Если произошла ошибка при анализе, возвращаем ошибку 500
         raise HTTPException(status_code=500, detail=f"Ошибка при анализе контента: {str(e)}")
     
@@ -1127,9 +1089,6 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
         analyzed_posts_count=len(posts),
         message=error_message
     )
-    # После успешного анализа (до return AnalyzeResponse)
-    if telegram_user_id:
-        await subscription_service.increment_analysis_usage(int(telegram_user_id))
 
 # --- Маршрут для получения сохраненного анализа канала ---
 @app.get("/channel-analysis", response_model=Dict[str, Any])
@@ -1141,11 +1100,11 @@ async def get_channel_analysis(request: Request, channel_name: str):
         if not telegram_user_id:
             return {"error": "Для получения анализа необходимо авторизоваться через Telegram"}
         
-        if not supabase:
+        if not db:
             return {"error": "База данных недоступна"}
         
         # Запрос данных из базы
-        result = supabase.table("channel_analysis").select("*").eq("user_id", telegram_user_id).eq("channel_name", channel_name).execute()
+        result = await db.table("channel_analysis").select("*").eq("user_id", telegram_user_id).eq("channel_name", channel_name).execute()
         
         # Проверка результата
         if not hasattr(result, 'data') or len(result.data) == 0:
@@ -1168,11 +1127,11 @@ async def get_analyzed_channels(request: Request):
         if not telegram_user_id:
             return []
         
-        if not supabase:
+        if not db:
             return []
         
         # Запрос данных из базы
-        result = supabase.table("channel_analysis").select("channel_name,updated_at").eq("user_id", telegram_user_id).order("updated_at", desc=True).execute()
+        result = await db.table("channel_analysis").select("channel_name,updated_at").eq("user_id", telegram_user_id).order("updated_at", desc=True).execute()
         
         # Проверка результата
         if not hasattr(result, 'data'):
@@ -1213,7 +1172,7 @@ async def get_saved_ideas(request: Request, channel_name: Optional[str] = None):
                 ideas=[]
             )
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             return SuggestedIdeasResponse(
                 message="Ошибка: не удалось подключиться к базе данных",
@@ -1221,14 +1180,14 @@ async def get_saved_ideas(request: Request, channel_name: Optional[str] = None):
             )
         
         # Строим запрос к базе данных
-        query = supabase.table("suggested_ideas").select("*").eq("user_id", telegram_user_id)
+        query = db.table("suggested_ideas").select("*").eq("user_id", telegram_user_id)
         
         # Если указано имя канала, фильтруем по нему
         if channel_name:
             query = query.eq("channel_name", channel_name)
             
         # Выполняем запрос
-        result = query.order("created_at", desc=True).execute()
+        result = await query.order("created_at", desc=True).execute()
         
         # Обрабатываем результат
         if not hasattr(result, 'data'):
@@ -1277,30 +1236,6 @@ class PlanGenerationResponse(BaseModel):
     reset_at: Optional[str] = None
     subscription_required: Optional[bool] = False
 
-# Функция для очистки текста от маркеров форматирования
-def clean_text_formatting(text):
-    """Очищает текст от форматирования маркдауна и прочего."""
-    if not text:
-        return ""
-    
-    # Удаляем заголовки типа "### **День 1**", "### **1 день**", "### **ДЕНЬ 1**" и другие вариации
-    text = re.sub(r'#{1,6}\s*\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?', '', text)
-    
-    # Удаляем числа и слово "день" в начале строки (без символов #)
-    text = re.sub(r'^(?:\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?)', '', text)
-    
-    # Удаляем символы маркдауна
-    text = re.sub(r'\*\*|\*|__|_|#{1,6}', '', text)
-    
-    # Очищаем начальные и конечные пробелы
-    text = text.strip()
-    
-    # Делаем первую букву заглавной, если строка не пустая
-    if text and len(text) > 0:
-        text = text[0].upper() + text[1:] if len(text) > 1 else text.upper()
-    
-    return text
-
 def parse_plan_response(plan_text, styles, period_days):
     import re
     plan_items = []
@@ -1423,50 +1358,28 @@ async def generate_content_plan(request: Request, req: PlanGenerationRequest):
         user_prompt = f"""Сгенерируй план контента для Telegram-канала \"{channel_name}\" на {period_days} дней.\nТемы: {', '.join(themes)}\nСтили (используй ТОЛЬКО их): {', '.join(styles)}\n\nВыдай ровно {period_days} строк СТРОГО в формате:\nДень <номер_дня>:: <Идея поста>:: <Стиль из списка>\n\nНе включай ничего, кроме этих строк.\nСТРОГО ЗАПРЕЩЕНО использовать любые квадратные скобки [], фигурные скобки {{}} , плейсхолдеры, шаблоны, слова 'ссылка', 'памятка', 'контакт', 'email', 'телефон', 'номер', 'название', 'детали', 'уточнить', 'см. ниже', 'см. выше', 'подробнее', 'заполнить', 'указать', 'добавить', 'оставить', 'вставить', 'пример', 'шаблон', 'placeholder', 'link', 'reference', 'details', 'to be filled', 'to be added', 'to be specified', 'see below', 'see above', 'fill in', 'insert', 'add', 'TBD', 'TBA', 'N/A', '---', '***', '???', '!!!', '[]', '{{}}', '()' и любые подобные конструкции.\nВыдай только полностью готовый, финальный, осмысленный текст для каждой идеи без мест для ручного заполнения, без ссылок, без памяток, без контактов, без email, без телефона, без любых заготовок. Только чистый, законченный текст для публикации."""
         # --- ИЗМЕНЕНИЕ КОНЕЦ ---
 
-        # Настройка клиента OpenAI для использования OpenRouter
-        client = AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY
-        )
-        
-        # Запрос к API
+        # Запрос через LLM-шлюз (ретраи, circuit breaker, резервный провайдер)
         logger.info(f"Отправка запроса на генерацию плана контента для канала @{channel_name} с уточненным промптом")
-        response = await client.chat.completions.create(
-            model="google/gemini-2.5-flash-preview", # <--- ИЗМЕНЕНО НА НОВУЮ БЕСПЛАТНУЮ МОДЕЛЬ
-            messages=[
-                # {"role": "system", "content": system_prompt}, # Системный промпт может конфликтовать с некоторыми моделями, тестируем без него или с ним
-                {"role": "user", "content": user_prompt} # Помещаем все инструкции в user_prompt
-            ],
-            temperature=0.7, # Немного снижаем температуру для строгости формата
-            max_tokens=150 * period_days, # Примерно 150 токенов на идею
-            timeout=120,
-            extra_headers={
-                "HTTP-Referer": "https://content-manager.onrender.com",
-                "X-Title": "Smart Content Assistant"
-            }
-        )
-        
-        # === НАЧАЛО ИЗМЕНЕНИЯ: Проверка ответа API ===
         plan_text = ""
-        if response and response.choices and len(response.choices) > 0 and response.choices[0].message and response.choices[0].message.content:
-            plan_text = response.choices[0].message.content.strip()
+        try:
+            completion = await llm_complete(
+                [
+                    # Системный промпт может конфликтовать с некоторыми моделями, все инструкции в user_prompt
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.7, # Немного снижаем температуру для строгости формата
+                max_tokens=150 * period_days, # Примерно 150 токенов на идею
+                deadline=120,
+            )
+            plan_text = completion.text
             logger.info(f"Получен ответ с планом публикаций (первые 100 символов): {plan_text[:100]}...")
-        else:
-            # Логируем полный ответ, если структура неожиданная
-            logger.error(f"Некорректный или пустой ответ от OpenRouter API при генерации плана. Status: {response.response.status_code if hasattr(response, 'response') else 'N/A'}")
-            try:
-                # Попробуем залогировать тело ответа, если оно есть
-                raw_response_content = await response.response.text() if hasattr(response, 'response') and hasattr(response.response, 'text') else str(response)
-                logger.error(f"Полный ответ API (или его представление): {raw_response_content}")
-            except Exception as log_err:
-                logger.error(f"Не удалось залогировать тело ответа API: {log_err}")
-                
+        except LLMGatewayError as api_error:
+            logger.error(f"Некорректный или пустой ответ LLM при генерации плана: {api_error}")
             # Возвращаем пустой план с сообщением об ошибке
             return PlanGenerationResponse(
                 plan=[],
                 message="Ошибка: API не вернул ожидаемый результат для генерации плана."
             )
-        # === КОНЕЦ ИЗМЕНЕНИЯ ===
         
         plan_items = parse_plan_response(plan_text, styles, period_days)
         # Если не удалось — fallback
@@ -1531,19 +1444,19 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
             logger.warning("Запрос постов без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для доступа к постам необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Строим запрос к базе данных
-        query = supabase.table("saved_posts").select("*").eq("user_id", telegram_user_id)
+        query = db.table("saved_posts").select("*").eq("user_id", telegram_user_id)
         
         # Если указано имя канала, фильтруем по нему
         if channel_name:
             query = query.eq("channel_name", channel_name)
             
         # Выполняем запрос
-        result = query.order("target_date", desc=True).execute()
+        result = await query.order("target_date", desc=True).execute()
         
         # Проверка результата
         if not hasattr(result, 'data'):
@@ -1553,7 +1466,7 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
         # === ИЗМЕНЕНИЕ: Запрос для получения связанных изображений ===
         # Строим запрос к базе данных, запрашивая связанные данные из saved_images
         # Обратите внимание: имя таблицы saved_images используется как имя связи
-        query = supabase.table("saved_posts").select(
+        query = db.table("saved_posts").select(
             "*, saved_images(*)" # <--- Запрашиваем все поля поста и все поля связанного изображения
         ).eq("user_id", int(telegram_user_id))
         # === КОНЕЦ ИЗМЕНЕНИЯ ===
@@ -1563,7 +1476,7 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
             query = query.eq("channel_name", channel_name)
             
         # Выполняем запрос
-        result = query.order("target_date", desc=True).execute()
+        result = await query.order("target_date", desc=True).execute()
         
         # Проверка результата
         if not hasattr(result, 'data'):
@@ -1629,24 +1542,9 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
 async def create_post(request: Request, post_data: PostData):
     """Создание нового поста."""
     try:
-        # === ДОБАВЛЕНО: Принудительное обновление схемы перед операцией ===
-        try:
-            logger.info("Вызов fix_schema перед созданием поста...")
-            fix_result = await fix_schema()
-            if not fix_result.get("success"):
-                logger.warning(f"Не удалось обновить/проверить схему перед созданием поста: {fix_result}")
-                # Можно решить, прерывать ли операцию или нет. Пока продолжаем.
-            else:
-                logger.info("Проверка/обновление схемы перед созданием поста завершена успешно.")
-        except Exception as pre_save_fix_err:
-            logger.error(f"Ошибка при вызове fix_schema перед созданием поста: {pre_save_fix_err}", exc_info=True)
-            # Продолжаем, но логируем ошибку
-        # === КОНЕЦ ДОБАВЛЕНИЯ ===
-
-        # === ДОБАВЛЕНО: Пауза после обновления схемы ===
-        logger.info("Небольшая пауза после fix_schema, чтобы дать PostgREST время...")
-        await asyncio.sleep(0.7) # Пауза 0.7 секунды
-        # === КОНЕЦ ДОБАВЛЕНИЯ ===
+        # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+        if not await ensure_schema_verified():
+            logger.warning("Схема БД не сверена, продолжаем без сверки")
 
         # Получение telegram_user_id из заголовков
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
@@ -1654,7 +1552,7 @@ async def create_post(request: Request, post_data: PostData):
             logger.warning("Запрос создания поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для создания поста необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
@@ -1714,7 +1612,7 @@ async def create_post(request: Request, post_data: PostData):
                     # Проверяем, существует ли изображение с таким URL (более надежно)
                     image_check = None
                     if selected_image.url:
-                        image_check_result = supabase.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
+                        image_check_result = await db.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
                         if hasattr(image_check_result, 'data') and len(image_check_result.data) > 0:
                             image_check = image_check_result.data[0]
                     # --- КОНЕЦ ПРОВЕРКИ ПО URL ---
@@ -1741,7 +1639,7 @@ async def create_post(request: Request, post_data: PostData):
                             # --- УДАЛЕНО: external_id ---
                         }
                         
-                        image_result = supabase.table("saved_images").insert(image_data_to_save).execute()
+                        image_result = await db.table("saved_images").insert(image_data_to_save).execute()
                         if hasattr(image_result, 'data') and len(image_result.data) > 0:
                             saved_image_id = new_internal_id # Используем наш ID для связи
                             logger.info(f"Сохранено новое изображение {saved_image_id} для поста")
@@ -1770,7 +1668,7 @@ async def create_post(request: Request, post_data: PostData):
         try:
             logger.info(f"Выполняем insert в saved_posts для ID {post_to_save['id']}...")
             # === ИСПРАВЛЕНО: Выровнен отступ ===
-            result = supabase.table("saved_posts").insert(post_to_save).execute()
+            result = await db.table("saved_posts").insert(post_to_save).execute()
             logger.info(f"Insert выполнен. Status: {result.status_code if hasattr(result, 'status_code') else 'N/A'}")
         except APIError as e:
             logger.error(f"Ошибка APIError при insert в saved_posts: {e}")
@@ -1799,7 +1697,7 @@ async def create_post(request: Request, post_data: PostData):
              response_data.selected_image_data = selected_image # Возвращаем исходные данные изображения
         elif saved_image_id: # Если изображение было найдено, но не передано (маловероятно, но на всякий случай)
              # Пытаемся получить данные изображения из БД
-             img_data_res = supabase.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", saved_image_id).maybe_single().execute()
+             img_data_res = await db.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", saved_image_id).maybe_single().execute()
              if img_data_res.data:
                   response_data.selected_image_data = PostImage(**img_data_res.data)
 
@@ -1816,22 +1714,9 @@ async def create_post(request: Request, post_data: PostData):
 async def update_post(post_id: str, request: Request, post_data: PostData):
     """Обновление существующего поста."""
     try:
-        # === ДОБАВЛЕНО: Принудительное обновление схемы перед операцией ===
-        try:
-            logger.info(f"Вызов fix_schema перед обновлением поста {post_id}...")
-            fix_result = await fix_schema()
-            if not fix_result.get("success"):
-                logger.warning(f"Не удалось обновить/проверить схему перед обновлением поста {post_id}: {fix_result}")
-            else:
-                logger.info(f"Проверка/обновление схемы перед обновлением поста {post_id} завершена успешно.")
-        except Exception as pre_update_fix_err:
-            logger.error(f"Ошибка при вызове fix_schema перед обновлением поста {post_id}: {pre_update_fix_err}", exc_info=True)
-        # === КОНЕЦ ДОБАВЛЕНИЯ ===
-
-        # === ДОБАВЛЕНО: Пауза после обновления схемы ===
-        logger.info(f"Небольшая пауза после fix_schema для поста {post_id}, чтобы дать PostgREST время...")
-        await asyncio.sleep(0.7) # Пауза 0.7 секунды
-        # === КОНЕЦ ДОБАВЛЕНИЯ ===
+        # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+        if not await ensure_schema_verified():
+            logger.warning("Схема БД не сверена, продолжаем без сверки")
 
         # Получение telegram_user_id из заголовков
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
@@ -1839,12 +1724,12 @@ async def update_post(post_id: str, request: Request, post_data: PostData):
             logger.warning("Запрос обновления поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для обновления поста необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Проверяем, что пост принадлежит пользователю
-        post_check = supabase.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+        post_check = await db.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
         if not hasattr(post_check, 'data') or len(post_check.data) == 0:
             logger.warning(f"Попытка обновить чужой или несуществующий пост: {post_id}")
             raise HTTPException(status_code=404, detail="Пост не найден или нет прав на его редактирование")
@@ -1892,7 +1777,7 @@ async def update_post(post_id: str, request: Request, post_data: PostData):
                         # Проверяем, существует ли изображение с таким URL
                         image_check = None
                         if selected_image.url:
-                            image_check_result = supabase.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
+                            image_check_result = await db.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
                             if hasattr(image_check_result, 'data') and len(image_check_result.data) > 0:
                                 image_check = image_check_result.data[0]
 
@@ -1912,7 +1797,7 @@ async def update_post(post_id: str, request: Request, post_data: PostData):
                                 "source": selected_image.source or "frontend_selection",
                                 "user_id": int(telegram_user_id),
                             }
-                            image_result = supabase.table("saved_images").insert(image_data_to_save).execute()
+                            image_result = await db.table("saved_images").insert(image_data_to_save).execute()
                             if hasattr(image_result, 'data') and len(image_result.data) > 0:
                                 image_id_to_set_in_post = new_internal_id
                                 logger.info(f"Сохранено новое изображение {image_id_to_set_in_post} для обновления поста {post_id}")
@@ -1963,7 +1848,7 @@ async def update_post(post_id: str, request: Request, post_data: PostData):
         # Выполнение UPDATE запроса
         try:
             logger.info(f"Выполняем update в saved_posts для ID {post_id}...")
-            result = supabase.table("saved_posts").update(post_to_update).eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+            result = await db.table("saved_posts").update(post_to_update).eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
             logger.info(f"Update выполнен. Status: {result.status_code if hasattr(result, 'status_code') else 'N/A'}")
         except APIError as e:
             logger.error(f"Ошибка APIError при update в saved_posts для ID {post_id}: {e}")
@@ -1989,7 +1874,7 @@ async def update_post(post_id: str, request: Request, post_data: PostData):
 
         if final_image_id:
             # Если ID есть, пытаемся получить данные изображения из БД
-            img_data_res = supabase.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", final_image_id).maybe_single().execute()
+            img_data_res = await db.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", final_image_id).maybe_single().execute()
             if img_data_res.data:
                  try: # Добавляем try-except для маппинга
                      alt_text = img_data_res.data.get("alt_description") or img_data_res.data.get("alt")
@@ -2030,19 +1915,19 @@ async def delete_post(post_id: str, request: Request):
             logger.warning("Запрос удаления поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для удаления поста необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Проверяем, что пост принадлежит пользователю
-        post_check = supabase.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+        post_check = await db.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
         if not hasattr(post_check, 'data') or len(post_check.data) == 0:
             logger.warning(f"Попытка удалить чужой или несуществующий пост: {post_id}")
             raise HTTPException(status_code=404, detail="Пост не найден или нет прав на его удаление")
         
         # --- ДОБАВЛЕНО: Удаление связей перед удалением поста --- 
         try:
-            delete_links_res = supabase.table("post_images").delete().eq("post_id", post_id).execute()
+            delete_links_res = await db.table("post_images").delete().eq("post_id", post_id).execute()
             logger.info(f"Удалено {len(delete_links_res.data) if hasattr(delete_links_res, 'data') else 0} связей для удаляемого поста {post_id}")
         except Exception as del_link_err:
             logger.error(f"Ошибка при удалении связей post_images для поста {post_id} перед удалением поста: {del_link_err}")
@@ -2050,7 +1935,7 @@ async def delete_post(post_id: str, request: Request):
         # --- КОНЕЦ ДОБАВЛЕНИЯ ---
         
         # Удаление из Supabase
-        result = supabase.table("saved_posts").delete().eq("id", post_id).execute()
+        result = await db.table("saved_posts").delete().eq("id", post_id).execute()
         
         # Проверка результата
         if not hasattr(result, 'data'):
@@ -2094,84 +1979,9 @@ async def delete_post(post_id: str, request: Request):
 
 # --- Функция для генерации ключевых слов для поиска изображений ---
 async def generate_image_keywords(text: str, topic: str, format_style: str) -> List[str]:
-    """Генерация ключевых слов для поиска изображений с помощью ИИ."""
-    try:
-        # Если нет API-ключа, вернем список с тематикой поста
-        if not OPENROUTER_API_KEY:
-            words = re.findall(r'\b[а-яА-Яa-zA-Z]{4,}\b', text.lower())
-            stop_words = ["и", "в", "на", "с", "по", "для", "а", "но", "что", "как", "так", "это"]
-            filtered_words = [w for w in words if w not in stop_words]
-            
-            # Если есть тема и формат, добавляем их
-            result = []
-            if topic:
-                result.append(topic)
-            if format_style:
-                result.append(format_style)
-                
-            # Добавляем несколько наиболее часто встречающихся слов
-            word_counts = Counter(filtered_words)
-            common_words = [word for word, _ in word_counts.most_common(3)]
-            result.extend(common_words)
-            
-            # Добавляем контекстные слова для разнообразия результатов
-            context_words = ["business", "abstract", "professional", "technology", "creative", "modern"]
-            result.extend(random.sample(context_words, 2))
-            
-            return result
-        
-        # Инициализируем клиент OpenAI через OpenRouter
-        client = AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY
-        )
-        
-        # Создаем промпт для генерации ключевых слов
-        system_prompt = """Твоя задача - сгенерировать 2-3 эффективных ключевых слова для поиска изображений.
-        Ключевые слова должны точно отражать тематику текста и быть универсальными для поиска стоковых изображений.
-        Выбирай короткие конкретные существительные на английском языке, даже если текст на русском.
-        Формат ответа: список ключевых слов через запятую."""
-        
-        user_prompt = f"""Текст поста: {text[:300]}...
-
-Тематика поста: {topic}
-Формат поста: {format_style}
-
-Выдай 2-3 лучших ключевых слова на английском языке для поиска подходящих изображений. Только ключевые слова, без объяснений."""
-        
-        # Запрос к API
-        response = await client.chat.completions.create(
-            model="google/gemini-2.5-flash-preview", # <--- ИЗМЕНЕНО НА НОВУЮ БЕСПЛАТНУЮ МОДЕЛЬ
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=100,
-            timeout=15,
-            extra_headers={
-                "HTTP-Referer": "https://content-manager.onrender.com",
-                "X-Title": "Smart Content Assistant"
-            }
-        )
-        
-        # Получаем и обрабатываем ответ
-        keywords_text = response.choices[0].message.content.strip()
-        keywords_list = re.split(r'[,;\n]', keywords_text)
-        keywords = [k.strip() for k in keywords_list if k.strip()]
-        
-        # Если не удалось получить ключевые слова, используем запасной вариант
-        if not keywords:
-            logger.warning("Не удалось получить ключевые слова от API, используем запасной вариант")
-            return [topic, format_style] + random.sample(["business", "abstract", "professional"], 2)
-        
-        logger.info(f"Сгенерированы ключевые слова для поиска изображений: {keywords}")
-        return keywords
-        
-    except Exception as e:
-        logger.error(f"Ошибка при генерации ключевых слов для поиска изображений: {e}")
-        # В случае ошибки возвращаем базовые ключевые слова
-        return [topic, format_style, "concept", "idea"]
+    """Ключевые слова для поиска изображений: кэш, LLM или локальный извлекатель (см. keyword_service)."""
+    from backend.services.keyword_service import get_image_keywords
+    return await get_image_keywords(text, topic, format_style)
 
 # --- Функция для поиска изображений в Unsplash ---
 async def search_unsplash_images(query: str, count: int = 5, topic: str = "", format_style: str = "", post_text: str = "") -> List[FoundImage]:
@@ -2225,33 +2035,33 @@ async def search_unsplash_images(query: str, count: int = 5, topic: str = "", fo
         }
         
         all_photos = []
-        async with httpx.AsyncClient(timeout=15.0) as client: # Увеличим таймаут
-            for keyword in keywords[:3]:
-                try:
-                    logger.info(f"Поиск изображений в Unsplash по запросу: {keyword}")
-                    response = await client.get(
-                        unsplash_api_url,
-                        headers=headers,
-                        params={"query": keyword, "per_page": per_page}
-                    )
-                    
-                    if response.status_code != 200:
-                        logger.error(f"Ошибка при запросе к Unsplash API: {response.status_code} {response.text}")
-                        continue
-                    
-                    results = response.json()
-                    if 'results' in results and results['results']:
-                        all_photos.extend(results['results'])
-                    else:
-                        logger.warning(f"Нет результатов по запросу '{keyword}'")
-                         
-                except httpx.ReadTimeout:
-                    logger.warning(f"Таймаут при поиске изображений по ключевому слову '{keyword}'")
-                    continue
-                except Exception as e:
-                    logger.error(f"Ошибка при выполнении запроса к Unsplash по ключевому слову '{keyword}': {e}")
+        client = get_http_client("unsplash")
+        for keyword in keywords[:3]:
+            try:
+                logger.info(f"Поиск изображений в Unsplash по запросу: {keyword}")
+                response = await client.get(
+                    unsplash_api_url,
+                    headers=headers,
+                    params={"query": keyword, "per_page": per_page}
+                )
+                
+                if response.status_code != 200:
+                    logger.error(f"Ошибка при запросе к Unsplash API: {response.status_code} {response.text}")
                     continue
-        
+                
+                results = response.json()
+                if 'results' in results and results['results']:
+                    all_photos.extend(results['results'])
+                else:
+                    logger.warning(f"Нет результатов по запросу '{keyword}'")
+                     
+            except httpx.ReadTimeout:
+                logger.warning(f"Таймаут при поиске изображений по ключевому слову '{keyword}'")
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении запроса к Unsplash по ключевому слову '{keyword}': {e}")
+                continue
+
         if not all_photos:
             logger.warning(f"Не найдено изображений по всем ключевым словам")
             return []
@@ -2286,17 +2096,17 @@ async def generate_post_details(request: Request, req: GeneratePostDetailsReques
     found_images = [] 
     channel_name = req.channel_name if hasattr(req, 'channel_name') else ""
     api_error_message = None # Добавляем переменную для хранения ошибки API
+    quota = None
     try:
         # Получение telegram_user_id из заголовков
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if telegram_user_id:
-            # Проверка лимита генерации идей
+            # Проверка и списание лимита генерации постов одним запросом к БД
             from backend.services.supabase_subscription_service import SupabaseSubscriptionService
-            subscription_service = SupabaseSubscriptionService(supabase)
-            can_generate = await subscription_service.can_generate_post(int(telegram_user_id))
-            if not can_generate:
-                usage = await subscription_service.get_user_usage(int(telegram_user_id))
-                reset_at = usage.get("reset_at")
+            subscription_service = SupabaseSubscriptionService(db)
+            quota = await subscription_service.consume_quota(int(telegram_user_id), "post")
+            if not quota.get("allowed"):
+                reset_at = quota.get("reset_at")
                 raise HTTPException(status_code=403, detail=f"Достигнут лимит в 2 генерации постов для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.")
         if not telegram_user_id:
             logger.warning("Запрос генерации поста без идентификации пользователя Telegram")
@@ -2365,106 +2175,35 @@ async def generate_post_details(request: Request, req: GeneratePostDetailsReques
 {sample_text}
 """
 
-        # Настройка клиента OpenAI для использования OpenRouter
-        client = AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY
-        )
-        
         # === ИЗМЕНЕНО: Добавлена обработка ошибок API ===
         post_text = ""
         try:
-            # Запрос к API
+            # Запрос через LLM-шлюз (ретраи, circuit breaker, резервный провайдер)
             logger.info(f"Отправка запроса на генерацию поста по идее: {topic_idea}")
-            response = await client.chat.completions.create(
-                model="google/gemini-2.5-flash-preview", # <--- ИЗМЕНЕНО НА НОВУЮ БЕСПЛАТНУЮ МОДЕЛЬ
-                messages=[
+            completion = await llm_complete(
+                [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.7,
                 max_tokens=850, # === ИЗМЕНЕНО: Уменьшен лимит токенов с 1000 до 850 ===
-                timeout=60,
-                extra_headers={
-                    "HTTP-Referer": "https://content-manager.onrender.com",
-                    "X-Title": "Smart Content Assistant"
-                }
+                deadline=60,
             )
-            
-            # Проверка ответа и извлечение текста
-            if response and response.choices and len(response.choices) > 0 and response.choices[0].message and response.choices[0].message.content:
-                post_text = response.choices[0].message.content.strip()
-                logger.info(f"Получен текст поста ({len(post_text)} символов)")
-            # === ДОБАВЛЕНО: Явная проверка на ошибку в ответе ===
-            elif response and hasattr(response, 'error') and response.error:
-                err_details = response.error
-                # Пытаемся получить сообщение об ошибке
-                api_error_message = getattr(err_details, 'message', str(err_details)) 
-                logger.error(f"OpenRouter API вернул ошибку: {api_error_message}")
-                post_text = "[Текст не сгенерирован из-за ошибки API]"
-            # === КОНЕЦ ДОБАВЛЕНИЯ ===
-            else:
-                # Общий случай некорректного ответа
-                api_error_message = "API вернул некорректный или пустой ответ"
-                logger.error(f"Некорректный или пустой ответ от OpenRouter API. Ответ: {response}")
-                post_text = "[Текст не сгенерирован из-за ошибки API]"
-                
-        except Exception as api_error:
-            # Ловим ошибки HTTP запроса или другие исключения
+            post_text = completion.text
+            logger.info(f"Получен текст поста через {completion.provider} ({len(post_text)} символов)")
+        except LLMGatewayError as api_error:
             api_error_message = f"Ошибка соединения с API: {str(api_error)}"
-            logger.error(f"Ошибка при запросе к OpenRouter API: {api_error}", exc_info=True)
+            logger.error(f"Ошибка при запросе к LLM: {api_error}")
             post_text = "[Текст не сгенерирован из-за ошибки API]"
         # === КОНЕЦ ИЗМЕНЕНИЯ ===
 
-        # Генерируем ключевые слова для поиска изображений на основе темы и текста
-        image_keywords = await generate_image_keywords(post_text, topic_idea, format_style)
-        logger.info(f"Сгенерированы ключевые слова для поиска изображений: {image_keywords}")
-        
-        # Поиск изображений по ключевым словам
-        # found_images инициализирован в начале
-        for keyword in image_keywords[:3]:  # Ограничиваем до 3 ключевых слов для поиска
-            try:
-                # Получаем не более 5 изображений
-                image_count = min(5 - len(found_images), 3)
-                if image_count <= 0:
-                    break
-                    
-                images = await search_unsplash_images(
-                    keyword, 
-                    count=image_count,
-                    topic=topic_idea,
-                    format_style=format_style,
-                    post_text=post_text
-                )
-                
-                # Добавляем только уникальные изображения
-                existing_ids = {img.id for img in found_images}
-                unique_images = [img for img in images if img.id not in existing_ids]
-                found_images.extend(unique_images)
-                
-                # Ограничиваем до 5 изображений всего
-                if len(found_images) >= 5:
-                    found_images = found_images[:5]
-                    break
-                    
-                logger.info(f"Найдено {len(unique_images)} уникальных изображений по ключевому слову '{keyword}'")
-            except Exception as e:
-                logger.error(f"Ошибка при поиске изображений для ключевого слова '{keyword}': {e}")
-                continue
-        
-        # Если изображения не найдены, повторяем поиск с общей идеей
-        if not found_images:
-            try:
-                found_images = await search_unsplash_images(
-                    topic_idea, 
-                    count=5,
-                    topic=topic_idea,
-                    format_style=format_style
-                )
-                logger.info(f"Найдено {len(found_images)} изображений по основной теме")
-            except Exception as e:
-                logger.error(f"Ошибка при поиске изображений по основной теме: {e}")
-                found_images = []
+        # Поиск изображений: ключевые слова генерируются один раз, запросы к Unsplash идут параллельно
+        from backend.services.image_search_service import search_post_images
+        try:
+            found_images = await search_post_images(post_text, topic_idea, format_style, limit=IMAGE_RESULTS_COUNT)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске изображений для поста: {e}")
+            found_images = []
         
         # Просто возвращаем найденные изображения без сохранения
         logger.info(f"Подготовлено {len(found_images)} предложенных изображений")
@@ -2489,17 +2228,18 @@ async def generate_post_details(request: Request, req: GeneratePostDetailsReques
                 author_url=found_images[0].author_url if found_images else ""
             ) if found_images else None
         )
-        # После успешной генерации (до return PostDetailsResponse)
-        if telegram_user_id:
-            await subscription_service.increment_post_usage(int(telegram_user_id))
         # === КОНЕЦ ИЗМЕНЕНИЯ ===
                 
     except HTTPException as http_err:
         # Перехватываем HTTPException, чтобы они не попадали в общий Exception
+        if http_err.status_code >= 500 and quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "post")
         raise http_err
     except Exception as e:
         logger.error(f"Ошибка при генерации деталей поста: {e}")
         traceback.print_exc() # Печатаем traceback для диагностики
+        if quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "post")
         # === ИЗМЕНЕНО: Используем HTTPException для ответа ===
         raise HTTPException(
             status_code=500,
@@ -2510,30 +2250,30 @@ async def generate_post_details(request: Request, req: GeneratePostDetailsReques
 # --- Функция для исправления форматирования в существующих идеях ---
 async def fix_existing_ideas_formatting():
     """Исправляет форматирование в существующих идеях."""
-    if not supabase:
+    if not db:
         logger.error("Невозможно исправить форматирование: клиент Supabase не инициализирован")
         return
     
     try:
         # Получение всех идей
-        result = supabase.table("suggested_ideas").select("id,topic_idea,format_style").execute()
+        result = await db.table("suggested_ideas").select("id,topic_idea,format_style").execute()
         
         if not hasattr(result, 'data') or len(result.data) == 0:
             logger.info("Нет идей для исправления форматирования")
             return
         
+        # Очищаем форматирование всей таблицы пакетами (большие — в пуле потоков, вне event loop)
+        cleaned_topics = await clean_text_formatting_batch_async([idea.get("topic_idea", "") for idea in result.data])
+        cleaned_formats = await clean_text_formatting_batch_async([idea.get("format_style", "") for idea in result.data])
+        
         fixed_count = 0
-        for idea in result.data:
+        for idea, cleaned_topic, cleaned_format in zip(result.data, cleaned_topics, cleaned_formats):
             original_topic = idea.get("topic_idea", "")
             original_format = idea.get("format_style", "")
             
-            # Очищаем форматирование
-            cleaned_topic = clean_text_formatting(original_topic)
-            cleaned_format = clean_text_formatting(original_format)
-            
             # Если текст изменился, обновляем запись
             if cleaned_topic != original_topic or cleaned_format != original_format:
-                supabase.table("suggested_ideas").update({
+                await db.table("suggested_ideas").update({
                     "topic_idea": cleaned_topic,
                     "format_style": cleaned_format
                 }).eq("id", idea["id"]).execute()
@@ -2549,6 +2289,36 @@ async def startup_event():
     """Запуск обслуживающих процессов при старте приложения."""
     logger.info("Запуск обслуживающих процессов...")
     
+    # Создаем общие долгоживущие HTTP-клиенты для всех апстримов
+    await init_http_clients()
+    
+    # Асинхронный клиент Supabase для обработчиков (синхронный остается только для служебных скриптов)
+    try:
+        await db.init()
+    except Exception as db_init_error:
+        logger.error(f"Ошибка при инициализации асинхронного клиента Supabase: {db_init_error}", exc_info=True)
+    
+    # Общий пул asyncpg для прямых запросов (премиум-статус и т.п.)
+    pg_url = os.getenv("SUPABASE_URL") or os.getenv("DATABASE_URL") or os.getenv("RENDER_DATABASE_URL")
+    if pg_url:
+        try:
+            await init_pg_pool(normalize_db_url(pg_url))
+        except Exception as pool_error:
+            logger.error(f"Ошибка при создании пула asyncpg: {pool_error}", exc_info=True)
+    
+    # Пул воркеров фоновых задач генерации (/jobs/...)
+    await job_queue.start()
+    
+    # Шаблоны промптов разобраны при импорте; их версии сопоставляются со статистикой вызовов LLM в логах
+    logger.info(f"Шаблоны промптов: {registered_templates()}")
+    
+    # Долгоживущий клиент Telethon: подключение и авторизация один раз на процесс
+    if telethon_gateway.configured:
+        try:
+            await telethon_gateway.start()
+        except Exception as telethon_error:
+            logger.warning(f"Клиент Telethon не подключен при старте, подключение будет выполнено при первом запросе: {telethon_error}")
+    
     # Проверяем и логируем наличие переменных окружения (замаскированные для безопасности)
     supabase_url = os.getenv("SUPABASE_URL")
     database_url = os.getenv("DATABASE_URL")
@@ -2594,49 +2364,57 @@ async def startup_event():
     
     logger.info("Обслуживающие процессы запущены успешно")
 
-    # --- ДОБАВЛЕНО: Вызов fix_schema при старте --- 
+    # --- Сверка схемы БД: один раз за деплой, по отпечатку в таблице schema_state ---
     try:
-        fix_result = await fix_schema()
-        logger.info(f"Результат проверки/исправления схемы при старте: {fix_result}")
-        if not fix_result.get("success"):
-            logger.error("Ошибка при проверке/исправлении схемы БД при запуске!")
-            # Решите, следует ли прерывать запуск или нет.
-            # Пока продолжаем работу.
+        schema_result = await ensure_schema()
+        logger.info(f"Результат сверки схемы при старте: {schema_result.get('message')}")
+        if not schema_result.get("success"):
+            logger.error("Ошибка при сверке схемы БД при запуске!")
     except Exception as schema_fix_error:
-        logger.error(f"Исключение при вызове fix_schema во время старта: {schema_fix_error}", exc_info=True)
-    # --- КОНЕЦ ДОБАВЛЕНИЯ ---
+        logger.error(f"Исключение при сверке схемы во время старта: {schema_fix_error}", exc_info=True)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Освобождение ресурсов при остановке приложения."""
+    # Очередь задач — первой: прерванные и ожидающие задачи сохраняются в БД, пока соединения открыты
+    await job_queue.stop()
+    await close_http_clients()
+    await db.close()
+    await close_pg_pool()
+    await telethon_gateway.stop()
+    logger.info("Очередь задач, HTTP-клиенты, пулы соединений и клиент Telethon закрыты")
 
 # --- Функция для исправления форматирования в существующих постах ---
 async def fix_existing_posts_formatting():
     """Исправляет форматирование в существующих постах."""
-    if not supabase:
+    if not db:
         logger.error("Невозможно исправить форматирование постов: клиент Supabase не инициализирован")
         return
     
     try:
         # Получение всех постов
-        result = supabase.table("saved_posts").select("id,topic_idea,format_style,final_text").execute()
+        result = await db.table("saved_posts").select("id,topic_idea,format_style,final_text").execute()
         
         if not hasattr(result, 'data') or len(result.data) == 0:
             logger.info("Нет постов для исправления форматирования")
             return
         
+        # Очищаем форматирование всей таблицы пакетами (большие — в пуле потоков, вне event loop)
+        cleaned_topics = await clean_text_formatting_batch_async([post.get("topic_idea", "") for post in result.data])
+        cleaned_formats = await clean_text_formatting_batch_async([post.get("format_style", "") for post in result.data])
+        cleaned_texts = await clean_text_formatting_batch_async([post.get("final_text", "") for post in result.data])
+        
         fixed_count = 0
-        for post in result.data:
+        for post, cleaned_topic, cleaned_format, cleaned_text in zip(result.data, cleaned_topics, cleaned_formats, cleaned_texts):
             original_topic = post.get("topic_idea", "")
             original_format = post.get("format_style", "")
             original_text = post.get("final_text", "")
             
-            # Очищаем форматирование
-            cleaned_topic = clean_text_formatting(original_topic)
-            cleaned_format = clean_text_formatting(original_format)
-            cleaned_text = clean_text_formatting(original_text)
-            
             # Если текст изменился, обновляем запись
             if (cleaned_topic != original_topic or 
                 cleaned_format != original_format or 
                 cleaned_text != original_text):
-                supabase.table("saved_posts").update({
+                await db.table("saved_posts").update({
                     "topic_idea": cleaned_topic,
                     "format_style": cleaned_format,
                     "final_text": cleaned_text
@@ -2658,7 +2436,7 @@ async def save_image(request: Request, image_data: Dict[str, Any]):
             logger.warning("Запрос сохранения изображения без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для сохранения изображения необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
@@ -2681,14 +2459,14 @@ async def save_image(request: Request, image_data: Dict[str, Any]):
         image_data["created_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
         
         # Проверяем, существует ли уже такое изображение
-        image_check = supabase.table("saved_images").select("id").eq("url", image_data["url"]).execute()
+        image_check = await db.table("saved_images").select("id").eq("url", image_data["url"]).execute()
         
         if hasattr(image_check, 'data') and len(image_check.data) > 0:
             # Изображение уже существует, возвращаем его id
             return {"id": image_check.data[0]["id"], "status": "exists"}
         
         # Сохраняем информацию об изображении
-        result = supabase.table("saved_images").insert(image_data).execute()
+        result = await db.table("saved_images").insert(image_data).execute()
         
         # Проверка результата
         if not hasattr(result, 'data') or len(result.data) == 0:
@@ -2713,12 +2491,12 @@ async def get_user_images(request: Request, limit: int = 20):
             logger.warning("Запрос получения изображений пользователя без идентификации")
             raise HTTPException(status_code=401, detail="Для получения изображений необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Получаем все изображения пользователя
-        result = supabase.table("saved_images").select("*").eq("user_id", int(telegram_user_id)).limit(limit).execute()
+        result = await db.table("saved_images").select("*").eq("user_id", int(telegram_user_id)).limit(limit).execute()
         
         # Если в результате есть данные, возвращаем их
         if hasattr(result, 'data'):
@@ -2742,12 +2520,12 @@ async def get_image_by_id(request: Request, image_id: str):
             logger.warning("Запрос получения изображения по ID без идентификации")
             raise HTTPException(status_code=401, detail="Для получения изображения необходимо авторизоваться")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Получаем изображение по ID, проверяя принадлежность пользователю
-        result = supabase.table("saved_images").select("*").eq("id", image_id).eq("user_id", int(telegram_user_id)).maybe_single().execute()
+        result = await db.table("saved_images").select("*").eq("id", image_id).eq("user_id", int(telegram_user_id)).maybe_single().execute()
         
         # Если изображение найдено, возвращаем его
         if result.data:
@@ -2772,19 +2550,19 @@ async def get_post_images(request: Request, post_id: str):
             logger.warning("Запрос получения изображений поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для получения изображений поста необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Проверяем существование поста и принадлежность пользователю
-        post_check = supabase.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+        post_check = await db.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
         
         if not hasattr(post_check, 'data') or len(post_check.data) == 0:
             logger.warning(f"Попытка получить изображения чужого или несуществующего поста {post_id}")
             raise HTTPException(status_code=404, detail="Пост не найден или вы не имеете к нему доступа")
         
         # Получаем изображения поста через таблицу связей
-        result = supabase.table("post_images").select("saved_images(*)").eq("post_id", post_id).execute()
+        result = await db.table("post_images").select("saved_images(*)").eq("post_id", post_id).execute()
         
         # Если в результате есть данные и они имеют нужную структуру, извлекаем изображения
         images = []
@@ -2795,7 +2573,7 @@ async def get_post_images(request: Request, post_id: str):
         
         # Если изображений не найдено, проверяем, есть ли прямая ссылка в данных поста
         if not images:
-            post_data = supabase.table("saved_posts").select("image_url").eq("id", post_id).execute()
+            post_data = await db.table("saved_posts").select("image_url").eq("id", post_id).execute()
             if hasattr(post_data, 'data') and len(post_data.data) > 0 and post_data.data[0].get("image_url"):
                 images.append({
                     "id": f"direct_img_{post_id}",
@@ -2828,12 +2606,12 @@ async def proxy_image(request: Request, image_id: str, size: Optional[str] = Non
             logger.warning("Запрос проксирования изображения без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для доступа к изображению необходимо авторизоваться через Telegram")
         
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         
         # Получаем данные об изображении из базы
-        image_data = supabase.table("saved_images").select("*").eq("id", image_id).execute()
+        image_data = await db.table("saved_images").select("*").eq("id", image_id).execute()
         
         if not hasattr(image_data, 'data') or len(image_data.data) == 0:
             logger.warning(f"Изображение с ID {image_id} не найдено")
@@ -2848,20 +2626,17 @@ async def proxy_image(request: Request, image_id: str, size: Optional[str] = Non
             raise HTTPException(status_code=500, detail="Данные изображения повреждены")
         
         # Выполняем запрос к внешнему сервису для получения изображения
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка при получении изображения {image_id} по URL {image_url}: {response.status}")
-                    raise HTTPException(status_code=response.status, detail="Не удалось получить изображение")
-                
-                # Определяем тип контента
-                content_type = response.headers.get("Content-Type", "image/jpeg")
-                
-                # Получаем содержимое изображения
-                image_content = await response.read()
-                
-                # Возвращаем изображение как ответ
-                return Response(content=image_content, media_type=content_type)
+        client = get_http_client("external")
+        response = await client.get(image_url)
+        if response.status_code != 200:
+            logger.error(f"Ошибка при получении изображения {image_id} по URL {image_url}: {response.status_code}")
+            raise HTTPException(status_code=response.status_code, detail="Не удалось получить изображение")
+        
+        # Определяем тип контента
+        content_type = response.headers.get("Content-Type", "image/jpeg")
+        
+        # Возвращаем изображение как ответ
+        return Response(content=response.content, media_type=content_type)
     
     except Exception as e:
         logger.error(f"Ошибка при проксировании изображения: {e}")
@@ -2882,7 +2657,7 @@ async def save_suggested_idea(idea_data: Dict[str, Any], request: Request):
     if not telegram_user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    if not supabase:
+    if not db:
         logging.error("Supabase client not initialized")
         raise HTTPException(status_code=500, detail="Database not initialized")
     
@@ -2898,7 +2673,7 @@ async def save_suggested_idea(idea_data: Dict[str, Any], request: Request):
         idea_data["created_at"] = datetime.now().isoformat()
         
         # Сохраняем идею в базе данных
-        result = supabase.table("suggested_ideas").insert(idea_data).execute()
+        result = await db.table("suggested_ideas").insert(idea_data).execute()
         
         if hasattr(result, 'data') and result.data:
             logging.info(f"Saved idea with ID {idea_id}")
@@ -2918,12 +2693,12 @@ async def check_db_tables():
             logger.error("Отсутствуют SUPABASE_URL и DATABASE_URL в переменных окружения при проверке таблиц БД")
             return False
         # Проверяем есть ли клиент Supabase
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован для проверки таблиц")
             return False
         # Для проверки просто запрашиваем одну строку из таблицы, чтобы убедиться, что соединение работает
         try:
-            result = supabase.table("suggested_ideas").select("id").limit(1).execute()
+            result = await db.table("suggested_ideas").select("id").limit(1).execute()
             logger.info("Таблица suggested_ideas существует и доступна.")
         except Exception as e:
             logger.error(f"Ошибка при проверке соединения с Supabase: {e}")
@@ -2986,6 +2761,15 @@ async def fix_formatting_in_json_fields():
         # Продолжаем работу приложения даже при ошибке
 
 @app.get("/fix-schema")
+async def fix_schema_endpoint():
+    """Явная (админская) сверка схемы БД с записью отпечатка в schema_state."""
+    return await ensure_schema(force=True)
+
+@app.get("/schema-state")
+async def get_schema_state():
+    """Текущее состояние сверки схемы в этом процессе."""
+    return {"verified": is_schema_verified(), "version": SCHEMA_VERSION, "fingerprint": schema_fingerprint()}
+
 async def fix_schema():
     """Исправление схемы базы данных: добавление недостающих колонок и обновление кэша схемы."""
     logger.info("Запуск исправления схемы БД...")
@@ -2996,34 +2780,13 @@ async def fix_schema():
         "operations": []
     }
     try:
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             results["message"] = "Ошибка: не удалось подключиться к базе данных"
             return results
 
-        # Список команд для выполнения
-        sql_commands = [
-            # Добавление preview_url в saved_images
-            {
-                "name": "add_preview_url_to_saved_images",
-                "query": "ALTER TABLE saved_images ADD COLUMN IF NOT EXISTS preview_url TEXT;"
-            },
-            # Добавление updated_at в channel_analysis
-            {
-                "name": "add_updated_at_to_channel_analysis",
-                "query": "ALTER TABLE channel_analysis ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW();"
-            },
-            # Добавление external_id в saved_images
-            {
-                "name": "add_external_id_to_saved_images",
-                "query": "ALTER TABLE saved_images ADD COLUMN IF NOT EXISTS external_id TEXT;"
-            },
-            # Добавление saved_image_id в saved_posts
-            {
-                "name": "add_saved_image_id_to_saved_posts",
-                "query": "ALTER TABLE saved_posts ADD COLUMN IF NOT EXISTS saved_image_id UUID REFERENCES saved_images(id) ON DELETE SET NULL;"
-            }
-        ]
+        # Список команд для выполнения (версионируется в backend/schema_state.py)
+        sql_commands = SCHEMA_RECONCILE_COMMANDS
 
         all_commands_successful = True
         saved_image_id_column_verified = False # Флаг для проверки колонки
@@ -3361,7 +3124,7 @@ async def save_suggested_ideas_batch(payload: SaveIdeasRequest, request: Request
         logger.error(f"Некорректный ID пользователя в заголовке: {telegram_user_id}")
         raise HTTPException(status_code=400, detail="Некорректный формат ID пользователя")
 
-    if not supabase:
+    if not db:
         logger.error("Supabase client not initialized")
         raise HTTPException(status_code=500, detail="Database not initialized")
 
@@ -3376,7 +3139,7 @@ async def save_suggested_ideas_batch(payload: SaveIdeasRequest, request: Request
     # --- НАЧАЛО: Удаление старых идей для этого канала перед сохранением новых --- 
     if channel_name:
         try:
-            delete_result = supabase.table("suggested_ideas")\
+            delete_result = await db.table("suggested_ideas")\
                 .delete()\
                 .eq("user_id", int(telegram_user_id))\
                 .eq("channel_name", channel_name)\
@@ -3388,20 +3151,10 @@ async def save_suggested_ideas_batch(payload: SaveIdeasRequest, request: Request
             errors.append(f"Ошибка удаления старых идей: {str(del_err)}")
     # --- КОНЕЦ: Удаление старых идей --- 
 
-    # --- ДОБАВЛЕНО: Вызов fix_schema перед вставкой --- 
-    try:
-        logger.info("Вызов fix_schema непосредственно перед сохранением идей...")
-        fix_result = await fix_schema()
-        if not fix_result.get("success"):
-            logger.warning(f"Не удалось обновить/проверить схему перед сохранением идей: {fix_result}")
-            # Не прерываем, но логируем. Ошибка, скорее всего, повторится при вставке.
-            errors.append("Предупреждение: не удалось проверить/обновить схему перед сохранением.")
-        else:
-            logger.info("Проверка/обновление схемы перед сохранением идей завершена успешно.")
-    except Exception as pre_save_fix_err:
-        logger.error(f"Ошибка при вызове fix_schema перед сохранением идей: {pre_save_fix_err}", exc_info=True)
-        errors.append(f"Ошибка проверки схемы перед сохранением: {str(pre_save_fix_err)}")
-    # --- КОНЕЦ ДОБАВЛЕНИЯ ---
+    # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+    if not await ensure_schema_verified():
+        logger.warning("Схема БД не сверена перед сохранением идей")
+        errors.append("Предупреждение: не удалось проверить/обновить схему перед сохранением.")
 
     records_to_insert = []
     for idea_data in ideas_to_save:
@@ -3438,7 +3191,7 @@ async def save_suggested_ideas_batch(payload: SaveIdeasRequest, request: Request
 
     try:
         # Сохраняем все подготовленные записи одним запросом
-        result = supabase.table("suggested_ideas").insert(records_to_insert).execute()
+        result = await db.table("suggested_ideas").insert(records_to_insert).execute()
 
         if hasattr(result, 'data') and result.data:
             saved_count = len(result.data)
@@ -3454,7 +3207,7 @@ async def save_suggested_ideas_batch(payload: SaveIdeasRequest, request: Request
             saved_ids_single = []
             for record in records_to_insert:
                  try:
-                     single_result = supabase.table("suggested_ideas").insert(record).execute()
+                     single_result = await db.table("suggested_ideas").insert(record).execute()
                      if hasattr(single_result, 'data') and single_result.data:
                          saved_count_single += 1
                          saved_ids_single.append(record['id'])
@@ -3499,7 +3252,7 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
         logger.error(f"Некорректный ID пользователя в заголовке: {telegram_user_id}")
         raise HTTPException(status_code=400, detail="Некорректный формат ID пользователя")
 
-    if not supabase:
+    if not db:
         logger.error("Клиент Supabase не инициализирован")
         raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
 
@@ -3531,7 +3284,7 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
 
         # Загружаем файл в Supabase Storage
         # Используем file_options для установки content-type
-        upload_response = supabase.storage.from_(bucket_name).upload(
+        upload_response = await db.storage.from_(bucket_name).upload(
             path=storage_path,
             file=file_content,
             file_options={"content-type": content_type, "cache-control": "3600"} # Устанавливаем тип и кэширование
@@ -3542,7 +3295,7 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
         logger.info(f"Файл успешно загружен в Supabase Storage (ответ API: {upload_response}). Путь: {storage_path}")
 
         # Получаем публичный URL для загруженного файла
-        public_url_response = supabase.storage.from_(bucket_name).get_public_url(storage_path)
+        public_url_response = await db.storage.from_(bucket_name).get_public_url(storage_path)
 
         if not public_url_response:
              logger.error(f"Не удалось получить публичный URL для файла: {storage_path}")
@@ -3699,7 +3452,7 @@ async def get_subscription_status(request: Request):
     if not user_id:
         return {"error": "user_id обязателен"}
     try:
-        result = supabase.table("user_subscription").select("*").eq("user_id", int(user_id)).maybe_single().execute()
+        result = await db.table("user_subscription").select("*").eq("user_id", int(user_id)).maybe_single().execute()
         logger.info(f'Результат запроса к user_subscription: {result.data}')
         if result.data:
             sub = result.data
@@ -3802,10 +3555,11 @@ async def direct_premium_check(request: Request, user_id: Optional[str] = None):
                 headers=headers
             )
         
-        # Проверяем, что у нас есть доступ к базе данных
-        db_url = os.getenv("SUPABASE_URL") or os.getenv("DATABASE_URL") or os.getenv("RENDER_DATABASE_URL")
-        if not db_url:
-            logger.error("Отсутствуют SUPABASE_URL, DATABASE_URL и RENDER_DATABASE_URL")
+        # Статус берется из TTL-кэша, при промахе - через общий пул asyncpg
+        try:
+            premium_status = await get_premium_status(user_id_int)
+        except RuntimeError as pool_error:
+            logger.error(f"Нет подключения к базе данных для проверки премиума: {pool_error}")
             return JSONResponse(
                 content={
                     "has_premium": False,
@@ -3814,72 +3568,28 @@ async def direct_premium_check(request: Request, user_id: Optional[str] = None):
                 },
                 headers=headers
             )
-            
-        # Нормализуем URL базы данных
-        db_url = normalize_db_url(db_url)
+        has_premium = premium_status["has_premium"]
+        subscription_end_date = premium_status["subscription_end_date"]
+        logger.info(f"Премиум-статус пользователя {user_id_int}: has_premium={has_premium}, до {subscription_end_date}")
+
+        # Получаем лимиты в зависимости от статуса подписки
+        analysis_count = 9999 if has_premium else 3
+        post_generation_count = 9999 if has_premium else 1
         
-        # Подключаемся напрямую к базе данных (так же, как это делает бот)
-        conn = await asyncpg.connect(db_url)
-        try:
-            # Проверяем наличие активной подписки
-            query = """
-            SELECT
-                id,
-                user_id,
-                start_date,
-                end_date,
-                is_active,
-                payment_id,
-                created_at,
-                updated_at
-            FROM user_subscription 
-            WHERE user_id = $1 
-              AND is_active = TRUE 
-              AND end_date > NOW()
-            ORDER BY end_date DESC
-            LIMIT 1
-            """
-            
-            subscription = await conn.fetchrow(query, user_id_int)
-            
-            # Проверяем результат
-            if subscription:
-                # Подписка существует и активна
-                has_premium = True
-                from datetime import datetime
-                end_date_obj = subscription["end_date"]
-                subscription_end_date = end_date_obj.strftime('%Y-%m-%d %H:%M:%S')
-                end_date_formatted = end_date_obj.strftime('%d.%m.%Y %H:%M')
-                
-                logger.info(f"Найдена активная подписка для пользователя {user_id_int}. Действует до: {end_date_formatted}")
-            else:
-                # Подписка не существует или не активна
-                has_premium = False
-                subscription_end_date = None
-                logger.info(f"Активная подписка для пользователя {user_id_int} не найдена")
-            
-            # Получаем лимиты в зависимости от статуса подписки
-            analysis_count = 9999 if has_premium else 3
-            post_generation_count = 9999 if has_premium else 1
-            
-            # Формируем ответ
-            response_data = {
-                "has_premium": has_premium,
-                "user_id": user_id_int,
-                "error": None,
-                "analysis_count": analysis_count,
-                "post_generation_count": post_generation_count
-            }
-            
-            # Добавляем дату окончания подписки, если есть
-            if subscription_end_date:
-                response_data["subscription_end_date"] = subscription_end_date
-            
-            return JSONResponse(content=response_data, headers=headers)
-            
-        finally:
-            # Закрываем соединение с базой данных
-            await conn.close()
+        # Формируем ответ
+        response_data = {
+            "has_premium": has_premium,
+            "user_id": user_id_int,
+            "error": None,
+            "analysis_count": analysis_count,
+            "post_generation_count": post_generation_count
+        }
+        
+        # Добавляем дату окончания подписки, если есть
+        if subscription_end_date:
+            response_data["subscription_end_date"] = subscription_end_date
+        
+        return JSONResponse(content=response_data, headers=headers)
     
     except Exception as e:
         logger.error(f"Ошибка при прямой проверке премиум-статуса: {e}")
@@ -3918,13 +3628,13 @@ async def generate_invoice(request: Request):
             "prices": [{"label": "Подписка", "amount": amount * 100}],
             "photo_url": "https://smart-content-assistant.onrender.com/static/premium_sub.jpg"
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            tg_data = response.json()
-            if not tg_data.get("ok"):
-                logger.error(f"Ошибка Telegram API: {tg_data}")
-                raise HTTPException(status_code=500, detail=f"Ошибка Telegram API: {tg_data}")
-            invoice_url = tg_data["result"]
+        client = get_http_client("telegram_api")
+        response = await client.post(url, json=payload)
+        tg_data = response.json()
+        if not tg_data.get("ok"):
+            logger.error(f"Ошибка Telegram API: {tg_data}")
+            raise HTTPException(status_code=500, detail=f"Ошибка Telegram API: {tg_data}")
+        invoice_url = tg_data["result"]
         return {"invoice_url": invoice_url, "payment_id": payment_id}
     except Exception as e:
         logger.error(f"Ошибка при генерации инвойса: {e}")
@@ -3951,7 +3661,7 @@ async def download_and_save_external_image(image_data: PostImage, user_id: int)
     
     try:
         # Проверяем, существует ли уже это изображение в базе данных
-        image_check_result = supabase.table("saved_images").select("id").eq("url", image_data.url).limit(1).execute()
+        image_check_result = await db.table("saved_images").select("id").eq("url", image_data.url).limit(1).execute()
         if hasattr(image_check_result, 'data') and len(image_check_result.data) > 0:
             # Изображение уже существует в базе данных
             saved_image_id = image_check_result.data[0]["id"]
@@ -3959,86 +3669,86 @@ async def download_and_save_external_image(image_data: PostImage, user_id: int)
             return {"id": saved_image_id, "is_new": False}
         
         # Скачиваем изображение
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            logger.info(f"Начинаем скачивание изображения с URL: {image_data.url}")
-            response = await client.get(image_data.url)
-            response.raise_for_status()  # Проверяем успешность запроса
-            
-            # Получаем расширение файла из URL или из Content-Type
-            file_ext = None
-            content_type = response.headers.get("Content-Type", "").lower()
-            
-            if "image/jpeg" in content_type or "image/jpg" in content_type:
+        client = get_http_client("external")
+        logger.info(f"Начинаем скачивание изображения с URL: {image_data.url}")
+        response = await client.get(image_data.url)
+        response.raise_for_status()  # Проверяем успешность запроса
+        
+        # Получаем расширение файла из URL или из Content-Type
+        file_ext = None
+        content_type = response.headers.get("Content-Type", "").lower()
+        
+        if "image/jpeg" in content_type or "image/jpg" in content_type:
+            file_ext = "jpg"
+        elif "image/png" in content_type:
+            file_ext = "png"
+        elif "image/webp" in content_type:
+            file_ext = "webp"
+        elif "image/gif" in content_type:
+            file_ext = "gif"
+        else:
+            # Пытаемся получить расширение из URL
+            url_path = image_data.url.split("?")[0].lower()
+            if url_path.endswith(".jpg") or url_path.endswith(".jpeg"):
                 file_ext = "jpg"
-            elif "image/png" in content_type:
+            elif url_path.endswith(".png"):
                 file_ext = "png"
-            elif "image/webp" in content_type:
+            elif url_path.endswith(".webp"):
                 file_ext = "webp"
-            elif "image/gif" in content_type:
+            elif url_path.endswith(".gif"):
                 file_ext = "gif"
             else:
-                # Пытаемся получить расширение из URL
-                url_path = image_data.url.split("?")[0].lower()
-                if url_path.endswith(".jpg") or url_path.endswith(".jpeg"):
-                    file_ext = "jpg"
-                elif url_path.endswith(".png"):
-                    file_ext = "png"
-                elif url_path.endswith(".webp"):
-                    file_ext = "webp"
-                elif url_path.endswith(".gif"):
-                    file_ext = "gif"
-                else:
-                    # Если не удалось определить расширение, используем jpg по умолчанию
-                    file_ext = "jpg"
-            
-            # Создаем уникальное имя файла
-            new_internal_id = str(uuid.uuid4())
-            filename = f"{new_internal_id}.{file_ext}"
-            storage_path = f"external/{filename}"
-            
-            logger.info(f"Скачано изображение, размер: {len(response.content)} байт, тип: {content_type}")
-            
-            # Сохраняем изображение в Supabase Storage
-            storage_result = supabase.storage.from_("post-images").upload(
-                storage_path,
-                response.content,
-                file_options={"content-type": content_type}
-            )
-            
-            # Получаем публичный URL для сохраненного изображения
-            public_url = supabase.storage.from_("post-images").get_public_url(storage_path)
-            logger.info(f"Изображение сохранено в Storage, публичный URL: {public_url}")
-            
-            # Сохраняем информацию об изображении в базу данных
-            image_data_to_save = {
-                "id": new_internal_id,
-                "url": public_url,  # Используем URL из нашего хранилища
-                "preview_url": image_data.preview_url or public_url,
-                "alt": image_data.alt or "",
-                "author": image_data.author or "",
-                "author_url": image_data.author_url or "",
-                "source": f"{image_data.source}_saved" if image_data.source else "external_saved",
-                "user_id": user_id,
-                "external_url": image_data.url  # Сохраняем оригинальный URL
-            }
-            
-            image_result = supabase.table("saved_images").insert(image_data_to_save).execute()
-            if not hasattr(image_result, 'data') or len(image_result.data) == 0:
-                logger.error(f"Ошибка при сохранении информации об изображении в БД: {image_result}")
-                raise Exception("Не удалось сохранить информацию об изображении в базе данных")
-            
-            logger.info(f"Информация об изображении сохранена в БД с ID: {new_internal_id}")
-            return {
-                "id": new_internal_id,
-                "is_new": True,
-                "url": public_url,
-                "preview_url": image_data.preview_url or public_url,
-                "alt": image_data.alt or "",
-                "author": image_data.author or "",
-                "author_url": image_data.author_url or "",
-                "source": f"{image_data.source}_saved" if image_data.source else "external_saved"
-            }
-    
+                # Если не удалось определить расширение, используем jpg по умолчанию
+                file_ext = "jpg"
+        
+        # Создаем уникальное имя файла
+        new_internal_id = str(uuid.uuid4())
+        filename = f"{new_internal_id}.{file_ext}"
+        storage_path = f"external/{filename}"
+        
+        logger.info(f"Скачано изображение, размер: {len(response.content)} байт, тип: {content_type}")
+        
+        # Сохраняем изображение в Supabase Storage
+        storage_result = await db.storage.from_("post-images").upload(
+            storage_path,
+            response.content,
+            file_options={"content-type": content_type}
+        )
+        
+        # Получаем публичный URL для сохраненного изображения
+        public_url = await db.storage.from_("post-images").get_public_url(storage_path)
+        logger.info(f"Изображение сохранено в Storage, публичный URL: {public_url}")
+        
+        # Сохраняем информацию об изображении в базу данных
+        image_data_to_save = {
+            "id": new_internal_id,
+            "url": public_url,  # Используем URL из нашего хранилища
+            "preview_url": image_data.preview_url or public_url,
+            "alt": image_data.alt or "",
+            "author": image_data.author or "",
+            "author_url": image_data.author_url or "",
+            "source": f"{image_data.source}_saved" if image_data.source else "external_saved",
+            "user_id": user_id,
+            "external_url": image_data.url  # Сохраняем оригинальный URL
+        }
+        
+        image_result = await db.table("saved_images").insert(image_data_to_save).execute()
+        if not hasattr(image_result, 'data') or len(image_result.data) == 0:
+            logger.error(f"Ошибка при сохранении информации об изображении в БД: {image_result}")
+            raise Exception("Не удалось сохранить информацию об изображении в базе данных")
+        
+        logger.info(f"Информация об изображении сохранена в БД с ID: {new_internal_id}")
+        return {
+            "id": new_internal_id,
+            "is_new": True,
+            "url": public_url,
+            "preview_url": image_data.preview_url or public_url,
+            "alt": image_data.alt or "",
+            "author": image_data.author or "",
+            "author_url": image_data.author_url or "",
+            "source": f"{image_data.source}_saved" if image_data.source else "external_saved"
+        }
+
     except httpx.RequestError as e:
         logger.error(f"Ошибка при скачивании изображения: {e}")
         raise Exception(f"Не удалось скачать изображение: {str(e)}")
@@ -4093,17 +3803,17 @@ async def get_user_settings(
     """
     Получение пользовательских настроек.
     """
-    if not supabase:
+    if not db:
         logger.error("Supabase клиент не инициализирован при получении настроек пользователя")
         raise HTTPException(status_code=503, detail="База данных недоступна")
 
     try:
-        response = await asyncio.to_thread(
-            supabase.table("user_settings")
+        response = await (
+            db.table("user_settings")
             .select("*")
             .eq("user_id", user_id)
             .maybe_single()
-            .execute
+            .execute()
         )
         if response.data:
             return UserSettingsResponse(**response.data)
@@ -4124,7 +3834,7 @@ async def update_user_settings(
     """
     Обновление или создание пользовательских настроек.
     """
-    if not supabase:
+    if not db:
         logger.error("Supabase клиент не инициализирован при обновлении настроек пользователя")
         raise HTTPException(status_code=503, detail="База данных недоступна")
 
@@ -4142,30 +3852,30 @@ async def update_user_settings(
 
     try:
         # Проверяем, существуют ли настройки для этого пользователя
-        existing_settings_response = await asyncio.to_thread(
-            supabase.table("user_settings")
+        existing_settings_response = await (
+            db.table("user_settings")
             .select("id") # Достаточно одного поля для проверки существования
             .eq("user_id", user_id)
             .maybe_single()
-            .execute
+            .execute()
         )
 
         if existing_settings_response.data:
             # Обновляем существующие настройки
-            response = await asyncio.to_thread(
-                supabase.table("user_settings")
+            response = await (
+                db.table("user_settings")
                 .update(data_to_save)
                 .eq("user_id", user_id)
-                .execute
+                .execute()
             )
         else:
             # Создаем новые настройки
             data_to_save["created_at"] = now
             # data_to_save["id"] = uuid.uuid4() # PK генерируется базой данных по умолчанию
-            response = await asyncio.to_thread(
-                supabase.table("user_settings")
+            response = await (
+                db.table("user_settings")
                 .insert(data_to_save)
-                .execute
+                .execute()
             )
         
         if response.data:
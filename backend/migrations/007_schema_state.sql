@@ -0,0 +1,9 @@
+-- Таблица для хранения отпечатка примененной схемы (см. backend/schema_state.py)
+CREATE TABLE IF NOT EXISTS schema_state (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+COMMENT ON TABLE schema_state IS 'Отпечаток схемы, сверенной при последнем деплое';
@@ -0,0 +1,82 @@
+-- Атомарное списание бесплатных лимитов (см. SupabaseSubscriptionService.consume_quota)
+ALTER TABLE user_usage_stats ADD COLUMN IF NOT EXISTS ideas_generation_count INTEGER DEFAULT 0;
+ALTER TABLE user_usage_stats ADD COLUMN IF NOT EXISTS reset_at TIMESTAMP WITH TIME ZONE;
+
+-- Сброс счетчиков при наступлении reset_at, проверка лимита и списание одного использования
+-- выполняются в одной транзакции под блокировкой строки пользователя.
+-- Пользователи с активной подпиской не ограничиваются и квоту не списывают.
+CREATE OR REPLACE FUNCTION consume_quota(
+    p_user_id BIGINT,
+    p_kind TEXT,
+    p_limit INTEGER,
+    p_reset_days INTEGER DEFAULT 3
+) RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_row user_usage_stats%ROWTYPE;
+    v_has_premium BOOLEAN;
+    v_current INTEGER;
+    v_allowed BOOLEAN;
+    v_consumed BOOLEAN;
+BEGIN
+    IF p_kind NOT IN ('analysis', 'post', 'idea') THEN
+        RAISE EXCEPTION 'Неизвестный вид квоты: %', p_kind;
+    END IF;
+
+    SELECT EXISTS (
+        SELECT 1 FROM user_subscription
+        WHERE user_id = p_user_id AND is_active = TRUE AND end_date > NOW()
+    ) INTO v_has_premium;
+
+    INSERT INTO user_usage_stats (user_id, analysis_count, post_generation_count, ideas_generation_count, reset_at, created_at, updated_at)
+    VALUES (p_user_id, 0, 0, 0, NOW() + make_interval(days => p_reset_days), NOW(), NOW())
+    ON CONFLICT (user_id) DO NOTHING;
+
+    SELECT * INTO v_row FROM user_usage_stats WHERE user_id = p_user_id FOR UPDATE;
+
+    IF v_row.reset_at IS NULL OR v_row.reset_at <= NOW() THEN
+        UPDATE user_usage_stats
+        SET analysis_count = 0,
+            post_generation_count = 0,
+            ideas_generation_count = 0,
+            reset_at = NOW() + make_interval(days => p_reset_days),
+            updated_at = NOW()
+        WHERE user_id = p_user_id
+        RETURNING * INTO v_row;
+    END IF;
+
+    v_current := COALESCE(CASE p_kind
+        WHEN 'analysis' THEN v_row.analysis_count
+        WHEN 'post' THEN v_row.post_generation_count
+        ELSE v_row.ideas_generation_count
+    END, 0);
+    v_allowed := v_has_premium OR v_current < p_limit;
+    v_consumed := v_allowed AND NOT v_has_premium;
+
+    IF v_consumed THEN
+        UPDATE user_usage_stats
+        SET analysis_count = COALESCE(analysis_count, 0) + (p_kind = 'analysis')::INTEGER,
+            post_generation_count = COALESCE(post_generation_count, 0) + (p_kind = 'post')::INTEGER,
+            ideas_generation_count = COALESCE(ideas_generation_count, 0) + (p_kind = 'idea')::INTEGER,
+            updated_at = NOW()
+        WHERE user_id = p_user_id
+        RETURNING * INTO v_row;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'user_id', p_user_id,
+        'kind', p_kind,
+        'limit', p_limit,
+        'allowed', v_allowed,
+        'consumed', v_consumed,
+        'has_premium', v_has_premium,
+        'analysis_count', COALESCE(v_row.analysis_count, 0),
+        'post_generation_count', COALESCE(v_row.post_generation_count, 0),
+        'ideas_generation_count', COALESCE(v_row.ideas_generation_count, 0),
+        'reset_at', v_row.reset_at
+    );
+END;
+$$;
+
+COMMENT ON FUNCTION consume_quota(BIGINT, TEXT, INTEGER, INTEGER) IS 'Атомарная проверка и списание бесплатного лимита за один запрос';
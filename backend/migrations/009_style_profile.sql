@@ -0,0 +1,2 @@
+-- Профиль стиля канала (тон, длина, структура, эмодзи), см. backend/services/style_profile.py
+ALTER TABLE channel_analysis ADD COLUMN IF NOT EXISTS style_profile JSONB DEFAULT '{}'::jsonb;
@@ -0,0 +1,3 @@
+-- MinHash-сигнатура идеи для локального фильтра повторов, см. backend/services/idea_dedup.py
+ALTER TABLE suggested_ideas ADD COLUMN IF NOT EXISTS minhash JSONB;
+CREATE INDEX IF NOT EXISTS idx_suggested_ideas_user_channel ON suggested_ideas(user_id, channel_name);
@@ -0,0 +1,12 @@
+-- Состояние фоновых задач генерации при JOBS_DB_BACKING=true, см. backend/jobs.py
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    id UUID PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result JSONB,
+    error JSONB,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_user_id ON generation_jobs(user_id);
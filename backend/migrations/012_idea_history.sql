@@ -0,0 +1,3 @@
+-- История планов: старые идеи канала помечаются superseded_at вместо удаления,
+-- чтобы фильтр повторов (backend/services/idea_dedup.py) видел все прошлые идеи
+ALTER TABLE suggested_ideas ADD COLUMN IF NOT EXISTS superseded_at TIMESTAMP WITH TIME ZONE;
@@ -0,0 +1,125 @@
+# Поиск плейсхолдеров в сгенерированном тексте: автомат Ахо-Корасик по словарю запрещенных фрагментов,
+# один линейный проход по тексту вместо длинных списков запретов в промптах
+from collections import deque
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# (фрагмент, только целым словом). Фрагменты в нижнем регистре.
+# Целым словом ищутся слова, которые внутри других слов встречаются в обычном тексте ("пример" в "например").
+FORBIDDEN_FRAGMENTS: List[Tuple[str, bool]] = [
+    ("[", False),
+    ("]", False),
+    ("{", False),
+    ("}", False),
+    ("<вставьте", False),
+    ("(ссылка)", False),
+    ("(контакт)", False),
+    ("(контакты)", False),
+    ("(название)", False),
+    ("(телефон)", False),
+    ("(email)", False),
+    ("(дата)", False),
+    ("(цена)", False),
+    ("(имя)", False),
+    ("добавьте свой", False),
+    ("добавьте свою", False),
+    ("добавьте своё", False),
+    ("вставьте ссылку", False),
+    ("укажите", True),
+    ("заполните", True),
+    ("см. ниже", True),
+    ("см. выше", True),
+    ("здесь будет", True),
+    ("ваш номер", True),
+    ("ваш email", True),
+    ("ваша ссылка", True),
+    ("название компании", True),
+    ("имя автора", True),
+    ("tbd", True),
+    ("xxx", True),
+    ("lorem ipsum", False),
+]
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: все вхождения всех шаблонов за один проход по тексту."""
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Номера шаблонов, заканчивающихся в состоянии (с учетом суффиксных ссылок)
+        self._out: List[List[int]] = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state].extend(self._out[self._fail[next_state]])
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """Вхождения (начало, конец, номер шаблона) в порядке окончания."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                yield position + 1 - len(self.patterns[index]), position + 1, index
+
+
+_MATCHER = AhoCorasick([fragment for fragment, _ in FORBIDDEN_FRAGMENTS])
+_WHOLE_WORD = [whole_word for _, whole_word in FORBIDDEN_FRAGMENTS]
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def find_placeholders(text: str) -> List[str]:
+    """Найденные в тексте запрещенные фрагменты (без повторов, в порядке появления)."""
+    if not text:
+        return []
+    lowered = text.lower()
+    found: List[str] = []
+    for start, end, index in _MATCHER.iter_matches(lowered):
+        if _WHOLE_WORD[index]:
+            if start > 0 and _is_word_char(lowered[start - 1]):
+                continue
+            if end < len(lowered) and _is_word_char(lowered[end]):
+                continue
+        fragment = _MATCHER.patterns[index]
+        if fragment not in found:
+            found.append(fragment)
+    return found
+
+
+def has_placeholder(text: str) -> bool:
+    return bool(find_placeholders(text))
+
+
+def placeholder_paragraphs(paragraphs: Sequence[str]) -> Dict[int, List[str]]:
+    """Номера абзацев с плейсхолдерами -> найденные в них фрагменты."""
+    violations = {}
+    for number, paragraph in enumerate(paragraphs):
+        found = find_placeholders(paragraph)
+        if found:
+            violations[number] = found
+    return violations
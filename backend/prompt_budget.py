@@ -0,0 +1,104 @@
+# Бюджет токенов для промптов: подсчет локальным токенизатором, отбор постов и лимит ответа
+import logging
+import os
+import re
+from typing import List, Optional, Sequence
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+    TIKTOKEN_AVAILABLE = True
+except Exception:
+    _ENCODING = None
+    TIKTOKEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Контекстное окно самой "узкой" модели в цепочке провайдеров (gpt-3.5-turbo — 16k)
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "16000"))
+# Запас на служебные токены чата и погрешность подсчета
+CONTEXT_SAFETY_MARGIN = 256
+# Без tiktoken: ~2.5 символа на токен для русского текста (с запасом в большую сторону)
+CHARS_PER_TOKEN_FALLBACK = 2.5
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return int(len(text) / CHARS_PER_TOKEN_FALLBACK) + 1
+
+
+def count_message_tokens(messages: Sequence[dict]) -> int:
+    """Токены chat-сообщений с учетом служебной разметки (~4 токена на сообщение)."""
+    return sum(count_tokens(message.get("content") or "") + 4 for message in messages) + 2
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст до max_tokens токенов (по границе слова, если токенизатора нет)."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING is not None:
+        return _ENCODING.decode(_ENCODING.encode(text, disallowed_special=())[:max_tokens]).rstrip() + "…"
+    cut = text[:int(max_tokens * CHARS_PER_TOKEN_FALLBACK)]
+    return cut.rsplit(" ", 1)[0].rstrip() + "…"
+
+
+def _shingles(text: str) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < 3:
+        return set(words)
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def select_posts(texts: List[str], budget_tokens: int, max_post_tokens: Optional[int] = None) -> List[str]:
+    """
+    Отбирает посты в пределах budget_tokens. Каждый пост сначала обрезается до max_post_tokens,
+    затем жадно берутся самые информативные: длинные и непохожие на уже выбранные
+    (сходство — доля общих шинглов из трех слов). Порядок исходного списка сохраняется.
+    """
+    candidates = []
+    for index, text in enumerate(texts):
+        text = (text or "").strip()
+        if not text:
+            continue
+        if max_post_tokens:
+            text = truncate_to_tokens(text, max_post_tokens)
+        candidates.append({"index": index, "text": text, "tokens": count_tokens(text), "shingles": _shingles(text)})
+
+    selected = []
+    used = 0
+    while candidates:
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            if used + candidate["tokens"] > budget_tokens:
+                continue
+            similarity = 0.0
+            for chosen in selected:
+                union = candidate["shingles"] | chosen["shingles"]
+                if union:
+                    similarity = max(similarity, len(candidate["shingles"] & chosen["shingles"]) / len(union))
+            score = candidate["tokens"] * (1.0 - similarity)
+            if best is None or score > best_score:
+                best, best_score = candidate, score
+        if best is None or (selected and best_score <= 0):
+            break
+        selected.append(best)
+        used += best["tokens"]
+        candidates.remove(best)
+
+    if len(selected) < len(texts):
+        logger.info(f"Бюджет промпта {budget_tokens} токенов: отобрано {len(selected)} из {len(texts)} постов ({used} токенов)")
+    return [item["text"] for item in sorted(selected, key=lambda item: item["index"])]
+
+
+def output_budget(messages: Sequence[dict], desired_tokens: int, min_tokens: int = 100,
+                  context_tokens: int = LLM_CONTEXT_TOKENS) -> int:
+    """Лимит ответа: желаемый, но не больше того, что осталось в контекстном окне после промпта."""
+    remaining = context_tokens - count_message_tokens(messages) - CONTEXT_SAFETY_MARGIN
+    return max(min_tokens, min(desired_tokens, remaining))
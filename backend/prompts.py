@@ -0,0 +1,278 @@
+# Реестр шаблонов промптов. Статичные инструкции — неизменный префикс (system), данные запроса
+# дописываются в конец сообщения user, поэтому провайдеры (OpenRouter, OpenAI) переиспользуют кэш префикса.
+# Шаблоны разбираются один раз при импорте; по id шаблона (name@version) собирается статистика вызовов.
+import logging
+import threading
+from string import Formatter
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.prompt_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_SECTION_SEPARATOR = "\n\n"
+
+
+class PromptTemplate:
+    """
+    Шаблон промпта: статичный system и секции сообщения user с полями {name}.
+    Секция пропускается, если хотя бы одно ее поле пустое, — так собираются необязательные блоки.
+    Изменение текста шаблона требует нового version, чтобы статистика разных версий не смешивалась.
+    """
+
+    def __init__(self, name: str, version: int, system: str, sections: List[str], task: Optional[str] = None):
+        self.name = name
+        self.version = version
+        self.id = f"{name}@{version}"
+        # Класс задачи для маршрутизатора моделей в llm_gateway: keywords, analysis, plan, post
+        self.task = task
+        # system не форматируется и передается как есть
+        self.system = system.strip()
+        # Секции заранее разобраны на (литерал, поле) — при вызове остается только склейка
+        self._sections: List[List[Tuple[str, Optional[str]]]] = [self._compile(section) for section in sections]
+        self.fields = frozenset(field for section in self._sections for _, field in section if field)
+        self.prefix_tokens = count_tokens(self.system)
+
+    def _compile(self, section: str) -> List[Tuple[str, Optional[str]]]:
+        parts = []
+        for literal, field, format_spec, conversion in Formatter().parse(section.strip()):
+            if field is not None and (not field.isidentifier() or format_spec or conversion):
+                raise ValueError(f"Шаблон {self.id}: поддерживаются только простые поля {{name}}, получено {{{field}}}")
+            parts.append((literal, field))
+        return parts
+
+    def render_user(self, **data: Any) -> str:
+        unknown = set(data) - self.fields
+        if unknown:
+            raise KeyError(f"Шаблон {self.id}: неизвестные поля {sorted(unknown)}")
+        rendered = []
+        for section in self._sections:
+            values = [data.get(field) for _, field in section if field]
+            if any(value is None or value == "" for value in values):
+                continue
+            rendered.append("".join(literal + (str(data[field]) if field else "") for literal, field in section))
+        return _SECTION_SEPARATOR.join(rendered)
+
+    def render(self, **data: Any) -> List[Dict[str, str]]:
+        """Сообщения chat completion: статичный system, затем user с данными запроса."""
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.render_user(**data)},
+        ]
+
+
+_REGISTRY: Dict[str, PromptTemplate] = {}
+_TASKS_BY_ID: Dict[str, str] = {}
+
+
+def register(template: PromptTemplate) -> PromptTemplate:
+    if template.name in _REGISTRY:
+        raise ValueError(f"Шаблон {template.name} уже зарегистрирован")
+    _REGISTRY[template.name] = template
+    if template.task:
+        _TASKS_BY_ID[template.id] = template.task
+    return template
+
+
+def template_task(template_id: Optional[str]) -> Optional[str]:
+    """Класс задачи по id шаблона (None для неизвестного шаблона)."""
+    return _TASKS_BY_ID.get(template_id) if template_id else None
+
+
+def registered_templates() -> Dict[str, Dict[str, Any]]:
+    """id текущих версий шаблонов и размер их статичного префикса в токенах."""
+    return {name: {"id": template.id, "prefix_tokens": template.prefix_tokens} for name, template in _REGISTRY.items()}
+
+
+_GRAMMAR_RULES = """ГРАММАТИКА: Соблюдай правила русского языка:
+• Используй тире (—) в предложениях для пауз и противопоставлений
+• Ставь дефисы (-) в сложных словах: "контент-маркетинг", "SMM-продвижение", "интернет-канал"
+• Правильно оформляй перечисления и диалоги
+• Проверяй пунктуацию и орфографию
+• Пиши сложные и составные слова, а также устойчивые выражения с дефисом (например: кто-то, что-то, из-за, по-настоящему, когда-либо, где-нибудь, по-русски и т.д.) — не допускай их написания слитно или с ошибками"""
+
+_PLAN_CHANNEL_SECTION = "Telegram-канал: \"{channel_name}\""
+_PLAN_THEMES_SECTION = "План публикаций для канала тематики: {themes} на {period_days} дней. Форматы постов (используй ТОЛЬКО их): {styles}"
+_PLAN_PRODUCED_SECTION = "Для других дней этого плана уже выбраны идеи: {produced_topics}\nНЕ повторяй их."
+_PLAN_REJECTED_SECTION = "Эти идеи уже были у канала, НЕ предлагай их и похожие на них: {rejected_topics}\nПредложи совершенно новые идеи в рамках тематики канала."
+
+PLAN_JSON = register(PromptTemplate(
+    "plan_json", 1, task="plan",
+    system="""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — создать план публикаций на определенный период, учитывая темы и форматы канала.
+
+ВАЖНО: Создавай разнообразный контент, избегая зацикливания на одних и тех же темах. Обеспечь баланс между:
+1. Развитием уже затронутых тем (углубление, новые аспекты, продолжение)
+2. Введением свежих идей в рамках тематики канала
+3. Логическим продолжением предыдущих постов
+4. Избеганием прямого повторения уже использованных идей
+
+Формат ответа — JSON-план: [{"day": <номер дня от начала плана>, "topic_idea": "<идея поста>", "format_style": "<формат из списка>"}, ...], ровно по одной идее на каждый запрошенный день.
+В ответе выдай только JSON-план, без пояснений, без повторения инструкции, без скобок и мест для ручного заполнения.""",
+    sections=[
+        _PLAN_CHANNEL_SECTION,
+        _PLAN_THEMES_SECTION,
+        _PLAN_PRODUCED_SECTION,
+        _PLAN_REJECTED_SECTION,
+        "Создай {days_count} идей — по одной на каждый из дней: {days}.",
+    ],
+))
+
+PLAN_LINES = register(PromptTemplate(
+    "plan_lines", 1, task="plan",
+    system="""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — создать план публикаций на заданный период, учитывая темы и форматы канала.
+
+Создавай разнообразный контент, избегая зацикливания на одних и тех же темах и прямого повторения уже использованных идей.
+
+СТРОГО СЛЕДУЙ ФОРМАТУ ВЫВОДА: одна строка на день, дни по порядку, день, идея и стиль разделены ДВУМЯ двоеточиями (::).
+Формат КАЖДОЙ строки: День <номер_дня>:: <Идея поста>:: <Стиль из списка>
+Не добавляй заголовков, комментариев, нумерованных списков и любого другого текста.
+Без квадратных и фигурных скобок, плейсхолдеров и мест для ручного заполнения.""",
+    sections=[
+        _PLAN_CHANNEL_SECTION,
+        _PLAN_THEMES_SECTION,
+        _PLAN_REJECTED_SECTION,
+        "Выдай ровно {days_count} строк — по одной идее на каждый из дней: {days}.",
+    ],
+))
+
+# Данные поста идут от самых стабильных (примеры канала) к уникальным для запроса (тема)
+_POST_SECTIONS = [
+    "Примеры постов канала (копируй их стиль, структуру, форматирование, длину, тональность):\n{samples}",
+    "Последние посты канала (для контекста, НЕ повторяй эти темы):\n{recent_topics}\n\nСоздай пост, который логически дополняет развитие канала, но освещает новые аспекты темы.",
+    "{tone_instruction}",
+    "{structure_instruction}",
+    "Контекст времени: {time_context}",
+    "Особенности формата: {format_instruction}",
+    "Telegram-канал: \"@{channel_name}\"",
+    "Создай пост на тему:\n\"{topic_idea}\"",
+    "Формат поста: {format_style}",
+    "Напиши полный текст поста, который будет готов к публикации. В ответе выдай только готовый текст поста, без пояснений и примеров.",
+]
+
+POST_WITH_SAMPLES = register(PromptTemplate(
+    "post_with_samples", 1, task="post",
+    system=f"""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — сгенерировать текст поста на основе идеи и формата, который будет готов к публикации.
+
+КРИТИЧЕСКИ ВАЖНО: если даны примеры постов, ты должен максимально точно копировать их стиль, структуру, форматирование, длину, тональность, особенности подачи.
+
+СТРУКТУРА И ДЛИНА:
+• Анализируй длину примеров постов и создавай пост ТОЧНО такой же длины (±10%)
+• Копируй количество абзацев и их размер из примеров
+• Сохраняй структуру: если в примерах короткие абзацы — делай короткие, если длинные — делай длинные
+• Повторяй стиль разделения на абзацы (одна строка, двойной перенос и т.д.)
+• Если в примерах посты по 3-5 предложений — пиши столько же, если по 10-15 — следуй этому
+
+НЕ используй никаких других форматов, кроме как в примерах. Не добавляй ничего нового, не меняй структуру, не используй хэштеги, если их нет в примерах.
+
+Создай ГОТОВЫЙ текст с конкретными фактами, цифрами и примерами, без плейсхолдеров и мест для заполнения.
+
+{_GRAMMAR_RULES}
+
+В ответе только готовый текст поста, без пояснений, без повторения инструкции, без примеров, только сам пост.""",
+    sections=_POST_SECTIONS,
+))
+
+POST = register(PromptTemplate(
+    "post", 1, task="post",
+    system=f"""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — сгенерировать текст поста на основе идеи и формата, который будет готов к публикации.
+
+Пост должен быть структурированным, соответствовать теме и формату, быть готовым к публикации без шаблонов и пояснений. Критически важно: максимально точно копируй стиль, тон, манеру изложения, длину, форматирование и особенности из примеров постов, если они есть.
+
+Создай ГОТОВЫЙ текст с конкретными фактами, цифрами и примерами, без плейсхолдеров и мест для заполнения.
+
+{_GRAMMAR_RULES}
+
+В ответе выдай только готовый текст поста, без пояснений, без повторения инструкции, без примеров, только сам пост.""",
+    sections=_POST_SECTIONS,
+))
+
+POST_PARAGRAPH_FIX = register(PromptTemplate(
+    "post_paragraph_fix", 1, task="post",
+    system="Ты — редактор Telegram-канала. Перепиши абзац поста так, чтобы он был готов к публикации: без плейсхолдеров, скобок и мест для заполнения. Сохрани смысл, стиль, форматирование и длину. В ответе только новый абзац.",
+    sections=[
+        "Тема поста: {topic_idea}\nНедопустимые фрагменты: {fragments}",
+        "Абзац:\n{paragraph}",
+    ],
+))
+
+CHANNEL_ANALYSIS = register(PromptTemplate(
+    "channel_analysis", 1, task="analysis",
+    system="""Ты - эксперт по анализу контента Telegram-каналов.
+Твоя задача - глубоко проанализировать предоставленные посты и выявить САМЫЕ ХАРАКТЕРНЫЕ, ДОМИНИРУЮЩИЕ темы и стили/форматы, отражающие СУТЬ и УНИКАЛЬНОСТЬ канала.
+Избегай слишком общих формулировок, если они не являются ключевыми. Сосредоточься на качестве, а не на количестве.
+
+Определи 3-5 САМЫХ ХАРАКТЕРНЫХ тем и 3-5 САМЫХ РАСПРОСТРАНЕННЫХ стилей/форматов подачи контента, которые наилучшим образом отражают специфику ИМЕННО ЭТОГО канала.
+Основывайся ТОЛЬКО на предоставленных текстах.
+
+Выдай результат СТРОГО в формате JSON с двумя ключами: "themes" и "styles". Каждый ключ должен содержать массив из 3-5 наиболее РЕЛЕВАНТНЫХ строк. Никакого другого текста.""",
+    sections=["Посты Telegram-канала для анализа:\n{posts}"],
+))
+
+IMAGE_KEYWORDS = register(PromptTemplate(
+    "image_keywords", 1, task="keywords",
+    system="""Твоя задача - сгенерировать 2-3 эффективных ключевых слова для поиска изображений.
+Ключевые слова должны точно отражать тематику текста и быть универсальными для поиска стоковых изображений.
+Выбирай короткие конкретные существительные на английском языке, даже если текст на русском.
+Формат ответа: только ключевые слова через запятую, без объяснений.""",
+    sections=[
+        "Тематика поста: {topic}",
+        "Формат поста: {format_style}",
+        "Текст поста: {text}",
+    ],
+))
+
+
+# Статистика вызовов по id шаблона: число вызовов, суммарные задержка и токены
+_stats_lock = threading.Lock()
+_template_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _usage_value(usage: Any, name: str) -> int:
+    if usage is None:
+        return 0
+    value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return int(value or 0)
+
+
+def _cached_tokens(usage: Any) -> int:
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+    return _usage_value(details, "cached_tokens")
+
+
+def record_template_call(template_id: Optional[str], provider: str, latency: float, usage: Any):
+    """Учитывает вызов LLM по шаблону: задержка и токены (в том числе взятые из кэша префикса)."""
+    if not template_id:
+        return
+    prompt_tokens = _usage_value(usage, "prompt_tokens")
+    cached_tokens = _cached_tokens(usage)
+    completion_tokens = _usage_value(usage, "completion_tokens")
+    logger.info(
+        f"LLM {template_id} через {provider}: {latency:.2f} с, токены prompt={prompt_tokens} "
+        f"(из кэша {cached_tokens}), completion={completion_tokens}"
+    )
+    with _stats_lock:
+        stats = _template_stats.setdefault(template_id, {
+            "calls": 0, "latency": 0.0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+        })
+        stats["calls"] += 1
+        stats["latency"] += latency
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        stats["completion_tokens"] += completion_tokens
+
+
+def template_stats() -> Dict[str, Dict[str, float]]:
+    """Средняя задержка, средние токены и доля токенов промпта из кэша по каждой версии шаблона."""
+    with _stats_lock:
+        snapshot = {template_id: dict(stats) for template_id, stats in _template_stats.items()}
+    result = {}
+    for template_id, stats in snapshot.items():
+        calls = stats["calls"] or 1
+        result[template_id] = {
+            "calls": stats["calls"],
+            "avg_latency": round(stats["latency"] / calls, 3),
+            "avg_prompt_tokens": round(stats["prompt_tokens"] / calls, 1),
+            "avg_completion_tokens": round(stats["completion_tokens"] / calls, 1),
+            "cached_ratio": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0,
+        }
+    return result
@@ -0,0 +1,112 @@
+import asyncio
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.datastructures import Headers
+from typing import Dict, Any, Optional
+from pydantic import BaseModel
+from backend.jobs import FINISHED_STATES, job_queue
+from backend.sse import sse_event, sse_response
+from backend.routes.analysis import AnalyzeRequest
+from backend.routes.ideas import PlanGenerationRequest
+from backend.services.analysis_service import analyze_channel
+from backend.services.ideas_service import generate_content_plan
+from backend.services.posts_service import generate_post_details
+
+# Повтор события status, пока задача не изменилась, и интервал опроса БД для задач другого процесса (секунды)
+JOB_EVENTS_HEARTBEAT = 15
+JOB_EVENTS_POLL_INTERVAL = 2
+
+class JobSubmittedResponse(BaseModel):
+    job_id: str
+    status: str
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    result: Optional[Any] = None
+    error: Optional[Dict[str, Any]] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+router = APIRouter()
+
+def _telegram_user_id(request: Request) -> int:
+    telegram_user_id = request.headers.get("X-Telegram-User-Id")
+    if not telegram_user_id or not telegram_user_id.isdigit():
+        raise HTTPException(status_code=401, detail="Для запуска генерации необходимо авторизоваться через Telegram")
+    return int(telegram_user_id)
+
+async def _owned_job_state(request: Request, job_id: str) -> Dict[str, Any]:
+    user_id = _telegram_user_id(request)
+    state = await job_queue.get(job_id)
+    # Чужая задача неотличима от несуществующей
+    if not state or str(state.get("user_id")) != str(user_id):
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return {k: v for k, v in state.items() if k != "user_id"}
+
+class _JobRequest:
+    """
+    Снимок запроса для задачи: обработчик выполняется уже после ответа клиенту,
+    поэтому вместо живого Request ему передаются только нужные заголовки.
+    """
+
+    def __init__(self, telegram_user_id: int):
+        self.headers = Headers({"X-Telegram-User-Id": str(telegram_user_id)})
+
+async def _submit(request: Request, kind: str, handler, req) -> JobSubmittedResponse:
+    telegram_user_id = _telegram_user_id(request)
+    job_request = _JobRequest(telegram_user_id)
+    job = await job_queue.submit(kind, telegram_user_id, lambda: handler(job_request, req))
+    return JobSubmittedResponse(job_id=job.id, status=job.status)
+
+@router.post("/jobs/analyze", response_model=JobSubmittedResponse, status_code=202)
+async def submit_analyze_job(request: Request, req: AnalyzeRequest):
+    return await _submit(request, "analyze", analyze_channel, req)
+
+@router.post("/jobs/generate-plan", response_model=JobSubmittedResponse, status_code=202)
+async def submit_generate_plan_job(request: Request, req: PlanGenerationRequest):
+    return await _submit(request, "generate-plan", generate_content_plan, req)
+
+@router.post("/jobs/generate-post-details", response_model=JobSubmittedResponse, status_code=202)
+async def submit_generate_post_details_job(request: Request, req: Dict[str, Any]):
+    return await _submit(request, "generate-post-details", generate_post_details, req)
+
+@router.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(request: Request, job_id: str):
+    return await _owned_job_state(request, job_id)
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str):
+    """
+    Состояние задачи через Server-Sent Events. События: status — при каждом изменении состояния,
+    done — задача завершена (в данных результат или ошибка), error — задача пропала
+    (вытеснена из памяти или удалена), поток после него закрывается.
+    """
+    state = await _owned_job_state(request, job_id)
+
+    async def event_stream():
+        nonlocal state
+        while True:
+            job = job_queue.get_local(job_id)
+            changed = job.changed if job else None
+            if job:
+                state = job.to_dict()
+            if state["status"] in FINISHED_STATES:
+                yield sse_event("done", state)
+                return
+            yield sse_event("status", {"job_id": job_id, "status": state["status"]})
+            try:
+                if changed is not None:
+                    await asyncio.wait_for(changed.wait(), timeout=JOB_EVENTS_HEARTBEAT)
+                else:
+                    # Задача выполняется в другом процессе — состояние читается из БД
+                    await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+                    state = await _owned_job_state(request, job_id)
+            except asyncio.TimeoutError:
+                pass
+            except HTTPException as http_err:
+                # Ответ уже начат — ошибку можно передать только событием
+                yield sse_event("error", {"job_id": job_id, "status_code": http_err.status_code, "detail": http_err.detail})
+                return
+
+    return sse_response(event_stream())
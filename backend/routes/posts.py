@@ -3,7 +3,7 @@ from fastapi.responses import JSONResponse
 from typing import Dict, Any, List, Optional
 from pydantic import BaseModel, Field
 from uuid import UUID
-from backend.services.posts_service import get_posts, create_post, update_post, delete_post, generate_post_details
+from backend.services.posts_service import get_posts, create_post, update_post, delete_post, generate_post_details, generate_post_details_stream
 from backend.services.image_service import save_image, get_user_images, get_image_by_id, get_post_images, proxy_image
 
 class PostImage(BaseModel):
@@ -58,6 +58,10 @@ async def delete_post_router(post_id: str, request: Request):
 async def generate_post_details_router(request: Request, req: Dict[str, Any]):
     return await generate_post_details(request, req)
 
+@router.post("/generate-post-details/stream")
+async def generate_post_details_stream_router(request: Request, req: Dict[str, Any]):
+    return await generate_post_details_stream(request, req)
+
 @router.post("/save-image", response_model=Dict[str, Any])
 async def save_image_router(request: Request, image_data: Dict[str, Any]):
     return await save_image(request, image_data)
@@ -2,7 +2,8 @@ from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 from typing import Dict, Any
 from backend.services.supabase_subscription_service import SupabaseSubscriptionService
-from backend.main import supabase, logger
+from backend.main import logger
+from backend.db import db
 
 router = APIRouter()
 
@@ -12,7 +13,7 @@ async def init_user_usage(request: Request):
     telegram_user_id = request.headers.get("X-Telegram-User-Id")
     if not telegram_user_id or not telegram_user_id.isdigit():
         return {"error": "Некорректный или отсутствующий Telegram ID"}
-    subscription_service = SupabaseSubscriptionService(supabase)
+    subscription_service = SupabaseSubscriptionService(db)
     return await subscription_service.get_user_usage(int(telegram_user_id))
 
     # Возвращаем базовые лимиты даже в случае ошибки
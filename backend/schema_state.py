@@ -0,0 +1,184 @@
+# Версионированное состояние схемы БД: сверка один раз за деплой, а не на каждый запрос
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from backend.db import get_pg_pool
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повторной сверкой после неудачи (секунды), удваивается до максимума
+SCHEMA_RETRY_BACKOFF = float(os.getenv("SCHEMA_RETRY_BACKOFF", "30"))
+SCHEMA_RETRY_BACKOFF_MAX = float(os.getenv("SCHEMA_RETRY_BACKOFF_MAX", "600"))
+
+# Увеличивайте версию при любом изменении SCHEMA_RECONCILE_COMMANDS
+SCHEMA_VERSION = 5
+
+# Команды сверки схемы (идемпотентные), выполняются через fix_schema()
+SCHEMA_RECONCILE_COMMANDS: List[Dict[str, str]] = [
+    {
+        "name": "add_preview_url_to_saved_images",
+        "query": "ALTER TABLE saved_images ADD COLUMN IF NOT EXISTS preview_url TEXT;"
+    },
+    {
+        "name": "add_updated_at_to_channel_analysis",
+        "query": "ALTER TABLE channel_analysis ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW();"
+    },
+    {
+        "name": "add_external_id_to_saved_images",
+        "query": "ALTER TABLE saved_images ADD COLUMN IF NOT EXISTS external_id TEXT;"
+    },
+    {
+        "name": "add_saved_image_id_to_saved_posts",
+        "query": "ALTER TABLE saved_posts ADD COLUMN IF NOT EXISTS saved_image_id UUID REFERENCES saved_images(id) ON DELETE SET NULL;"
+    },
+    {
+        "name": "add_style_profile_to_channel_analysis",
+        "query": "ALTER TABLE channel_analysis ADD COLUMN IF NOT EXISTS style_profile JSONB DEFAULT '{}'::jsonb;"
+    },
+    {
+        "name": "add_minhash_to_suggested_ideas",
+        "query": "ALTER TABLE suggested_ideas ADD COLUMN IF NOT EXISTS minhash JSONB;"
+    },
+    {
+        "name": "create_generation_jobs",
+        "query": "CREATE TABLE IF NOT EXISTS generation_jobs (id UUID PRIMARY KEY, user_id BIGINT NOT NULL, kind TEXT NOT NULL, status TEXT NOT NULL, result JSONB, error JSONB, created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW());"
+    },
+    {
+        "name": "add_superseded_at_to_suggested_ideas",
+        "query": "ALTER TABLE suggested_ideas ADD COLUMN IF NOT EXISTS superseded_at TIMESTAMP WITH TIME ZONE;"
+    },
+]
+
+SCHEMA_STATE_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS schema_state ("
+    "id TEXT PRIMARY KEY, "
+    "version INTEGER NOT NULL, "
+    "fingerprint TEXT NOT NULL, "
+    "applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW())"
+)
+
+
+def schema_fingerprint() -> str:
+    """Отпечаток ожидаемой схемы: хэш версии и текста всех команд сверки."""
+    payload = f"{SCHEMA_VERSION}\n" + "\n".join(cmd["query"] for cmd in SCHEMA_RECONCILE_COMMANDS)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+_schema_verified = False
+_schema_lock = asyncio.Lock()
+_retry_at = 0.0
+_retry_delay = 0.0
+
+
+def is_schema_verified() -> bool:
+    """Флаг процесса: схема сверена с текущим отпечатком."""
+    return _schema_verified
+
+
+async def _ensure_state_table() -> bool:
+    """Создает таблицу schema_state через пул asyncpg (RPC exec_sql_array_json не выполняет DDL)."""
+    try:
+        pool = await get_pg_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(SCHEMA_STATE_TABLE_SQL)
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось создать таблицу schema_state: {e}")
+        return False
+
+
+async def _read_applied_fingerprint() -> Optional[str]:
+    try:
+        pool = await get_pg_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval("SELECT fingerprint FROM schema_state WHERE id = 'main'")
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать отпечаток схемы: {e}")
+        return None
+
+
+async def _record_fingerprint(fingerprint: str) -> bool:
+    try:
+        pool = await get_pg_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO schema_state (id, version, fingerprint, applied_at) "
+                "VALUES ('main', $1, $2, NOW()) "
+                "ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, "
+                "fingerprint = EXCLUDED.fingerprint, applied_at = EXCLUDED.applied_at",
+                SCHEMA_VERSION, fingerprint,
+            )
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось записать отпечаток схемы: {e}")
+        return False
+
+
+async def ensure_schema(force: bool = False) -> Dict[str, Any]:
+    """
+    Сверяет схему с ожидаемым отпечатком. Если отпечаток в таблице schema_state
+    совпадает, DDL не выполняется. Иначе запускается fix_schema() и отпечаток записывается.
+    """
+    global _schema_verified
+    from backend.main import fix_schema
+
+    if _schema_verified and not force:
+        return {"success": True, "message": "Схема уже сверена в этом процессе", "fingerprint": schema_fingerprint()}
+
+    async with _schema_lock:
+        if _schema_verified and not force:
+            return {"success": True, "message": "Схема уже сверена в этом процессе", "fingerprint": schema_fingerprint()}
+
+        expected = schema_fingerprint()
+        state_table_ready = await _ensure_state_table()
+
+        if not force and state_table_ready:
+            applied = await _read_applied_fingerprint()
+            if applied == expected:
+                _schema_verified = True
+                logger.info(f"Схема БД актуальна (отпечаток {expected[:12]}), сверка не требуется.")
+                return {"success": True, "message": "Схема актуальна", "fingerprint": expected}
+            logger.info(f"Отпечаток схемы изменился ({str(applied)[:12]} -> {expected[:12]}), запускаем сверку.")
+
+        fix_result = await fix_schema()
+        if not fix_result.get("success"):
+            logger.error(f"Сверка схемы завершилась с ошибкой: {fix_result.get('message')}")
+            return {**fix_result, "fingerprint": None}
+
+        # Схема в этом процессе сверена; без записанного отпечатка следующий деплой повторит сверку
+        _schema_verified = True
+        if state_table_ready and await _record_fingerprint(expected):
+            logger.info(f"Схема БД сверена, записан отпечаток {expected[:12]}.")
+            return {**fix_result, "fingerprint": expected}
+        logger.warning("Схема БД сверена, но отпечаток не записан.")
+        return {**fix_result, "fingerprint": None}
+
+
+async def ensure_schema_verified() -> bool:
+    """
+    Быстрая проверка для обработчиков запросов: читает флаг процесса.
+    Если стартовая сверка не удалась, повторяет ее не чаще, чем позволяет пауза
+    SCHEMA_RETRY_BACKOFF (удваивается после каждой неудачи).
+    """
+    global _retry_at, _retry_delay
+    if _schema_verified:
+        return True
+    if time.monotonic() < _retry_at:
+        return False
+    try:
+        result = await ensure_schema()
+        success = bool(result.get("success"))
+    except Exception as e:
+        logger.error(f"Ошибка при сверке схемы БД: {e}", exc_info=True)
+        success = False
+    if success:
+        _retry_delay = 0.0
+        return True
+    _retry_delay = min(SCHEMA_RETRY_BACKOFF_MAX, _retry_delay * 2 if _retry_delay else SCHEMA_RETRY_BACKOFF)
+    _retry_at = time.monotonic() + _retry_delay
+    logger.warning(f"Сверка схемы не удалась, следующая попытка не раньше чем через {_retry_delay:.0f} с.")
+    return False
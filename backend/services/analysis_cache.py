@@ -0,0 +1,92 @@
+# Общий кэш результатов анализа каналов: ключ — имя канала и хэш текстов постов
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from backend.main import logger
+from backend.singleflight import SingleFlight
+
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", "21600"))  # 6 часов
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "1000"))
+
+_CHANNEL_PREFIX_RE = re.compile(r"^(?:https?://)?(?:www\.)?(?:t\.me|telegram\.me)/(?:s/)?", re.IGNORECASE)
+
+# ключ -> (момент истечения по time.monotonic(), результат анализа)
+_analysis_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+# Вычисления анализа, которые уже выполняются
+_analysis_flight = SingleFlight("analysis")
+
+
+def normalize_channel_username(username: str) -> str:
+    """Приводит имя канала к единому виду: без ссылки t.me, без @, в нижнем регистре."""
+    name = _CHANNEL_PREFIX_RE.sub("", (username or "").strip())
+    return name.strip("/").lstrip("@").lower()
+
+
+def posts_fingerprint(texts: List[str]) -> str:
+    """Хэш текстов постов: меняется, как только в канале появляются новые посты."""
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update((text or "").strip().encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+
+def analysis_cache_key(username: str, texts: List[str]) -> str:
+    return f"{normalize_channel_username(username)}:{posts_fingerprint(texts)}"
+
+
+def _get_cached(key: str):
+    cached = _analysis_cache.get(key)
+    if cached is None:
+        return None
+    if cached[0] <= time.monotonic():
+        _analysis_cache.pop(key, None)
+        return None
+    _analysis_cache.move_to_end(key)
+    return dict(cached[1])
+
+
+def _store(key: str, result: Dict[str, Any]):
+    if ANALYSIS_CACHE_TTL <= 0:
+        return
+    _analysis_cache[key] = (time.monotonic() + ANALYSIS_CACHE_TTL, dict(result))
+    _analysis_cache.move_to_end(key)
+    while len(_analysis_cache) > ANALYSIS_CACHE_MAX_ENTRIES:
+        _analysis_cache.popitem(last=False)
+
+
+def invalidate_channel_analysis(username: str):
+    """Удаляет из кэша все результаты анализа канала."""
+    prefix = f"{normalize_channel_username(username)}:"
+    for key in [k for k in _analysis_cache if k.startswith(prefix)]:
+        _analysis_cache.pop(key, None)
+
+
+async def get_or_compute_analysis(
+    username: str,
+    texts: List[str],
+    compute: Callable[[], Awaitable[Dict[str, Any]]],
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Возвращает (результат, взят_ли_из_кэша). Одновременные запросы с тем же ключом
+    дожидаются одного вычисления. В кэш попадают только результаты с темами или стилями
+    и без флага cacheable=False (например, темы по умолчанию при отсутствии API ключей).
+    """
+    key = analysis_cache_key(username, texts)
+    cached = _get_cached(key)
+    if cached is not None:
+        return cached, True
+
+    async def compute_and_store():
+        result = await compute()
+        if result.get("cacheable", True) and (result.get("themes") or result.get("styles")):
+            _store(key, result)
+            logger.info(f"Результат анализа канала @{normalize_channel_username(username)} сохранен в кэш")
+        return result
+
+    result, shared = await _analysis_flight.do(key, compute_and_store)
+    return (dict(result) if shared else result), shared
@@ -1,11 +1,20 @@
 from fastapi import Request, HTTPException
 from typing import List, Dict, Any, Optional
-from backend.telegram_utils import get_telegram_posts_via_http, get_telegram_posts_via_telethon, get_sample_posts
+from backend.telegram_utils import get_sample_posts
+from backend.services.channel_fetch_service import fetch_channel_posts
 from backend.deepseek_utils import analyze_content_with_deepseek
-from backend.main import supabase, logger, OPENROUTER_API_KEY, OPENAI_API_KEY
+from backend.llm_gateway import is_llm_configured, PROVIDER_ORDER
+from backend.main import logger, OPENROUTER_API_KEY
+from backend.db import db
 from backend.services.supabase_subscription_service import SupabaseSubscriptionService
+from backend.services.analysis_cache import get_or_compute_analysis
+from backend.services.style_profile import compute_style_profile, invalidate_style_context
 from datetime import datetime
 from pydantic import BaseModel
+import os
+
+# Сколько постов канала анализировать (HTTP парсер загружает их постранично)
+ANALYSIS_MAX_POSTS = int(os.getenv("ANALYSIS_MAX_POSTS", "20"))
 
 class AnalyzeRequest(BaseModel):
     username: str
@@ -19,53 +28,64 @@ class AnalyzeResponse(BaseModel):
     message: Optional[str] = None
     error: Optional[str] = None
 
+async def _analyze_posts_content(username: str, texts: List[str]) -> Dict[str, Any]:
+    """Определяет темы и стили канала через LLM-шлюз (OpenRouter, при сбое — OpenAI)."""
+    if not is_llm_configured():
+        logger.error("Отсутствуют API ключи для анализа (OPENROUTER_API_KEY и OPENAI_API_KEY)")
+        return {
+            "themes": ["Технологии", "Маркетинг", "Бизнес", "Аналитика", "Новости"],
+            "styles": ["Обзор", "Лайфхак", "Анонс", "Интервью", "Туториал"],
+            "used_backup_api": False,
+            "message": "API для анализа контента недоступны. Использованы темы и стили по умолчанию.",
+            "cacheable": False,
+        }
+    logger.info(f"Анализируем посты канала @{username} через LLM-шлюз")
+    try:
+        analysis_result = await analyze_content_with_deepseek(texts, OPENROUTER_API_KEY)
+    except Exception as e:
+        logger.error(f"Ошибка анализа: {e}")
+        analysis_result = {"themes": [], "styles": []}
+    themes = analysis_result.get("themes", [])
+    styles = analysis_result.get("styles", [])
+    used_backup_api = analysis_result.get("provider") not in (None, PROVIDER_ORDER[0])
+    error_message = "Использован запасной API для анализа." if used_backup_api else None
+    if not themes and not styles:
+        error_message = "Ошибка при анализе контента через API."
+    return {
+        "themes": themes,
+        "styles": styles,
+        "used_backup_api": used_backup_api,
+        "message": error_message,
+        "cacheable": True,
+    }
+
 async def analyze_channel(request: Request, req: AnalyzeRequest):
     telegram_user_id = request.headers.get("X-Telegram-User-Id")
     logger.info(f"Начинаем анализ канала от пользователя: {telegram_user_id}")
     if not telegram_user_id or not telegram_user_id.isdigit():
         raise HTTPException(status_code=401, detail="Ошибка авторизации: не удалось получить корректный Telegram ID. Откройте приложение внутри Telegram.")
+    subscription_service = SupabaseSubscriptionService(db)
+    quota = None
     try:
-        subscription_service = SupabaseSubscriptionService(supabase)
-        can_analyze = await subscription_service.can_analyze_channel(int(telegram_user_id))
-        if not can_analyze:
-            usage = await subscription_service.get_user_usage(int(telegram_user_id))
-            reset_at = usage.get("reset_at")
+        # Сброс, проверка и списание лимита — один запрос к БД
+        quota = await subscription_service.consume_quota(int(telegram_user_id), "analysis")
+        if not quota.get("allowed"):
+            reset_at = quota.get("reset_at")
             raise HTTPException(status_code=403, detail=f"Достигнут лимит в 5 анализов каналов для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.")
         username = req.username.replace("@", "").strip()
         posts = []
         errors_list = []
         error_message = None
-        # 1. HTTP парсер
-        try:
-            logger.info(f"Пытаемся получить посты канала @{username} через HTTP парсинг")
-            http_posts = await get_telegram_posts_via_http(username)
-            if http_posts and len(http_posts) > 0:
-                posts = [{"text": post} for post in http_posts]
-                logger.info(f"Успешно получено {len(posts)} постов через HTTP парсинг")
-            else:
-                logger.warning(f"HTTP парсинг не вернул постов для канала @{username}, пробуем Telethon")
-                errors_list.append("HTTP: Не получены посты, пробуем Telethon")
-        except Exception as http_error:
-            logger.error(f"Ошибка при HTTP парсинге для канала @{username}: {http_error}")
-            errors_list.append(f"HTTP: {str(http_error)}")
-        # 2. Telethon
-        if not posts:
-            try:
-                logger.info(f"Пытаемся получить посты канала @{username} через Telethon")
-                telethon_posts, telethon_error = await get_telegram_posts_via_telethon(username)
-                if telethon_error:
-                    logger.warning(f"Ошибка Telethon для канала @{username}: {telethon_error}")
-                    errors_list.append(f"Telethon: {telethon_error}")
-                else:
-                    posts = telethon_posts
-                    logger.info(f"Успешно получено {len(posts)} постов через Telethon")
-            except Exception as e:
-                logger.error(f"Непредвиденная ошибка при получении постов канала @{username} через Telethon: {e}")
-                errors_list.append(f"Ошибка Telethon: {str(e)}")
+        # 1-2. HTTP парсер и Telethon наперегонки (второй источник стартует после задержки хеджирования)
+        posts, _, fetch_errors = await fetch_channel_posts(username, ANALYSIS_MAX_POSTS)
+        errors_list.extend(fetch_errors)
         # 3. Примеры
         sample_data_used = False
         if not posts:
             logger.warning(f"Не удалось получить посты канала {username}")
+            # Анализ не выполнен — возвращаем списанный лимит
+            if quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "analysis")
             
             # Проверяем наличие явных ошибок доступа, чтобы определить тип проблемы
             channel_not_exists = False
@@ -107,186 +127,21 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
                     error=f"Не удалось получить доступ к каналу @{username}. Возможно, канал не существует, является закрытым или превышен лимит запросов."
                 )
                 
-        # 4. Анализируем первые 20 постов
-        posts = posts[:20]
+        # 4. Анализируем первые ANALYSIS_MAX_POSTS постов
+        posts = posts[:ANALYSIS_MAX_POSTS]
         logger.info(f"Анализируем {len(posts)} постов")
         texts = [post.get("text", "") for post in posts if post.get("text")]
         
-        # Проверяем наличие API ключей и выбираем стратегию анализа
-        used_backup_api = False
-        
-        if OPENROUTER_API_KEY:
-            # Пробуем сначала использовать OpenRouter API
-            try:
-                logger.info(f"Анализируем посты канала @{username} с использованием OpenRouter API")
-                try:
-                    analysis_result = await analyze_content_with_deepseek(texts, OPENROUTER_API_KEY)
-                except Exception as e:
-                    logger.error(f"Ошибка анализа: {e}")
-                    analysis_result = {"themes": [], "styles": []}
-                themes = analysis_result.get("themes", [])
-                styles = analysis_result.get("styles", [])
-                if not themes and not styles:
-                    # Если не получены результаты, пробуем запасной API
-                    logger.warning(f"OpenRouter API не вернул результатов анализа для канала @{username}, пробуем использовать запасной API")
-                    raise Exception("OpenRouter API не вернул результатов анализа")
-            except Exception as api_error:
-                logger.error(f"Ошибка при анализе через OpenRouter API: {api_error}")
-                
-                # Пробуем использовать OpenAI API как запасной вариант
-                if OPENAI_API_KEY:
-                    used_backup_api = True
-                    try:
-                        logger.info(f"Пробуем анализировать посты канала @{username} с использованием запасного OpenAI API")
-                        
-                        # Импортируем локально, чтобы избежать циклических импортов
-                        from openai import AsyncOpenAI
-                        
-                        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-                        
-                        # Подготавливаем короткую выборку текстов для GPT
-                        sample_texts = [text[:2000] for text in texts[:10]]  # Ограничиваем размер и количество текстов
-                        combined_texts = "\n\n---\n\n".join(sample_texts)
-                        
-                        prompt = f"""Проанализируй следующие посты из Telegram-канала и определи:
-1. Основные темы канала (5-7 тем)
-2. Стили/форматы постов (5-7 стилей)
-
-Выдай ответ в JSON-формате:
-{{
-  "themes": ["тема1", "тема2", ...],
-  "styles": ["стиль1", "стиль2", ...]
-}}
-
-Тексты постов:
-{combined_texts}"""
-                        
-                        response = await openai_client.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[
-                                {"role": "system", "content": "Ты - аналитик контента для Telegram-каналов."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.7,
-                            max_tokens=500
-                        )
-                        
-                        analysis_text = response.choices[0].message.content.strip()
-                        
-                        # Извлекаем JSON из ответа
-                        import json
-                        import re
-                        
-                        json_match = re.search(r'(\{.*\})', analysis_text, re.DOTALL)
-                        if json_match:
-                            analysis_text = json_match.group(1)
-                        
-                        try:
-                            backup_analysis = json.loads(analysis_text)
-                            themes = backup_analysis.get("themes", [])
-                            styles = backup_analysis.get("styles", [])
-                            logger.info(f"Успешно получены результаты анализа через запасной OpenAI API: темы:{len(themes)}, стили:{len(styles)}")
-                            
-                            if error_message:
-                                error_message += " Использован запасной API для анализа."
-                            else:
-                                error_message = "Использован запасной API для анализа."
-                                
-                        except json.JSONDecodeError as json_err:
-                            logger.error(f"Не удалось распарсить JSON из ответа OpenAI: {json_err}, ответ: {analysis_text}")
-                            themes = []
-                            styles = []
-                            error_message = "Ошибка при анализе контента (ошибка парсинга JSON)."
-                            
-                    except Exception as openai_err:
-                        logger.error(f"Ошибка при использовании запасного OpenAI API: {openai_err}")
-                        themes = []
-                        styles = []
-                        error_message = "Ошибка при анализе контента через оба API."
-                else:
-                    # Нет запасного API
-                    logger.error("Запасной API (OPENAI_API_KEY) не настроен, невозможно продолжить анализ")
-                    themes = []
-                    styles = []
-                    error_message = "Ошибка при анализе контента (запасной API не настроен)."
-        
-        elif OPENAI_API_KEY:
-            # Если нет OPENROUTER_API_KEY, но есть OPENAI_API_KEY, используем его напрямую
-            used_backup_api = True
-            try:
-                logger.info(f"OPENROUTER_API_KEY отсутствует, используем OpenAI API напрямую для анализа канала @{username}")
-                
-                # Импортируем локально, чтобы избежать циклических импортов
-                from openai import AsyncOpenAI
-                
-                openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-                
-                # Подготавливаем короткую выборку текстов для GPT
-                sample_texts = [text[:2000] for text in texts[:10]]  # Ограничиваем размер и количество текстов
-                combined_texts = "\n\n---\n\n".join(sample_texts)
-                
-                prompt = f"""Проанализируй следующие посты из Telegram-канала и определи:
-1. Основные темы канала (5-7 тем)
-2. Стили/форматы постов (5-7 стилей)
-
-Выдай ответ в JSON-формате:
-{{
-  "themes": ["тема1", "тема2", ...],
-  "styles": ["стиль1", "стиль2", ...]
-}}
-
-Тексты постов:
-{combined_texts}"""
-                
-                response = await openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "Ты - аналитик контента для Telegram-каналов."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=500
-                )
-                
-                analysis_text = response.choices[0].message.content.strip()
-                
-                # Извлекаем JSON из ответа
-                import json
-                import re
-                
-                json_match = re.search(r'(\{.*\})', analysis_text, re.DOTALL)
-                if json_match:
-                    analysis_text = json_match.group(1)
-                
-                try:
-                    backup_analysis = json.loads(analysis_text)
-                    themes = backup_analysis.get("themes", [])
-                    styles = backup_analysis.get("styles", [])
-                    logger.info(f"Успешно получены результаты анализа через OpenAI API: темы:{len(themes)}, стили:{len(styles)}")
-                    
-                    if error_message:
-                        error_message += " Использован запасной API для анализа."
-                    else:
-                        error_message = "Использован запасной API для анализа."
-                        
-                except json.JSONDecodeError as json_err:
-                    logger.error(f"Не удалось распарсить JSON из ответа OpenAI: {json_err}, ответ: {analysis_text}")
-                    themes = []
-                    styles = []
-                    error_message = "Ошибка при анализе контента (ошибка парсинга JSON)."
-                    
-            except Exception as openai_err:
-                logger.error(f"Ошибка при использовании OpenAI API: {openai_err}")
-                themes = []
-                styles = []
-                error_message = "Ошибка при анализе контента через API."
-                
-        else:
-            # Нет ни одного API ключа
-            logger.error("Отсутствуют API ключи для анализа (OPENROUTER_API_KEY и OPENAI_API_KEY)")
-            themes = ["Технологии", "Маркетинг", "Бизнес", "Аналитика", "Новости"]
-            styles = ["Обзор", "Лайфхак", "Анонс", "Интервью", "Туториал"]
-            error_message = "API для анализа контента недоступны. Использованы темы и стили по умолчанию."
+        # Темы и стили берем из общего кэша, если канал с тем же набором постов уже анализировался
+        analysis_result, from_cache = await get_or_compute_analysis(
+            username, texts, lambda: _analyze_posts_content(username, texts)
+        )
+        themes = analysis_result.get("themes", [])
+        styles = analysis_result.get("styles", [])
+        used_backup_api = analysis_result.get("used_backup_api", False)
+        error_message = analysis_result.get("message")
+        if from_cache:
+            logger.info(f"Результат анализа канала @{username} взят из кэша")
         
         # 5. Сохраняем результат анализа в БД
         try:
@@ -300,29 +155,27 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
                 "best_posting_time": "18:00-20:00",  # Можно доработать
                 "is_sample_data": sample_data_used,
                 "used_backup_api": used_backup_api,  # Добавляем информацию об использовании запасного API
+                # Профиль стиля считается здесь один раз и используется при каждой генерации поста
+                "style_profile": compute_style_profile(texts),
                 "updated_at": datetime.now().isoformat()
             }
-            analysis_check = supabase.table("channel_analysis").select("id").eq("user_id", telegram_user_id).eq("channel_name", username).execute()
+            analysis_check = await db.table("channel_analysis").select("id").eq("user_id", telegram_user_id).eq("channel_name", username).execute()
             if hasattr(analysis_check, 'data') and len(analysis_check.data) > 0:
-                supabase.table("channel_analysis").update(analysis_data).eq("user_id", telegram_user_id).eq("channel_name", username).execute()
+                await db.table("channel_analysis").update(analysis_data).eq("user_id", telegram_user_id).eq("channel_name", username).execute()
             else:
-                supabase.table("channel_analysis").insert(analysis_data).execute()
+                await db.table("channel_analysis").insert(analysis_data).execute()
+            invalidate_style_context(int(telegram_user_id), username)
             # --- Обновляем allChannels в user_settings ---
-            user_settings_result = supabase.table("user_settings").select("allChannels").eq("user_id", telegram_user_id).maybe_single().execute()
+            user_settings_result = await db.table("user_settings").select("allChannels").eq("user_id", telegram_user_id).maybe_single().execute()
             all_channels = []
             if hasattr(user_settings_result, 'data') and user_settings_result.data and user_settings_result.data.get("allChannels"):
                 all_channels = user_settings_result.data["allChannels"]
             if username not in all_channels:
                 all_channels.append(username)
-                supabase.table("user_settings").update({"allChannels": all_channels, "updated_at": datetime.now().isoformat()}).eq("user_id", telegram_user_id).execute()
+                await db.table("user_settings").update({"allChannels": all_channels, "updated_at": datetime.now().isoformat()}).eq("user_id", telegram_user_id).execute()
         except Exception as db_error:
             logger.error(f"Ошибка при сохранении результатов анализа в БД: {db_error}")
-        # 6. Увеличиваем счетчик использования
-        try:
-            await subscription_service.increment_analysis_usage(int(telegram_user_id))
-        except Exception as counter_error:
-            logger.error(f"Ошибка при увеличении счетчика анализа: {counter_error}")
-        # 7. Возвращаем результат
+        # 6. Возвращаем результат (лимит уже списан через consume_quota)
         return AnalyzeResponse(
             themes=themes,
             styles=styles,
@@ -331,6 +184,12 @@ async def analyze_channel(request: Request, req: AnalyzeRequest):
             analyzed_posts_count=len(posts),
             message=error_message
         )
+    except HTTPException as http_err:
+        if http_err.status_code >= 500 and quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "analysis")
+        raise
     except Exception as e:
         logger.error(f"Ошибка при анализе канала для пользователя {telegram_user_id}: {e}")
+        if quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "analysis")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}") 
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Хеджированное получение постов канала: HTTP парсинг t.me/s и Telethon наперегонки
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.main import logger
+from backend.telegram_utils import iter_telegram_posts_via_http, get_telegram_posts_via_telethon, telethon_gateway
+from backend.services.analysis_cache import normalize_channel_username
+from backend.singleflight import SingleFlight
+
+# Через сколько секунд без результата запускать второй источник
+CHANNEL_FETCH_HEDGE_DELAY = float(os.getenv("CHANNEL_FETCH_HEDGE_DELAY", "2"))
+CHANNEL_SOURCE_MEMORY_TTL = float(os.getenv("CHANNEL_SOURCE_MEMORY_TTL", "86400"))
+CHANNEL_SOURCE_MEMORY_MAX = 5000
+
+# канал -> (момент истечения по time.monotonic(), источник, который сработал последним)
+_source_memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+
+def remembered_source(username: str) -> Optional[str]:
+    """Источник ("http" или "telethon"), который вернул посты канала в прошлый раз."""
+    key = normalize_channel_username(username)
+    entry = _source_memory.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        _source_memory.pop(key, None)
+        return None
+    return entry[1]
+
+
+def _remember_source(username: str, source: str):
+    key = normalize_channel_username(username)
+    _source_memory[key] = (time.monotonic() + CHANNEL_SOURCE_MEMORY_TTL, source)
+    _source_memory.move_to_end(key)
+    while len(_source_memory) > CHANNEL_SOURCE_MEMORY_MAX:
+        _source_memory.popitem(last=False)
+
+
+async def _fetch_via_http(username: str, limit: int, first_post: asyncio.Event) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    posts: List[Dict[str, Any]] = []
+    try:
+        async for post in iter_telegram_posts_via_http(username, limit=limit):
+            posts.append(post)
+            # Первая страница разобрана — источник отвечает, хеджирование не нужно
+            first_post.set()
+    except Exception as e:
+        if posts:
+            logger.warning(f"HTTP парсинг канала @{username} прерван после {len(posts)} постов: {e}")
+            return posts, None
+        logger.error(f"Ошибка при HTTP парсинге для канала @{username}: {e}")
+        return [], f"HTTP: {str(e)}"
+    if not posts:
+        return [], "HTTP: Не получены посты"
+    return posts, None
+
+
+async def _fetch_via_telethon(username: str, limit: int, first_post: asyncio.Event) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    # Telethon отдает посты одним ответом, поэтому first_post не используется
+    try:
+        posts, error = await get_telegram_posts_via_telethon(username, limit=limit)
+    except Exception as e:
+        logger.error(f"Непредвиденная ошибка при получении постов канала @{username} через Telethon: {e}")
+        return [], f"Ошибка Telethon: {str(e)}"
+    if error:
+        return [], f"Telethon: {error}"
+    if not posts:
+        return [], "Telethon: Не получены посты"
+    return posts, None
+
+
+# Одновременные запросы постов одного канала ждут одной загрузки
+_fetch_flight = SingleFlight("channel_fetch")
+
+_SOURCES = {
+    "http": _fetch_via_http,
+    "telethon": _fetch_via_telethon,
+}
+
+
+async def fetch_channel_posts(username: str, limit: int) -> Tuple[List[Dict[str, Any]], Optional[str], List[str]]:
+    """
+    Возвращает (посты, источник, ошибки). Одновременные запросы одного канала
+    (популярный канал анализируют десятки пользователей, повторная отправка формы)
+    выполняются одной загрузкой.
+    """
+    result, shared = await _fetch_flight.do(
+        f"{normalize_channel_username(username)}:{limit}", lambda: _fetch_channel_posts(username, limit)
+    )
+    if shared:
+        logger.info(f"Посты канала @{username} получены из уже выполнявшегося запроса")
+    posts, source, errors = result
+    return posts, source, list(errors)
+
+
+async def _fetch_channel_posts(username: str, limit: int) -> Tuple[List[Dict[str, Any]], Optional[str], List[str]]:
+    """
+    Первым запускается источник, который сработал
+    для канала в прошлый раз (по умолчанию HTTP); второй стартует, если первый не ответил
+    за CHANNEL_FETCH_HEDGE_DELAY секунд или вернул ошибку. Берется первый непустой результат,
+    оставшийся запрос отменяется. HTTP считается ответившим, как только разобрана первая
+    страница: догрузка остальных страниц запасной источник не запускает.
+    """
+    order = ["http", "telethon"] if telethon_gateway.configured else ["http"]
+    if remembered_source(username) == "telethon" and "telethon" in order:
+        order.reverse()
+
+    tasks: Dict[asyncio.Task, str] = {}
+    errors: List[str] = []
+    first_post = asyncio.Event()
+
+    def _start(source: str):
+        logger.info(f"Пытаемся получить посты канала @{username} через {source}")
+        tasks[asyncio.create_task(_SOURCES[source](username, limit, first_post))] = source
+
+    _start(order.pop(0))
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(
+                tasks.keys(),
+                timeout=CHANNEL_FETCH_HEDGE_DELAY if order and not first_post.is_set() else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done and first_post.is_set():
+                logger.info(f"Посты канала @{username} уже поступают, запасной источник не запускаем")
+                continue
+            if not done:
+                logger.info(f"Нет ответа за {CHANNEL_FETCH_HEDGE_DELAY} с, параллельно запускаем запасной источник для @{username}")
+                _start(order.pop(0))
+                continue
+            for task in done:
+                source = tasks.pop(task)
+                posts, error = task.result()
+                if posts:
+                    logger.info(f"Получено {len(posts)} постов канала @{username} через {source}")
+                    _remember_source(username, source)
+                    return posts, source, errors
+                logger.warning(f"Источник {source} не вернул постов для канала @{username}: {error}")
+                errors.append(error)
+            # Источник завершился без постов — запасной запускаем сразу, не дожидаясь задержки
+            while order:
+                _start(order.pop(0))
+    finally:
+        for task in tasks:
+            task.cancel()
+    return [], None, errors
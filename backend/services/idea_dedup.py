@@ -0,0 +1,164 @@
+# Локальный фильтр почти-дубликатов идей: MinHash-сигнатуры и LSH-индекс по сохраненным идеям канала
+import hashlib
+import os
+import random
+import re
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from backend.db import db
+from backend.main import logger
+from backend.services.analysis_cache import normalize_channel_username
+
+# Порог оценки сходства Жаккара по основам слов, начиная с которого идея считается повтором
+IDEA_DUP_THRESHOLD = float(os.getenv("IDEA_DUP_THRESHOLD", "0.5"))
+IDEA_INDEX_TTL = float(os.getenv("IDEA_INDEX_TTL", "600"))
+IDEA_INDEX_MAX_ENTRIES = int(os.getenv("IDEA_INDEX_MAX_ENTRIES", "2000"))
+
+# Сигнатура из MINHASH_PERMUTATIONS значений делится на полосы по LSH_BAND_ROWS для поиска кандидатов.
+# При изменении параметров сохраненные сигнатуры перестают совпадать по длине и пересчитываются из текста.
+MINHASH_PERMUTATIONS = 64
+LSH_BAND_ROWS = 2
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_PERMUTATIONS: List[Tuple[int, int]] = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(MINHASH_PERMUTATIONS)
+]
+
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+# Служебные слова не несут темы и только завышают сходство коротких формулировок
+_STOP_WORDS = frozenset(
+    "и в во на с со для как что по о об к из от до не это или а но у за при про без чем "
+    "ваш наш свой все всё так уже еще ещё".split()
+)
+# Длина основы: грубая замена стемминга, сводит вместе словоформы («маркетинг», «маркетинга»)
+_STEM_LENGTH = 5
+
+# (user_id, канал) -> (момент истечения по time.monotonic(), индекс)
+_idea_index_cache: "OrderedDict[Tuple[int, str], Tuple[float, IdeaIndex]]" = OrderedDict()
+
+
+def idea_tokens(text: str) -> Set[str]:
+    """Множество основ значимых слов идеи."""
+    words = _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    return {w[:_STEM_LENGTH] for w in words if len(w) > 2 and w not in _STOP_WORDS}
+
+
+def minhash_signature(text: str) -> List[int]:
+    """MinHash-сигнатура идеи; пустой список, если в тексте нет значимых слов."""
+    tokens = idea_tokens(text)
+    if not tokens:
+        return []
+    hashes = [int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "big") for t in tokens]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def estimated_similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    """Оценка сходства Жаккара по двум сигнатурам одинаковой длины."""
+    if not sig_a or len(sig_a) != len(sig_b):
+        return 0.0
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class IdeaIndex:
+    """LSH-индекс сигнатур: кандидаты ищутся по совпадающим полосам, затем проверяется оценка сходства."""
+
+    def __init__(self):
+        self._topics: List[str] = []
+        self._signatures: List[List[int]] = []
+        self._bands: Dict[Tuple[int, Tuple[int, ...]], List[int]] = defaultdict(list)
+
+    def __len__(self) -> int:
+        return len(self._topics)
+
+    @staticmethod
+    def _band_keys(signature: List[int]):
+        for start in range(0, len(signature), LSH_BAND_ROWS):
+            yield start, tuple(signature[start:start + LSH_BAND_ROWS])
+
+    def add(self, topic: str, signature: Optional[List[int]] = None):
+        if signature is None or len(signature) != MINHASH_PERMUTATIONS:
+            signature = minhash_signature(topic)
+        if not signature:
+            return
+        position = len(self._topics)
+        self._topics.append(topic)
+        self._signatures.append(signature)
+        for key in self._band_keys(signature):
+            self._bands[key].append(position)
+
+    def find_similar(self, signature: List[int], threshold: float = IDEA_DUP_THRESHOLD) -> Optional[str]:
+        """Ближайшая идея индекса со сходством не ниже порога или None."""
+        if not signature:
+            return None
+        candidates = {pos for key in self._band_keys(signature) for pos in self._bands.get(key, ())}
+        best_topic, best_score = None, threshold
+        for pos in candidates:
+            score = estimated_similarity(signature, self._signatures[pos])
+            if score >= best_score:
+                best_topic, best_score = self._topics[pos], score
+        return best_topic
+
+
+class PlanDeduplicator:
+    """Отбрасывает идеи плана, похожие на сохраненные идеи канала или на уже принятые идеи этого плана."""
+
+    def __init__(self, history: Optional[IdeaIndex] = None):
+        self.history = history or IdeaIndex()
+        self.accepted = IdeaIndex()
+
+    def accept(self, topic: str) -> bool:
+        signature = minhash_signature(topic)
+        similar = self.history.find_similar(signature) or self.accepted.find_similar(signature)
+        if similar:
+            logger.info(f"Идея '{topic}' отклонена как повтор '{similar}'")
+            return False
+        self.accepted.add(topic, signature)
+        return True
+
+
+def invalidate_idea_index(user_id: int, channel_name: Optional[str] = None):
+    """Сбрасывает индекс идей пользователя для канала (или для всех его каналов)."""
+    user_id = int(user_id)
+    if channel_name:
+        _idea_index_cache.pop((user_id, normalize_channel_username(channel_name)), None)
+        return
+    for key in [k for k in _idea_index_cache if k[0] == user_id]:
+        _idea_index_cache.pop(key, None)
+
+
+async def get_idea_index(user_id: int, channel_name: str) -> IdeaIndex:
+    """
+    Индекс сохраненных идей канала пользователя. Сигнатуры читаются из suggested_ideas.minhash
+    (для старых строк считаются по тексту); индекс кэшируется на IDEA_INDEX_TTL секунд.
+    При ошибке БД возвращается пустой индекс — фильтр тогда проверяет только повторы внутри плана.
+    """
+    user_id = int(user_id)
+    key = (user_id, normalize_channel_username(channel_name or ""))
+    now = time.monotonic()
+    cached = _idea_index_cache.get(key)
+    if cached and cached[0] > now:
+        _idea_index_cache.move_to_end(key)
+        return cached[1]
+
+    index = IdeaIndex()
+    if not db or not channel_name:
+        return index
+    try:
+        result = await db.table("suggested_ideas").select("topic_idea,minhash") \
+            .eq("user_id", user_id).eq("channel_name", channel_name).execute()
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить идеи канала @{channel_name} для фильтра повторов: {e}")
+        return index
+    for row in getattr(result, "data", None) or []:
+        if row.get("topic_idea"):
+            index.add(row["topic_idea"], row.get("minhash"))
+    logger.info(f"Индекс повторов для канала @{channel_name}: {len(index)} идей")
+    if IDEA_INDEX_TTL > 0:
+        _idea_index_cache[key] = (now + IDEA_INDEX_TTL, index)
+        _idea_index_cache.move_to_end(key)
+        while len(_idea_index_cache) > IDEA_INDEX_MAX_ENTRIES:
+            _idea_index_cache.popitem(last=False)
+    return index
@@ -1,51 +1,49 @@
 # Сервис для работы с идеями и генерацией плана
 from fastapi import Request, HTTPException
-from typing import Dict, Any, List, Optional
-from backend.main import supabase, logger, OPENROUTER_API_KEY, OPENAI_API_KEY
+from typing import Dict, Any, List, Optional, Tuple
+from backend.main import logger, OPENROUTER_API_KEY, OPENAI_API_KEY
+from backend.db import db
+from backend.schema_state import ensure_schema_verified
 from pydantic import BaseModel
+import asyncio
 import random
-import re
+import os
 import uuid
-from openai import AsyncOpenAI
+from backend.llm_gateway import complete as llm_complete, stream as llm_stream, LLMGatewayError, is_llm_configured, PROVIDER_ORDER
 from backend.services.supabase_subscription_service import SupabaseSubscriptionService
-from datetime import datetime
+from backend.sse import sse_event, sse_response
+from backend.text_cleanup import clean_text_formatting, clean_text_formatting_batch, clean_text_formatting_batch_async, strip_code_fence, strip_edge_quotes
+from backend.placeholder_detector import has_placeholder
+from backend.prompts import PLAN_JSON, PLAN_LINES, PromptTemplate
+from backend.services.idea_dedup import PlanDeduplicator, get_idea_index, invalidate_idea_index, minhash_signature
+from datetime import datetime, timezone
 import json
 
+# Дедлайн потоковой генерации плана (секунды): на 30 дней модель пишет заметно дольше
+PLAN_STREAM_DEADLINE = float(os.getenv("PLAN_STREAM_DEADLINE", "120"))
+# Длинные планы генерируются фрагментами по PLAN_CHUNK_DAYS дней, не более PLAN_CHUNK_CONCURRENCY одновременно
+PLAN_CHUNK_DAYS = int(os.getenv("PLAN_CHUNK_DAYS", "7"))
+PLAN_CHUNK_CONCURRENCY = int(os.getenv("PLAN_CHUNK_CONCURRENCY", "3"))
+PLAN_TOKENS_PER_DAY = 150
+
 # Импорт моделей PlanItem, PlanGenerationResponse, SuggestedIdeasResponse, SaveIdeasRequest из main.py или отдельного файла моделей
 # from backend.models import PlanItem, PlanGenerationResponse, SuggestedIdeasResponse, SaveIdeasRequest
 
-# Функция очистки форматирования (можно вынести в utils)
-def clean_text_formatting(text):
-    if not text:
-        return ""
-    text = re.sub(r'#{1,6}\s*\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?', '', text)
-    text = re.sub(r'^(?:\*?\*?(?:[Дд]ень|ДЕНЬ)?\s*\d+\s*(?:[Дд]ень|ДЕНЬ)?\*?\*?)', '', text)
-    text = re.sub(r'\*\*|\*|__|_|#{1,6}', '', text)
-    text = text.strip()
-    if text and len(text) > 0:
-        text = text[0].upper() + text[1:] if len(text) > 1 else text.upper()
-    return text
-
 def parse_plan_response(plan_text, styles, period_days):
     plan_items = []
     expected_style_set = set(s.lower() for s in styles)
     # 1. Попытка распарсить как JSON
     try:
-        plan_text_clean = plan_text.strip()
-        if plan_text_clean.startswith('```json'):
-            plan_text_clean = plan_text_clean[7:]
-        if plan_text_clean.endswith('```'):
-            plan_text_clean = plan_text_clean[:-3]
-        plan_text_clean = plan_text_clean.strip()
-        plan_json = json.loads(plan_text_clean)
+        plan_json = json.loads(strip_code_fence(plan_text.strip()).strip())
         if isinstance(plan_json, dict):
             plan_json = [plan_json]
-        for item in plan_json:
+        # Темы и стили всего плана очищаются одним пакетом
+        topics = clean_text_formatting_batch(item.get("topic_idea", "") for item in plan_json)
+        formats = clean_text_formatting_batch(item.get("format_style", "") for item in plan_json)
+        for item, topic_idea, format_style in zip(plan_json, topics, formats):
             day = int(item.get("day", 0))
-            topic_idea = clean_text_formatting(item.get("topic_idea", ""))
-            format_style = clean_text_formatting(item.get("format_style", ""))
-            # Фильтрация плейсхолдеров
-            if not topic_idea or re.search(r"\[.*\]", topic_idea):
+            # Идеи с плейсхолдерами отбрасываются, их дни перегенерируются
+            if not topic_idea or has_placeholder(topic_idea):
                 continue
             if format_style.lower() not in expected_style_set:
                 format_style = random.choice(styles)
@@ -59,33 +57,98 @@ def parse_plan_response(plan_text, styles, period_days):
     except Exception as e:
         logger.info(f"Ответ не является валидным JSON: {e}")
     # 2. Парсинг по строкам с разделителем ::
-    lines = plan_text.split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        parts = line.split('::')
-        if len(parts) == 3:
-            try:
-                day_part = parts[0].lower().replace('день', '').strip()
-                day = int(day_part)
-                topic_idea = clean_text_formatting(parts[1].strip())
-                format_style = clean_text_formatting(parts[2].strip())
-                if not topic_idea or re.search(r"\[.*\]", topic_idea):
-                    continue
-                if format_style.lower() not in expected_style_set:
-                    format_style = random.choice(styles)
-                plan_items.append({
-                    "day": day,
-                    "topic_idea": topic_idea,
-                    "format_style": format_style
-                })
-            except Exception as parse_err:
-                logger.warning(f"Ошибка парсинга строки плана '{line}': {parse_err}")
-        else:
-            logger.warning(f"Строка плана не соответствует формату 'День X:: Тема:: Стиль': {line}")
+    for line in plan_text.split('\n'):
+        item = parse_plan_line(line, styles, expected_style_set)
+        if item:
+            plan_items.append(item)
     return plan_items
 
+def parse_plan_line(line, styles, expected_style_set=None):
+    """Разбирает одну строку 'День X:: Тема:: Стиль'. Возвращает идею или None."""
+    if expected_style_set is None:
+        expected_style_set = set(s.lower() for s in styles)
+    line = line.strip()
+    if not line:
+        return None
+    parts = line.split('::')
+    if len(parts) != 3:
+        logger.warning(f"Строка плана не соответствует формату 'День X:: Тема:: Стиль': {line}")
+        return None
+    try:
+        day_part = parts[0].lower().replace('день', '').strip()
+        day = int(day_part)
+        topic_idea = clean_text_formatting(parts[1].strip())
+        format_style = clean_text_formatting(parts[2].strip())
+        if not topic_idea or has_placeholder(topic_idea):
+            return None
+        if format_style.lower() not in expected_style_set:
+            format_style = random.choice(styles)
+        return {
+            "day": day,
+            "topic_idea": topic_idea,
+            "format_style": format_style
+        }
+    except Exception as parse_err:
+        logger.warning(f"Ошибка парсинга строки плана '{line}': {parse_err}")
+        return None
+
+def fallback_plan_item(day, themes, styles):
+    """Базовая идея на день, если модель ее не выдала."""
+    random_theme = random.choice(themes) if themes else "Общая тема"
+    random_style = random.choice(styles) if styles else "Общий стиль"
+    return {
+        "day": day,
+        "topic_idea": f"Пост о {random_theme}",
+        "format_style": random_style
+    }
+
+class PlanStreamParser:
+    """
+    Инкрементальный разбор плана: принимает фрагменты текста по мере генерации
+    и возвращает идеи, как только приходит законченная строка. Пропущенные дни
+    обнаруживаются сразу, как только модель выдала идею на более поздний день.
+    """
+
+    def __init__(self, styles, period_days):
+        self.styles = styles
+        self.period_days = period_days
+        self.items: Dict[int, Dict[str, Any]] = {}
+        self._expected_style_set = set(s.lower() for s in styles)
+        self._buffer = ""
+        self._reported_missing = set()
+
+    def feed(self, delta: str) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """Возвращает (новые идеи, новые пропущенные дни)."""
+        self._buffer += delta
+        *lines, self._buffer = self._buffer.split("\n")
+        return self._consume(lines)
+
+    def finish(self) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """Разбирает остаток буфера (последняя строка может прийти без перевода строки)."""
+        lines, self._buffer = [self._buffer], ""
+        return self._consume(lines)
+
+    def missing_days(self) -> List[int]:
+        return [day for day in range(1, self.period_days + 1) if day not in self.items]
+
+    def unreported_missing_days(self) -> List[int]:
+        """Пропущенные дни, о которых еще не сообщалось (обычно хвост плана после обрыва генерации)."""
+        return [day for day in self.missing_days() if day not in self._reported_missing]
+
+    def _consume(self, lines):
+        new_items = []
+        for line in lines:
+            item = parse_plan_line(line, self.styles, self._expected_style_set)
+            if not item or not 1 <= item["day"] <= self.period_days or item["day"] in self.items:
+                continue
+            self.items[item["day"]] = item
+            new_items.append(item)
+        if not self.items:
+            return new_items, []
+        gaps = [day for day in range(1, max(self.items)) if day not in self.items and day not in self._reported_missing]
+        self._reported_missing.update(gaps)
+        return new_items, gaps
+
 async def get_saved_ideas(request: Request, channel_name: Optional[str] = None):
     try:
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
@@ -97,18 +160,21 @@ async def get_saved_ideas(request: Request, channel_name: Optional[str] = None):
         except (ValueError, TypeError):
             logger.error(f"Некорректный ID пользователя в заголовке: {telegram_user_id}")
             return {"message": "Некорректный ID пользователя", "ideas": []}
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             return {"message": "Ошибка: не удалось подключиться к базе данных", "ideas": []}
-        query = supabase.table("suggested_ideas").select("*").eq("user_id", telegram_user_id)
+        query = db.table("suggested_ideas").select("*").eq("user_id", telegram_user_id)
         if channel_name:
             query = query.eq("channel_name", channel_name)
-        result = query.order("created_at", desc=True).execute()
+        result = await query.order("created_at", desc=True).execute()
         if not hasattr(result, 'data'):
             logger.error(f"Ошибка при получении идей из БД: {result}")
             return {"message": "Не удалось получить сохраненные идеи", "ideas": []}
         ideas = []
         for item in result.data:
+            # Идеи прошлых планов хранятся только для фильтра повторов
+            if item.get("superseded_at"):
+                continue
             idea = {
                 "id": item.get("id"),
                 "channel_name": item.get("channel_name"),
@@ -128,7 +194,117 @@ async def get_saved_ideas(request: Request, channel_name: Optional[str] = None):
         logger.error(f"Ошибка при получении идей: {e}")
         return {"message": f"Ошибка при получении идей: {str(e)}", "ideas": []}
 
+async def _plan_deduplicator(telegram_user_id: str, channel_name: str) -> PlanDeduplicator:
+    """Фильтр повторов для нового плана: индекс сохраненных идей канала вместо истории в промпте."""
+    try:
+        history = await get_idea_index(int(telegram_user_id), channel_name)
+    except Exception as e:
+        logger.warning(f"Не удалось получить индекс идей канала {channel_name}: {e}")
+        history = None
+    return PlanDeduplicator(history)
+
+def _plan_fields(channel_name: Optional[str], themes: List[str], styles: List[str], period_days: int) -> Dict[str, Any]:
+    """Данные канала для шаблонов плана (дописываются после статичного префикса промпта)."""
+    return {
+        "channel_name": channel_name or "",
+        "themes": ", ".join(themes[:5]),
+        "styles": ", ".join(styles[:5]),
+        "period_days": period_days,
+    }
+
+def _days_label(days: List[int]) -> str:
+    """'8-14' для сплошного диапазона дней, иначе список через запятую."""
+    if len(days) > 2 and days == list(range(days[0], days[-1] + 1)):
+        return f"{days[0]}-{days[-1]}"
+    return ", ".join(map(str, days))
+
+def _plan_chunks(period_days: int, chunk_days: int) -> List[Tuple[int, int]]:
+    """Разбивает период на диапазоны дней [(1, 7), (8, 14), ...]."""
+    chunk_days = max(1, chunk_days)
+    return [(start, min(start + chunk_days - 1, period_days)) for start in range(1, period_days + 1, chunk_days)]
+
+def _clean_plan_text(plan_text: str) -> str:
+    # Удаляем обёртку ```json ... ``` если есть
+    if plan_text.startswith('```json'):
+        plan_text = plan_text[7:]
+    if plan_text.endswith('```'):
+        plan_text = plan_text[:-3]
+    plan_text = plan_text.strip()
+    # Удаляем кавычки по краям, если они есть
+    plan_text = strip_edge_quotes(plan_text)
+    # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
+    for unwanted in ["Ты — опытный контент-маркетолог", "Создай план публикаций", "В ответе выдай только"]:
+        if plan_text.lower().startswith(unwanted.lower()):
+            plan_text = plan_text.split("\n", 1)[-1].strip()
+    return plan_text
+
+async def _generate_plan_chunk(plan_fields: Dict[str, Any], start_day: int, end_day: int,
+                               styles: List[str], produced_topics: List[str]):
+    """
+    Генерирует идеи на дни start_day..end_day. Возвращает (идеи, completion);
+    при ошибке LLM — ([], None), недостающие дни заполняет вызывающий код.
+    """
+    days_count = end_day - start_day + 1
+    messages = PLAN_JSON.render(
+        **plan_fields,
+        produced_topics="; ".join(produced_topics),
+        days_count=days_count,
+        days=_days_label(list(range(start_day, end_day + 1))),
+    )
+    try:
+        completion = await llm_complete(
+            messages,
+            temperature=0.7,
+            max_tokens=max(1200, PLAN_TOKENS_PER_DAY * days_count),
+            deadline=60,
+            template=PLAN_JSON.id,
+        )
+    except LLMGatewayError as api_error:
+        logger.error(f"Ошибка при генерации плана на дни {start_day}-{end_day} через LLM-шлюз: {api_error}")
+        return [], None
+    plan_text = _clean_plan_text(completion.text)
+    logger.info(f"Получен ответ с планом на дни {start_day}-{end_day} через {completion.provider} (первые 100 символов): {plan_text[:100]}...")
+    items = parse_plan_response(plan_text, styles, days_count)
+    # Модель могла пронумеровать дни фрагмента с единицы
+    if start_day > 1 and items and all(1 <= item["day"] <= days_count for item in items) \
+            and not any(start_day <= item["day"] <= end_day for item in items):
+        for item in items:
+            item["day"] += start_day - 1
+    chunk_items: Dict[int, Dict[str, Any]] = {}
+    for item in items:
+        if start_day <= item["day"] <= end_day:
+            chunk_items.setdefault(item["day"], item)
+    return list(chunk_items.values()), completion
+
+async def _regenerate_plan_days(template: PromptTemplate, plan_fields: Dict[str, Any], days: List[int],
+                                rejected_topics: List[str], styles: List[str]) -> List[Dict[str, Any]]:
+    """Повторная генерация идей только на дни days: пропущенные, с плейсхолдерами или отклоненные как повторы."""
+    messages = template.render(
+        **plan_fields,
+        rejected_topics="; ".join(rejected_topics),
+        days_count=len(days),
+        days=_days_label(days),
+    )
+    try:
+        completion = await llm_complete(
+            messages,
+            temperature=0.9,
+            max_tokens=max(400, PLAN_TOKENS_PER_DAY * len(days)),
+            deadline=60,
+            template=template.id,
+        )
+    except LLMGatewayError as api_error:
+        logger.error(f"Ошибка при повторной генерации идей на дни {days} через LLM-шлюз: {api_error}")
+        return []
+    wanted = set(days)
+    items: Dict[int, Dict[str, Any]] = {}
+    for item in parse_plan_response(_clean_plan_text(completion.text), styles, len(days)):
+        if item["day"] in wanted:
+            items.setdefault(item["day"], item)
+    return list(items.values())
+
 async def generate_content_plan(request: Request, req):
+    quota = None
     try:
         used_backup_api = False
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
@@ -136,11 +312,11 @@ async def generate_content_plan(request: Request, req):
             logger.warning("Запрос генерации плана без идентификации пользователя Telegram")
             return {"message": "Для генерации плана необходимо авторизоваться через Telegram", "plan": []}
         # Проверка лимита генерации идей
-        subscription_service = SupabaseSubscriptionService(supabase)
-        can_generate = await subscription_service.can_generate_idea(int(telegram_user_id))
-        if not can_generate:
-            usage = await subscription_service.get_user_usage(int(telegram_user_id))
-            reset_at = usage.get("reset_at")
+        subscription_service = SupabaseSubscriptionService(db)
+        # Сброс, проверка и списание лимита — один запрос к БД
+        quota = await subscription_service.consume_quota(int(telegram_user_id), "idea")
+        if not quota.get("allowed"):
+            reset_at = quota.get("reset_at")
             return {
                 "plan": [],
                 "message": f"Достигнут лимит в 3 генерации идей для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.",
@@ -154,143 +330,207 @@ async def generate_content_plan(request: Request, req):
         channel_name = req.channel_name
         if not themes or not styles:
             logger.warning(f"Запрос с пустыми темами или стилями: themes={themes}, styles={styles}")
+            if quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "idea")
             return {"message": "Необходимо указать темы и стили для генерации плана", "plan": []}
         
         # Тестовые данные, которые добавил ChatGPT
         logger.info(f"Запрос генерации плана контента от пользователя {telegram_user_id} для канала {channel_name}")
         
-        # Получаем существующие идеи канала для анализа предыдущего контента
-        existing_ideas = []
-        try:
-            saved_ideas_response = await get_saved_ideas(request, channel_name)
-            if saved_ideas_response and "ideas" in saved_ideas_response:
-                existing_ideas = saved_ideas_response["ideas"][:10]  # Берем последние 10 идей
-                logger.info(f"Найдено {len(existing_ideas)} существующих идей для анализа разнообразия")
-        except Exception as e:
-            logger.warning(f"Не удалось получить существующие идеи для анализа: {e}")
-        
-        # Готовим промпт для генерации плана
-        system_prompt = """Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — создать план публикаций на определенный период, учитывая темы и форматы канала. 
-
-ВАЖНО: Создавай разнообразный контент, избегая зацикливания на одних и тех же темах. Обеспечь баланс между:
-1. Развитием уже затронутых тем (углубление, новые аспекты, продолжение)
-2. Введением свежих идей в рамках тематики канала
-3. Логическим продолжением предыдущих постов
-4. Избеганием прямого повторения уже использованных идей
-
-В ответе выдай только JSON-план, без пояснений, без повторения инструкции, только сам план."""
-        
-        # Формируем базовый user_prompt
-        user_prompt = f"Создай план публикаций для Telegram-канала тематики: {', '.join(themes[:5])} на {period_days} дней. Вот список возможных форматов постов: {', '.join(styles[:5])}\n"
+        # Повторы сохраненных идей отсеиваются локально, без передачи истории в промпт
+        dedup = await _plan_deduplicator(telegram_user_id, channel_name)
         
-        # Добавляем информацию о существующих идеях, если они есть
-        if existing_ideas:
-            existing_topics = [idea.get("topic_idea", "") for idea in existing_ideas if idea.get("topic_idea")]
-            if existing_topics:
-                user_prompt += f"\nРанее для канала использовались идеи: {'; '.join(existing_topics[:8])}\n"
-                user_prompt += "ОБЯЗАТЕЛЬНО учти это при создании нового плана: НЕ повторяй эти идеи точно, но можешь развивать их под новыми углами, создавать логическое продолжение или затрагивать смежные аспекты. Также добавь совершенно новые идеи в рамках тематики канала.\n"
+        # Статичные инструкции — в шаблоне PLAN_JSON, данные канала и диапазон дней добавляются в конец промпта
+        plan_fields = _plan_fields(channel_name, themes, styles, period_days)
         
-        user_prompt += f"Создай план в формате JSON: [{{'day': 1, 'topic_idea': '...', 'format_style': '...'}}, ...] Необходимо создать {period_days} идей для постов - по одной на каждый день. В ответе выдай только JSON-план, без пояснений, без повторения инструкции, только сам план."
-        
-        if OPENROUTER_API_KEY:
-            try:
-                logger.info(f"Отправка запроса на генерацию плана через OpenRouter API для канала {channel_name}")
-                client = AsyncOpenAI(
-                    base_url="https://openrouter.ai/api/v1",
-                    api_key=OPENROUTER_API_KEY
-                )
-                # --- Новый блок: расчет средней длины постов ---
-                avg_length = 0
-                post_samples = req.get("post_samples") or req.post_samples if hasattr(req, "post_samples") else None
-                if post_samples:
-                    avg_length = int(sum(len(t) for t in post_samples) / len(post_samples))
-                    avg_tokens = max(100, min(1200, avg_length // 3))
-                else:
-                    avg_tokens = 1200
-                response = await client.chat.completions.create(
-                            model="google/gemini-2.5-flash-preview",
-                    messages=[
-                                {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.7,
-                            max_tokens=avg_tokens,
-                            timeout=60,
-                    extra_headers={
-                        "HTTP-Referer": "https://content-manager.onrender.com",
-                        "X-Title": "Smart Content Assistant"
-                    }
-                )
-                if response and response.choices and len(response.choices) > 0 and response.choices[0].message and response.choices[0].message.content:
-                    plan_text = response.choices[0].message.content.strip()
-                    # Удаляем обёртку ```json ... ``` если есть
-                    if plan_text.startswith('```json'):
-                        plan_text = plan_text[7:]
-                    if plan_text.endswith('```'):
-                        plan_text = plan_text[:-3]
-                    plan_text = plan_text.strip()
-                    # Удаляем кавычки по краям, если они есть
-                    plan_text = re.sub(r'^[\"“"«»\']+|[\"""«»\']+$', '', plan_text).strip()
-                    # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
-                    for unwanted in ["Ты — опытный контент-маркетолог", "Создай план публикаций", "В ответе выдай только"]:
-                        if plan_text.lower().startswith(unwanted.lower()):
-                            plan_text = plan_text.split("\n", 1)[-1].strip()
-                    logger.info(f"Получен ответ с планом публикаций через OpenRouter API (первые 100 символов): {plan_text[:100]}...")
-                elif response and hasattr(response, 'error') and response.error:
-                    err_details = response.error
-                    api_error_message = getattr(err_details, 'message', str(err_details))
-                    logger.error(f"OpenRouter API вернул ошибку: {api_error_message}")
-                    raise Exception(f"OpenRouter API вернул ошибку: {api_error_message}")
-            except Exception as log_err:
-                logger.error(f"Не удалось залогировать тело ответа API: {log_err}")
-                raise Exception("Некорректный или пустой ответ от OpenRouter API")
-        else:
+        if not is_llm_configured():
             logger.error("Отсутствуют API ключи для генерации плана (OPENROUTER_API_KEY и OPENAI_API_KEY)")
+            if quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "idea")
             return {
                 "plan": [],
                 "message": "API для генерации плана недоступны.",
                 "limit_reached": False
             }
         
-        # Обработка полученного текста плана
-        plan_items = parse_plan_response(plan_text, styles, period_days)
+        # Длинный период делится на фрагменты по PLAN_CHUNK_DAYS дней, которые генерируются параллельно
+        chunks = _plan_chunks(period_days, PLAN_CHUNK_DAYS)
+        logger.info(f"Отправка запроса на генерацию плана через LLM-шлюз для канала {channel_name}: {len(chunks)} фрагмент(ов)")
+        semaphore = asyncio.Semaphore(PLAN_CHUNK_CONCURRENCY)
+        produced_topics: List[str] = []
+
+        async def run_chunk(start_day: int, end_day: int):
+            async with semaphore:
+                # Фрагмент видит идеи, уже готовые к моменту его запуска
+                items, completion = await _generate_plan_chunk(
+                    plan_fields, start_day, end_day, styles, list(produced_topics)
+                )
+            produced_topics.extend(item["topic_idea"] for item in items)
+            return items, completion
+
+        chunk_results = await asyncio.gather(*(run_chunk(start_day, end_day) for start_day, end_day in chunks))
+        completions = [completion for _, completion in chunk_results if completion is not None]
+        if not completions:
+            raise Exception("Некорректный или пустой ответ от API при генерации всех фрагментов плана")
+        used_backup_api = any(completion.used_fallback for completion in completions)
+        
+        # Объединяем фрагменты по дням
+        plan_by_day: Dict[int, Dict[str, Any]] = {}
+        for items, _ in chunk_results:
+            for item in items:
+                plan_by_day.setdefault(item["day"], item)
         
-        # Если не удалось извлечь идеи — генерируем базовый план вручную
-        if not plan_items:
-            logger.warning("Не удалось извлечь идеи из ответа LLM или все строки были некорректными, генерируем базовый план.")
-            for day in range(1, period_days + 1):
-                random_theme = random.choice(themes) if themes else "Общая тема"
-                random_style = random.choice(styles) if styles else "Общий стиль"
-                plan_items.append({
-                    "day": day,
-                    "topic_idea": f"Пост о {random_theme}",
-                    "format_style": random_style
-                })
+        # Повторы уже сохраненных идей и идей этого же плана отклоняются
+        rejected: Dict[int, Dict[str, Any]] = {}
+        for day in sorted(plan_by_day):
+            if not dedup.accept(plan_by_day[day]["topic_idea"]):
+                rejected[day] = plan_by_day.pop(day)
+        # Повторы и дни без идеи (пропущенные моделью или отброшенные из-за плейсхолдеров)
+        # перегенерируются одним запросом только на эти дни
+        retry_days = [day for day in range(1, period_days + 1) if day not in plan_by_day]
+        if retry_days:
+            logger.info(f"Перегенерируем идеи на дни {retry_days} (повторы: {sorted(rejected)})")
+            rejected_topics = [item["topic_idea"] for item in rejected.values()]
+            for item in await _regenerate_plan_days(PLAN_JSON, plan_fields, retry_days, rejected_topics, styles):
+                if dedup.accept(item["topic_idea"]):
+                    plan_by_day[item["day"]] = item
         
-        # Сортируем по дням и обрезаем до нужного количества
-        plan_items.sort(key=lambda x: x["day"])
-        plan_items = plan_items[:period_days]
+        # Дни, которые не удалось получить и повторно, заполняем базовыми идеями
+        missing_days = [day for day in range(1, period_days + 1) if day not in plan_by_day]
+        if missing_days:
+            logger.warning(f"Не удалось получить идеи на дни {missing_days}, используем базовые идеи")
+            for day in missing_days:
+                plan_by_day[day] = fallback_plan_item(day, themes, styles)
+        plan_items = [plan_by_day[day] for day in sorted(plan_by_day)]
         
         # Формируем сообщение с учетом использования запасного API
         result_message = None
         if used_backup_api:
             result_message = "План сгенерирован с использованием резервного API (OpenAI)"
         
-        # После успешной генерации идей увеличиваем счетчик использования
-        
-            await subscription_service.increment_idea_usage(int(telegram_user_id))
         return {"plan": plan_items, "message": result_message}
     except Exception as e:
         logger.error(f"Ошибка при генерации плана: {e}")
+        if quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "idea")
         return {"plan": [], "message": f"Ошибка при генерации плана: {str(e)}"}
 
+async def generate_content_plan_stream(request: Request, req):
+    """
+    Потоковая генерация плана (Server-Sent Events). Модель пишет строки 'День N:: идея:: стиль',
+    каждая разобранная строка сразу уходит клиенту событием item (PlanItem).
+    События: item — идея на день, missing — дни, пропущенные моделью (обнаруживаются по ходу
+    генерации), error — ошибка генерации, done — завершение. Пропущенные дни в конце
+    заполняются базовыми идеями.
+    """
+    from backend.main import PlanItem
+    telegram_user_id = request.headers.get("X-Telegram-User-Id")
+    if not telegram_user_id:
+        logger.warning("Запрос потоковой генерации плана без идентификации пользователя Telegram")
+        raise HTTPException(status_code=401, detail="Для генерации плана необходимо авторизоваться через Telegram")
+    themes = req.themes
+    styles = req.styles
+    period_days = req.period_days
+    channel_name = req.channel_name
+    if not themes or not styles:
+        raise HTTPException(status_code=400, detail="Необходимо указать темы и стили для генерации плана")
+    if not is_llm_configured():
+        logger.error("Отсутствуют API ключи для генерации плана (OPENROUTER_API_KEY и OPENAI_API_KEY)")
+        raise HTTPException(status_code=503, detail="API для генерации плана недоступны.")
+    subscription_service = SupabaseSubscriptionService(db)
+    # Лимит списывается до начала потока, чтобы отказ пришел обычным HTTP ответом
+    quota = await subscription_service.consume_quota(int(telegram_user_id), "idea")
+    if not quota.get("allowed"):
+        reset_at = quota.get("reset_at")
+        raise HTTPException(status_code=403, detail=f"Достигнут лимит в 3 генерации идей для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.")
+    logger.info(f"Запрос потоковой генерации плана от пользователя {telegram_user_id} для канала {channel_name}")
+    dedup = await _plan_deduplicator(telegram_user_id, channel_name)
+
+    plan_fields = _plan_fields(channel_name, themes, styles, period_days)
+    messages = PLAN_LINES.render(**plan_fields, days_count=period_days, days=_days_label(list(range(1, period_days + 1))))
+
+    def plan_item_event(item: Dict[str, Any]) -> str:
+        return sse_event("item", PlanItem(**item).dict())
+
+    async def event_stream():
+        parser = PlanStreamParser(styles, period_days)
+        info: Dict[str, Any] = {}
+        # Идеи, отклоненные фильтром повторов: придерживаются и перегенерируются после потока
+        rejected: Dict[int, Dict[str, Any]] = {}
+        try:
+            try:
+                async for delta in llm_stream(
+                    messages,
+                    temperature=0.7,
+                    max_tokens=PLAN_TOKENS_PER_DAY * period_days,
+                    deadline=PLAN_STREAM_DEADLINE,
+                    info=info,
+                    template=PLAN_LINES.id,
+                ):
+                    items, missing = parser.feed(delta)
+                    for item in items:
+                        if dedup.accept(item["topic_idea"]):
+                            yield plan_item_event(item)
+                        else:
+                            rejected[item["day"]] = item
+                    if missing:
+                        yield sse_event("missing", {"days": missing})
+                items, missing = parser.finish()
+                for item in items:
+                    if dedup.accept(item["topic_idea"]):
+                        yield plan_item_event(item)
+                    else:
+                        rejected[item["day"]] = item
+                if missing:
+                    yield sse_event("missing", {"days": missing})
+            except LLMGatewayError as api_error:
+                logger.error(f"Ошибка при потоковой генерации плана через LLM-шлюз: {api_error}")
+                yield sse_event("error", {"message": f"Ошибка при генерации плана: {str(api_error)}"})
+            generated = bool(parser.items)
+            logger.info(f"Потоковая генерация плана через {info.get('provider')}: получено {len(parser.items)} из {period_days} идей")
+
+            # Дни, которые модель пропустила, не успела выдать или выдала с плейсхолдерами
+            missing_days = parser.missing_days() if generated else []
+            tail_days = parser.unreported_missing_days() if generated else []
+            if tail_days:
+                yield sse_event("missing", {"days": tail_days})
+
+            # Пропущенные дни и повторы перегенерируются одним запросом только на эти дни,
+            # неудачные заменяются базовыми идеями
+            retry_days = sorted(set(missing_days) | set(rejected))
+            filled_days = []
+            if retry_days:
+                logger.info(f"Перегенерируем идеи на дни {retry_days} (повторы: {sorted(rejected)})")
+                rejected_topics = [item["topic_idea"] for item in rejected.values()]
+                replaced = set()
+                for item in await _regenerate_plan_days(PLAN_LINES, plan_fields, retry_days, rejected_topics, styles):
+                    if dedup.accept(item["topic_idea"]):
+                        replaced.add(item["day"])
+                        yield plan_item_event(item)
+                filled_days = [day for day in retry_days if day not in replaced]
+                for day in filled_days:
+                    yield plan_item_event(fallback_plan_item(day, themes, styles))
+
+            message = None
+            if not generated:
+                message = "Не удалось сгенерировать план."
+            elif info.get("provider") not in (None, PROVIDER_ORDER[0]):
+                message = "План сгенерирован с использованием резервного API (OpenAI)"
+            yield sse_event("done", {"count": len(parser.items), "filled_days": filled_days, "message": message})
+        finally:
+            # Ничего не сгенерировано или клиент отключился до первой идеи — возвращаем лимит
+            if not parser.items and quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "idea")
+
+    return sse_response(event_stream())
+
 async def save_suggested_idea(idea_data: Dict[str, Any], request: Request):
     try:
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if not telegram_user_id:
             logger.warning("Запрос сохранения идеи без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для сохранения идеи необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         idea_to_save = idea_data.copy()
@@ -301,9 +541,11 @@ async def save_suggested_idea(idea_data: Dict[str, Any], request: Request):
         # Удаляем поле isNew, если оно есть
         if "isNew" in idea_to_save:
             del idea_to_save["isNew"]
-        result = supabase.table("suggested_ideas").insert(idea_to_save).execute()
+        idea_to_save["minhash"] = minhash_signature(idea_to_save.get("topic_idea", ""))
+        result = await db.table("suggested_ideas").insert(idea_to_save).execute()
         if hasattr(result, 'data') and len(result.data) > 0:
             logger.info(f"Сохранена новая идея для пользователя {telegram_user_id}")
+            invalidate_idea_index(int(telegram_user_id), idea_to_save.get("channel_name"))
             return {"success": True, "id": idea_to_save["id"]}
         else:
             logger.error(f"Ошибка при сохранении идеи: {result}")
@@ -312,6 +554,30 @@ async def save_suggested_idea(idea_data: Dict[str, Any], request: Request):
         logger.error(f"Ошибка при сохранении идеи: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении идеи: {str(e)}")
 
+async def _supersede_channel_ideas(telegram_user_id: int, channel_name: str):
+    """
+    Помечает текущие идеи канала как замененные новым планом (superseded_at). Пока миграция 012
+    не применена, колонки нет — тогда старые идеи удаляются, как раньше.
+    """
+    try:
+        result = await db.table("suggested_ideas")\
+            .update({"superseded_at": datetime.now(timezone.utc).isoformat()})\
+            .eq("user_id", int(telegram_user_id))\
+            .eq("channel_name", channel_name)\
+            .is_("superseded_at", "null")\
+            .execute()
+        logger.info(f"Скрыто {len(result.data or [])} старых идей для канала {channel_name}, они остаются в истории")
+        return
+    except Exception as e:
+        logger.warning(f"Не удалось пометить старые идеи канала {channel_name} замененными ({e}), удаляем их")
+    delete_result = await db.table("suggested_ideas")\
+        .delete()\
+        .eq("user_id", int(telegram_user_id))\
+        .eq("channel_name", channel_name)\
+        .execute()
+    logger.info(f"Удалено {len(delete_result.data)} старых идей для канала {channel_name}")
+
+
 async def save_suggested_ideas_batch(payload, request: Request):
     telegram_user_id = request.headers.get("X-Telegram-User-Id")
     if not telegram_user_id:
@@ -322,16 +588,15 @@ async def save_suggested_ideas_batch(payload, request: Request):
     except (ValueError, TypeError):
         logger.error(f"Некорректный ID пользователя в заголовке: {telegram_user_id}")
         raise HTTPException(status_code=400, detail="Некорректный формат ID пользователя")
-    if not supabase:
+    if not db:
         logger.error("Supabase client not initialized")
         raise HTTPException(status_code=500, detail="Database not initialized")
         
-    # Добавляем проверку лимита генерации идей
-    subscription_service = SupabaseSubscriptionService(supabase)
-    can_generate = await subscription_service.can_generate_idea(telegram_user_id)
-    if not can_generate:
-        usage = await subscription_service.get_user_usage(telegram_user_id)
-        reset_at = usage.get("reset_at")
+    # Проверка лимита генерации идей без списания — один запрос к БД
+    subscription_service = SupabaseSubscriptionService(db)
+    quota = await subscription_service.peek_quota(telegram_user_id, "idea")
+    if not quota.get("allowed"):
+        reset_at = quota.get("reset_at")
         raise HTTPException(
             status_code=403, 
             detail={
@@ -348,38 +613,22 @@ async def save_suggested_ideas_batch(payload, request: Request):
     ideas_to_save = payload.ideas
     channel_name = payload.channel_name
     logger.info(f"Получен запрос на сохранение {len(ideas_to_save)} идей для канала {channel_name}")
-    # --- НАЧАЛО: Удаление старых идей для этого канала перед сохранением новых --- 
+    # Старые идеи канала скрываются из списка, но остаются в истории для фильтра повторов
     if channel_name:
         try:
-            delete_result = supabase.table("suggested_ideas")\
-                .delete()\
-                .eq("user_id", int(telegram_user_id))\
-                .eq("channel_name", channel_name)\
-                .execute()
-            logger.info(f"Удалено {len(delete_result.data)} старых идей для канала {channel_name}")
+            await _supersede_channel_ideas(telegram_user_id, channel_name)
         except Exception as del_err:
-            logger.error(f"Ошибка при удалении старых идей для канала {channel_name}: {del_err}")
+            logger.error(f"Ошибка при скрытии старых идей для канала {channel_name}: {del_err}")
             errors.append(f"Ошибка удаления старых идей: {str(del_err)}")
-    # --- КОНЕЦ: Удаление старых идей --- 
-    # --- ДОБАВЛЕНО: Вызов fix_schema перед вставкой --- 
-    try:
-        logger.info("Вызов fix_schema непосредственно перед сохранением идей...")
-        from backend.main import fix_schema
-        fix_result = await fix_schema()
-        if not fix_result.get("success"):
-            logger.warning(f"Не удалось обновить/проверить схему перед сохранением идей: {fix_result}")
-            errors.append("Предупреждение: не удалось проверить/обновить схему перед сохранением.")
-        else:
-            logger.info("Проверка/обновление схемы перед сохранением идей завершена успешно.")
-    except Exception as pre_save_fix_err:
-        logger.error(f"Ошибка при вызове fix_schema перед сохранением идей: {pre_save_fix_err}", exc_info=True)
-        errors.append(f"Ошибка проверки схемы перед сохранением: {str(pre_save_fix_err)}")
-    # --- КОНЕЦ ДОБАВЛЕНИЯ ---
+    # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+    if not await ensure_schema_verified():
+        logger.warning("Схема БД не сверена перед сохранением идей")
+        errors.append("Предупреждение: не удалось проверить/обновить схему перед сохранением.")
     records_to_insert = []
-    for idea_data in ideas_to_save:
+    topics = await clean_text_formatting_batch_async([idea_data.get("topic_idea", "") for idea_data in ideas_to_save])
+    formats = await clean_text_formatting_batch_async([idea_data.get("format_style", "") for idea_data in ideas_to_save])
+    for idea_data, topic_idea, format_style in zip(ideas_to_save, topics, formats):
         try:
-            topic_idea = clean_text_formatting(idea_data.get("topic_idea", ""))
-            format_style = clean_text_formatting(idea_data.get("format_style", ""))
             if not topic_idea or not format_style:
                 continue
             idea_id = str(uuid.uuid4())
@@ -395,6 +644,7 @@ async def save_suggested_ideas_batch(payload, request: Request):
                 "relative_day": relative_day,
                 "created_at": datetime.now().isoformat(),
                 "is_detailed": bool(idea_data.get("is_detailed", False)),
+                "minhash": minhash_signature(topic_idea),
             }
             records_to_insert.append(record)
             saved_ids.append(idea_id)
@@ -402,10 +652,23 @@ async def save_suggested_ideas_batch(payload, request: Request):
             errors.append(f"Ошибка подготовки идеи {idea_data.get('topic_idea')}: {str(e)}")
             logger.error(f"Ошибка подготовки идеи {idea_data.get('topic_idea')}: {str(e)}")
     if not records_to_insert:
+        if channel_name:
+            invalidate_idea_index(telegram_user_id, channel_name)
         logger.warning("Нет идей для сохранения после обработки.")
         return {"message": "Нет корректных идей для сохранения.", "saved_count": 0, "errors": errors}
     try:
-        result = supabase.table("suggested_ideas").insert(records_to_insert).execute()
+        return await _insert_ideas_batch(records_to_insert, saved_ids, errors)
+    finally:
+        # Индекс повторов сбрасывается после записи: план, собранный между удалением и вставкой,
+        # иначе закэшировал бы индекс без новых идей на IDEA_INDEX_TTL
+        for idea_channel in {channel_name} | {record["channel_name"] for record in records_to_insert}:
+            if idea_channel:
+                invalidate_idea_index(telegram_user_id, idea_channel)
+
+
+async def _insert_ideas_batch(records_to_insert: List[Dict[str, Any]], saved_ids: List[str], errors: List[str]) -> Dict[str, Any]:
+    try:
+        result = await db.table("suggested_ideas").insert(records_to_insert).execute()
         if hasattr(result, 'data') and result.data:
             saved_count = len(result.data)
             logger.info(f"Успешно сохранено {saved_count} идей батчем.")
@@ -419,7 +682,7 @@ async def save_suggested_ideas_batch(payload, request: Request):
             saved_ids_single = []
             for record in records_to_insert:
                 try:
-                    single_result = supabase.table("suggested_ideas").insert(record).execute()
+                    single_result = await db.table("suggested_ideas").insert(record).execute()
                     if hasattr(single_result, 'data') and single_result.data:
                         saved_count_single += 1
                         saved_ids_single.append(record['id'])
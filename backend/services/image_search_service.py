@@ -0,0 +1,139 @@
+# Сервис параллельного поиска изображений для постов
+import asyncio
+import random
+from typing import List, Optional
+
+import httpx
+
+from backend.main import logger
+from backend.http_clients import get_http_client
+from backend.services.keyword_service import get_image_keywords
+
+UNSPLASH_SEARCH_URL = "https://api.unsplash.com/search/photos"
+MAX_KEYWORD_QUERIES = 3
+FALLBACK_CONTEXT_WORDS = ["business", "abstract", "professional", "technology"]
+
+
+def _build_queries(keywords: List[str], topic: str, format_style: str) -> List[str]:
+    """Формирует список уникальных поисковых запросов из ключевых слов, темы и формата."""
+    queries = []
+    for candidate in list(keywords or [])[:MAX_KEYWORD_QUERIES] + [topic, format_style]:
+        candidate = (candidate or "").strip()
+        if candidate and candidate.lower() not in {q.lower() for q in queries}:
+            queries.append(candidate)
+    if len(queries) < 2:
+        queries.extend(random.sample(FALLBACK_CONTEXT_WORDS, 2))
+    return queries
+
+
+def _placeholder_images(count: int):
+    """Заглушки на случай отсутствия UNSPLASH_ACCESS_KEY."""
+    from backend.main import FoundImage
+    return [
+        FoundImage(
+            id=f"placeholder_{i}",
+            source="unsplash",
+            preview_url=f"https://via.placeholder.com/150x100?text=Image+{i+1}",
+            regular_url="https://via.placeholder.com/800x600?text=Unsplash+API+key+required",
+            description=f"Placeholder image {i+1}",
+            author_name="Demo",
+            author_url="https://unsplash.com"
+        )
+        for i in range(min(count, 5))
+    ]
+
+
+async def _fetch_unsplash_query(client: httpx.AsyncClient, query: str, per_page: int, access_key: str):
+    """Один запрос к Unsplash Search API. Возвращает список FoundImage (перемешанный)."""
+    from backend.main import FoundImage
+    response = await client.get(
+        UNSPLASH_SEARCH_URL,
+        headers={"Authorization": f"Client-ID {access_key}", "Accept-Version": "v1"},
+        params={"query": query, "per_page": per_page}
+    )
+    if response.status_code != 200:
+        logger.error(f"Ошибка при запросе к Unsplash API по запросу '{query}': {response.status_code} {response.text}")
+        return []
+    photos = response.json().get("results") or []
+    random.shuffle(photos)
+    images = []
+    for photo in photos:
+        try:
+            images.append(FoundImage(
+                id=photo['id'],
+                source="unsplash",
+                preview_url=photo['urls']['small'],
+                regular_url=photo['urls']['regular'],
+                description=photo.get('description') or photo.get('alt_description') or query,
+                author_name=photo['user']['name'],
+                author_url=photo['user']['links']['html']
+            ))
+        except (KeyError, TypeError) as e:
+            logger.warning(f"Пропущено изображение Unsplash с неполными данными: {e}")
+    return images
+
+
+async def search_post_images(post_text: str, topic: str, format_style: str,
+                             limit: Optional[int] = None, deadline: Optional[float] = None):
+    """
+    Поиск изображений для поста: ключевые слова генерируются один раз,
+    все запросы к Unsplash выполняются параллельно с общим дедлайном.
+    Результаты объединяются по мере поступления с дедупликацией по id,
+    поиск останавливается, как только набрано `limit` уникальных изображений.
+    """
+    from backend.main import UNSPLASH_ACCESS_KEY, IMAGE_RESULTS_COUNT, IMAGE_SEARCH_DEADLINE
+    limit = limit or IMAGE_RESULTS_COUNT
+    deadline = deadline or IMAGE_SEARCH_DEADLINE
+
+    if not UNSPLASH_ACCESS_KEY:
+        logger.warning("Поиск изображений в Unsplash невозможен: отсутствует UNSPLASH_ACCESS_KEY")
+        return _placeholder_images(limit)
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+
+    keywords = await get_image_keywords(post_text, topic, format_style)
+    queries = _build_queries(keywords, topic, format_style)
+    logger.info(f"Параллельный поиск изображений по запросам: {queries}")
+
+    remaining = deadline - (loop.time() - started_at)
+    if remaining <= 0:
+        logger.warning("Дедлайн поиска изображений истек на этапе генерации ключевых слов")
+        return []
+
+    found_images = []
+    seen_ids = set()
+    per_page = min(limit * 2, 30)
+    client = get_http_client("unsplash")
+    tasks = [
+        asyncio.create_task(_fetch_unsplash_query(client, query, per_page, UNSPLASH_ACCESS_KEY))
+        for query in queries
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=remaining):
+            try:
+                images = await next_done
+            except asyncio.TimeoutError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении запроса к Unsplash: {e}")
+                continue
+            for image in images:
+                if image.id in seen_ids:
+                    continue
+                seen_ids.add(image.id)
+                found_images.append(image)
+                if len(found_images) >= limit:
+                    break
+            if len(found_images) >= limit:
+                break
+    except asyncio.TimeoutError:
+        logger.warning(f"Дедлайн поиска изображений ({deadline} с) истек, найдено {len(found_images)}")
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    logger.info(f"Найдено {len(found_images)} уникальных изображений за {loop.time() - started_at:.2f} с")
+    return found_images[:limit]
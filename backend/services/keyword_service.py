@@ -0,0 +1,219 @@
+# Ключевые слова для поиска изображений: LRU+TTL кэш по (хэш текста, тема, формат),
+# LLM при свободном шлюзе и локальный RAKE-извлекатель со словарем RU→EN под нагрузкой или без LLM
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from backend.main import logger
+from backend.llm_gateway import complete as llm_complete, LLMGatewayError, available_providers, breaker_states
+from backend.prompts import IMAGE_KEYWORDS
+
+# Ключевые слова от LLM для неизменного текста не устаревают; локальные живут меньше,
+# чтобы после спада нагрузки текст получил ключевые слова от LLM
+KEYWORD_CACHE_TTL = float(os.getenv("KEYWORD_CACHE_TTL", "86400"))
+KEYWORD_LOCAL_CACHE_TTL = float(os.getenv("KEYWORD_LOCAL_CACHE_TTL", "600"))
+KEYWORD_CACHE_MAX_ENTRIES = int(os.getenv("KEYWORD_CACHE_MAX_ENTRIES", "5000"))
+# Сколько одновременных запросов ключевых слов к LLM допускается, остальные обслуживает локальный извлекатель
+KEYWORD_LLM_MAX_IN_FLIGHT = int(os.getenv("KEYWORD_LLM_MAX_IN_FLIGHT", "4"))
+KEYWORD_LLM_DEADLINE = float(os.getenv("KEYWORD_LLM_DEADLINE", "15"))
+# Сколько символов текста поста попадает в промпт
+KEYWORD_TEXT_CHARS = 300
+MAX_KEYWORDS = 3
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+(?:-[a-zа-я0-9]+)*")
+# Границы фраз RAKE помимо стоп-слов: знаки препинания и переводы строк
+_PHRASE_SPLIT_RE = re.compile(r"[.,;:!?()\[\]{}«»\"'“”…—–\n\r\t/|]+")
+_KEYWORD_SPLIT_RE = re.compile(r"[,;\n]")
+_KEYWORD_TRIM_RE = re.compile(r"^[\s\d.)*#\-\"'«»]+|[\s.\"'«»]+$")
+
+_STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все всё она так его но да ты к у же вы за бы по только ее её мне было вот от меня
+еще ещё нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж вам ведь там
+потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под
+будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее неё сейчас были куда
+зачем всех никогда можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая много
+разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между
+это эта эти весь свой своя свои своих ваш ваша ваши наш наша наши очень также который которая которые которых просто
+сегодня завтра вчера каждый каждая каждое день дня дней год года лет время раз пост поста посте посты канал канала
+the a an and or but if then of to in on at by for with from as is are was were be been this that these those it its
+your you we our they their he she his her not no so do does did have has had how what why who which will can just
+about into over more most very also than there here all any some such only own same too
+""".split())
+
+# Основы русских слов -> английский термин для стоковых фото. Основа совпадает с началом слова
+# (короткие основы — только целым словом, чтобы "мор" не находилось в "мороз")
+_RU_EN_TERMS: Dict[str, str] = {
+    "бизнес": "business", "маркетинг": "marketing", "реклам": "advertising", "продаж": "sales",
+    "клиент": "customer", "компани": "company", "стартап": "startup", "предприним": "entrepreneur",
+    "деньг": "money", "финанс": "finance", "инвест": "investment", "банк": "bank",
+    "крипт": "crypto", "биткоин": "bitcoin", "экономик": "economy", "карьер": "career", "работ": "work",
+    "офис": "office", "команд": "team", "лидер": "leadership", "менеджмент": "management", "успех": "success",
+    "цели": "goal", "мотивац": "motivation", "продуктивн": "productivity", "технолог": "technology",
+    "программ": "programming", "разработ": "development", "код": "code", "компьютер": "computer",
+    "ноутбук": "laptop", "интернет": "internet", "сайт": "website", "смартфон": "smartphone",
+    "телефон": "phone", "приложени": "app", "нейросет": "neural network", "искусственн": "artificial intelligence",
+    "робот": "robot", "дизайн": "design", "искусств": "art", "фотограф": "photography",
+    "музык": "music", "кино": "cinema", "фильм": "movie", "книг": "books", "чтени": "reading",
+    "образован": "education", "обучени": "learning", "учеб": "study", "школ": "school", "студент": "student",
+    "университет": "university", "наук": "science", "здоров": "health", "медицин": "medicine",
+    "врач": "doctor", "психолог": "psychology", "спорт": "sport", "фитнес": "fitness", "трениров": "workout",
+    "бег": "running", "бегун": "running", "пробежк": "running", "йога": "yoga", "питани": "nutrition",
+    "еда": "food", "рецепт": "recipe", "утро": "morning", "утрен": "morning", "вечер": "evening",
+    "кухн": "kitchen", "готовк": "cooking", "кофе": "coffee", "чай": "tea", "путешеств": "travel",
+    "туризм": "tourism", "отпуск": "vacation", "город": "city", "природ": "nature", "лес": "forest",
+    "горы": "mountains", "море": "sea", "морск": "sea", "океан": "ocean", "пляж": "beach", "зима": "winter", "зимн": "winter", "лето": "summer", "летн": "summer",
+    "осен": "autumn", "весн": "spring", "семь": "family", "дети": "children", "детск": "children", "ребен": "child",
+    "животн": "animals", "собак": "dog", "кошк": "cat", "кот": "cat", "дом": "home", "интерьер": "interior",
+    "недвижим": "real estate", "строител": "construction", "автомоб": "car", "машин": "car",
+    "мода": "fashion", "модн": "fashion", "одежд": "clothes", "красот": "beauty", "косметик": "cosmetics", "праздник": "holiday",
+    "подар": "gift", "новост": "news", "политик": "politics", "общени": "communication", "встреч": "meeting",
+    "конференц": "conference", "идея": "idea", "идеи": "idea", "творчеств": "creativity", "игр": "games",
+    "энерги": "energy", "эколог": "ecology", "сельск": "agriculture", "право": "law", "юрид": "legal",
+    "безопасност": "security", "космос": "space", "ресторан": "restaurant", "магазин": "shop",
+}
+# Основы короче этой длины сравниваются только целым словом
+_MIN_PREFIX_STEM = 4
+_SHORT_TERMS = {stem: term for stem, term in _RU_EN_TERMS.items() if len(stem) < _MIN_PREFIX_STEM}
+_PREFIX_STEMS = sorted((stem for stem in _RU_EN_TERMS if len(stem) >= _MIN_PREFIX_STEM), key=len, reverse=True)
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+# (хэш текста, тема, формат) -> (момент истечения по time.monotonic(), ключевые слова)
+_keyword_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, List[str]]]" = OrderedDict()
+_llm_in_flight = 0
+
+
+def translate_term(word: str) -> Optional[str]:
+    """Английский термин для русского слова по словарю основ; английские слова возвращаются как есть."""
+    if not _CYRILLIC_RE.search(word):
+        return word
+    if word in _SHORT_TERMS:
+        return _SHORT_TERMS[word]
+    for stem in _PREFIX_STEMS:
+        if word.startswith(stem):
+            return _RU_EN_TERMS[stem]
+    return None
+
+
+def _candidate_phrases(text: str) -> List[List[str]]:
+    """Фразы RAKE: последовательности значимых слов между стоп-словами и знаками препинания."""
+    phrases = []
+    for fragment in _PHRASE_SPLIT_RE.split(text.lower().replace("ё", "е")):
+        phrase: List[str] = []
+        for word in _WORD_RE.findall(fragment):
+            if word in _STOP_WORDS or len(word) < 3 or word.isdigit():
+                if phrase:
+                    phrases.append(phrase)
+                phrase = []
+            else:
+                phrase.append(word)
+        if phrase:
+            phrases.append(phrase)
+    # Длинные фразы для поиска изображений бесполезны
+    return [phrase[:3] for phrase in phrases]
+
+
+def extract_keywords_local(text: str, topic: str = "", limit: int = MAX_KEYWORDS) -> List[str]:
+    """
+    Локальный извлекатель без сетевых вызовов: RAKE по теме и тексту (слова темы весят вдвое),
+    перевод значимых слов по словарю RU→EN. Непереведенные русские слова добавляются только
+    если английских терминов не хватило.
+    """
+    topic_phrases = _candidate_phrases(topic or "")
+    phrases = topic_phrases + _candidate_phrases(text or "")
+    if not phrases:
+        return []
+    frequency: Dict[str, int] = defaultdict(int)
+    degree: Dict[str, int] = defaultdict(int)
+    for phrase in phrases:
+        for word in phrase:
+            frequency[word] += 1
+            degree[word] += len(phrase)
+    topic_words = {word for phrase in topic_phrases for word in phrase}
+    scores = {word: degree[word] / frequency[word] * (2 if word in topic_words else 1) + frequency[word] for word in frequency}
+
+    keywords: List[str] = []
+    untranslated: List[str] = []
+    for word in sorted(scores, key=scores.get, reverse=True):
+        term = translate_term(word)
+        if term is None:
+            untranslated.append(word)
+        elif term not in keywords:
+            keywords.append(term)
+        if len(keywords) >= limit:
+            break
+    return (keywords + untranslated)[:limit]
+
+
+def parse_keywords(text: str, limit: int = MAX_KEYWORDS) -> List[str]:
+    """Ключевые слова из ответа модели: список через запятую, без нумерации и кавычек."""
+    keywords = []
+    for part in _KEYWORD_SPLIT_RE.split(text or ""):
+        part = _KEYWORD_TRIM_RE.sub("", part)
+        if part and part.lower() not in {k.lower() for k in keywords}:
+            keywords.append(part)
+    return keywords[:limit]
+
+
+def _cache_key(text: str, topic: str, format_style: str) -> Tuple[str, str, str]:
+    digest = hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+    return digest, (topic or "").strip().lower(), (format_style or "").strip().lower()
+
+
+def _cache_put(key: Tuple[str, str, str], keywords: List[str], ttl: float):
+    if ttl <= 0:
+        return
+    _keyword_cache[key] = (time.monotonic() + ttl, keywords)
+    _keyword_cache.move_to_end(key)
+    while len(_keyword_cache) > KEYWORD_CACHE_MAX_ENTRIES:
+        _keyword_cache.popitem(last=False)
+
+
+def _llm_available() -> bool:
+    """Есть настроенный провайдер с закрытым (или пробным) circuit breaker и свободный слот."""
+    if _llm_in_flight >= KEYWORD_LLM_MAX_IN_FLIGHT:
+        return False
+    states = breaker_states()
+    return any(states.get(provider) != "open" for provider in available_providers())
+
+
+async def get_image_keywords(text: str, topic: str, format_style: str) -> List[str]:
+    """
+    Ключевые слова для поиска изображений. Повтор для того же текста, темы и формата берется из кэша
+    без сетевых вызовов. LLM вызывается, только если шлюз доступен и не занят другими запросами ключевых слов,
+    иначе (и при ошибке LLM) работает локальный извлекатель.
+    """
+    global _llm_in_flight
+    key = _cache_key(text, topic, format_style)
+    cached = _keyword_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        _keyword_cache.move_to_end(key)
+        return list(cached[1])
+
+    keywords: List[str] = []
+    if _llm_available():
+        _llm_in_flight += 1
+        try:
+            completion = await llm_complete(
+                IMAGE_KEYWORDS.render(topic=topic, format_style=format_style, text=(text or "")[:KEYWORD_TEXT_CHARS]),
+                temperature=0.3,
+                max_tokens=100,
+                deadline=KEYWORD_LLM_DEADLINE,
+                template=IMAGE_KEYWORDS.id,
+            )
+            keywords = parse_keywords(completion.text)
+        except LLMGatewayError as e:
+            logger.warning(f"Не удалось получить ключевые слова от LLM, используем локальный извлекатель: {e}")
+        finally:
+            _llm_in_flight -= 1
+        if keywords:
+            logger.info(f"Сгенерированы ключевые слова для поиска изображений: {keywords}")
+            _cache_put(key, keywords, KEYWORD_CACHE_TTL)
+            return list(keywords)
+
+    keywords = extract_keywords_local(text, topic)
+    logger.info(f"Ключевые слова для поиска изображений (локально): {keywords}")
+    _cache_put(key, keywords, KEYWORD_LOCAL_CACHE_TTL)
+    return list(keywords)
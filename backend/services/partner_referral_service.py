@@ -2,6 +2,7 @@ import os
 import httpx
 import requests
 from backend.main import logger
+from backend.http_clients import get_http_client
 
 async def get_star_referral_link(user_id: int) -> str:
     """
@@ -18,17 +19,17 @@ async def get_star_referral_link(user_id: int) -> str:
         "bot": int(bot_id),
         "peer": int(user_id)
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        response = await client.post(url, json=payload)
-        data = response.json()
-        if not data.get("ok"):
-            logger.error(f"Ошибка Telegram API при получении реферальной ссылки: {data}")
-            raise Exception(f"Ошибка Telegram API: {data}")
-        link = data["result"].get("referral_link") or data["result"].get("link")
-        if not link:
-            logger.error(f"Не удалось получить ссылку из ответа Telegram: {data}")
-            raise Exception("Не удалось получить реферальную ссылку из ответа Telegram")
-        return link
+    client = get_http_client("telegram_api")
+    response = await client.post(url, json=payload)
+    data = response.json()
+    if not data.get("ok"):
+        logger.error(f"Ошибка Telegram API при получении реферальной ссылки: {data}")
+        raise Exception(f"Ошибка Telegram API: {data}")
+    link = data["result"].get("referral_link") or data["result"].get("link")
+    if not link:
+        logger.error(f"Не удалось получить ссылку из ответа Telegram: {data}")
+        raise Exception("Не удалось получить реферальную ссылку из ответа Telegram")
+    return link
 
 def setup_affiliate_program(commission_permille=100, duration_months=3):
     """
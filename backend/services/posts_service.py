@@ -1,13 +1,41 @@
 ﻿# Сервис для работы с постами
 from fastapi import Request, HTTPException
 from typing import Dict, Any, List, Optional
-from backend.main import supabase, logger
+from backend.main import logger
+from backend.db import db
+from backend.schema_state import ensure_schema_verified
+from backend.sse import sse_event, sse_response
+from backend.prompt_budget import output_budget, select_posts
+from backend.text_cleanup import strip_edge_quotes
+from backend.placeholder_detector import find_placeholders, placeholder_paragraphs
+from backend.prompts import POST, POST_PARAGRAPH_FIX, POST_WITH_SAMPLES
+from backend.services.style_profile import compute_style_profile, get_style_context, invalidate_style_context, style_instructions
 from pydantic import BaseModel
 import uuid
 import asyncio
 from datetime import datetime
 import traceback
-import re
+import os
+
+# Общий дедлайн генерации текста поста (секунды)
+POST_GENERATION_DEADLINE = float(os.getenv("POST_GENERATION_DEADLINE", "60"))
+# Бюджет токенов на примеры постов канала в промпте генерации и лимит на один пример
+POST_SAMPLES_BUDGET = int(os.getenv("POST_SAMPLES_BUDGET", "4000"))
+POST_SAMPLE_MAX_TOKENS = int(os.getenv("POST_SAMPLE_MAX_TOKENS", "800"))
+# Сколько абзацев с плейсхолдерами переписывается отдельными запросами и общий дедлайн на них (секунды)
+POST_PLACEHOLDER_FIX_MAX = int(os.getenv("POST_PLACEHOLDER_FIX_MAX", "3"))
+POST_PLACEHOLDER_FIX_DEADLINE = float(os.getenv("POST_PLACEHOLDER_FIX_DEADLINE", "20"))
+
+# Адаптивные инструкции для форматов поста
+POST_FORMAT_INSTRUCTIONS = {
+    "обзор": "Структурируй обзор с четкими разделами и выводами",
+    "новость": "Начни с ключевого факта, добавь контекст и значимость",
+    "вопрос": "Сформулируй интригующий вопрос и направь размышления читателя", 
+    "совет": "Дай практичный, применимый совет с конкретными шагами",
+    "история": "Расскажи увлекательную историю с началом, развитием и выводом",
+    "список": "Создай структурированный список с полезными пунктами",
+    "мнение": "Выскажи аргументированную позицию с обоснованием"
+}
 
 # Импорт моделей PostImage, PostData, SavedPostResponse, PostDetailsResponse из main.py или отдельного файла моделей
 # from backend.models import PostImage, PostData, SavedPostResponse, PostDetailsResponse
@@ -18,13 +46,13 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
         if not telegram_user_id:
             logger.warning("Запрос постов без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для доступа к постам необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
-        query = supabase.table("saved_posts").select("*, saved_images(*)").eq("user_id", int(telegram_user_id))
+        query = db.table("saved_posts").select("*, saved_images(*)").eq("user_id", int(telegram_user_id))
         if channel_name:
             query = query.eq("channel_name", channel_name)
-        result = query.order("target_date", desc=True).execute()
+        result = await query.order("target_date", desc=True).execute()
         if not hasattr(result, 'data'):
             logger.error(f"Ошибка при получении постов из БД: {result}")
             return []
@@ -62,23 +90,15 @@ async def get_posts(request: Request, channel_name: Optional[str] = None):
 
 async def create_post(request: Request, post_data):
     try:
-        from backend.main import fix_schema, download_and_save_external_image
-        try:
-            logger.info("Вызов fix_schema перед созданием поста...")
-            fix_result = await fix_schema()
-            if not fix_result.get("success"):
-                logger.warning(f"Не удалось обновить/проверить схему перед созданием поста: {fix_result}")
-            else:
-                logger.info("Проверка/обновление схемы перед созданием поста завершена успешно.")
-        except Exception as pre_save_fix_err:
-            logger.error(f"Ошибка при вызове fix_schema перед созданием поста: {pre_save_fix_err}", exc_info=True)
-        logger.info("Небольшая пауза после fix_schema, чтобы дать PostgREST время...")
-        await asyncio.sleep(0.7)
+        from backend.main import download_and_save_external_image
+        # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+        if not await ensure_schema_verified():
+            logger.warning("Схема БД не сверена, продолжаем без сверки")
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if not telegram_user_id:
             logger.warning("Запрос создания поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для создания поста необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         selected_image = post_data.selected_image_data
@@ -116,7 +136,7 @@ async def create_post(request: Request, post_data):
                 else:
                     image_check = None
                     if selected_image.url:
-                        image_check_result = supabase.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
+                        image_check_result = await db.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
                         if hasattr(image_check_result, 'data') and len(image_check_result.data) > 0:
                             image_check = image_check_result.data[0]
                     if image_check:
@@ -134,7 +154,7 @@ async def create_post(request: Request, post_data):
                             "source": selected_image.source or "frontend_selection",
                             "user_id": int(telegram_user_id),
                         }
-                        image_result = supabase.table("saved_images").insert(image_data_to_save).execute()
+                        image_result = await db.table("saved_images").insert(image_data_to_save).execute()
                         if hasattr(image_result, 'data') and len(image_result.data) > 0:
                             saved_image_id = new_internal_id
                             logger.info(f"Сохранено новое изображение {saved_image_id} для поста")
@@ -150,9 +170,10 @@ async def create_post(request: Request, post_data):
         logger.info(f"Подготовлены данные для сохранения в saved_posts: {post_to_save}")
         try:
             logger.info(f"Выполняем insert в saved_posts для ID {post_to_save['id']}...")
-            result = supabase.table("saved_posts").insert(post_to_save).execute()
+            result = await db.table("saved_posts").insert(post_to_save).execute()
             if hasattr(result, 'data') and len(result.data) > 0:
                 logger.info(f"Пост успешно создан: {post_to_save['id']}")
+                invalidate_style_context(int(telegram_user_id), post_to_save.get("channel_name"))
                 return result.data[0]
             else:
                 logger.error(f"Ошибка при сохранении поста: {result}")
@@ -166,26 +187,18 @@ async def create_post(request: Request, post_data):
 
 async def update_post(post_id: str, request: Request, post_data):
     try:
-        from backend.main import fix_schema, download_and_save_external_image
-        try:
-            logger.info(f"Вызов fix_schema перед обновлением поста {post_id}...")
-            fix_result = await fix_schema()
-            if not fix_result.get("success"):
-                logger.warning(f"Не удалось обновить/проверить схему перед обновлением поста {post_id}: {fix_result}")
-            else:
-                logger.info(f"Проверка/обновление схемы перед обновлением поста {post_id} завершена успешно.")
-        except Exception as pre_update_fix_err:
-            logger.error(f"Ошибка при вызове fix_schema перед обновлением поста {post_id}: {pre_update_fix_err}", exc_info=True)
-        logger.info(f"Небольшая пауза после fix_schema для поста {post_id}, чтобы дать PostgREST время...")
-        await asyncio.sleep(0.7)
+        from backend.main import download_and_save_external_image
+        # Схема сверяется один раз за деплой (backend/schema_state.py), здесь только проверяем флаг
+        if not await ensure_schema_verified():
+            logger.warning("Схема БД не сверена, продолжаем без сверки")
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if not telegram_user_id:
             logger.warning("Запрос обновления поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для обновления поста необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
-        post_check = supabase.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+        post_check = await db.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
         if not hasattr(post_check, 'data') or len(post_check.data) == 0:
             logger.warning(f"Попытка обновить чужой или несуществующий пост: {post_id}")
             raise HTTPException(status_code=404, detail="Пост не найден или нет прав на его редактирование")
@@ -215,7 +228,7 @@ async def update_post(post_id: str, request: Request, post_data):
                     else:
                         image_check = None
                         if selected_image.url:
-                            image_check_result = supabase.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
+                            image_check_result = await db.table("saved_images").select("id").eq("url", selected_image.url).limit(1).execute()
                             if hasattr(image_check_result, 'data') and len(image_check_result.data) > 0:
                                 image_check = image_check_result.data[0]
                         if image_check:
@@ -233,7 +246,7 @@ async def update_post(post_id: str, request: Request, post_data):
                                 "source": selected_image.source or "frontend_selection",
                                 "user_id": int(telegram_user_id),
                             }
-                            image_result = supabase.table("saved_images").insert(image_data_to_save).execute()
+                            image_result = await db.table("saved_images").insert(image_data_to_save).execute()
                             if hasattr(image_result, 'data') and len(image_result.data) > 0:
                                 image_id_to_set_in_post = new_internal_id
                                 logger.info(f"Сохранено новое изображение {image_id_to_set_in_post} для обновления поста {post_id}")
@@ -266,7 +279,7 @@ async def update_post(post_id: str, request: Request, post_data):
         logger.info(f"Подготовлены данные для обновления в saved_posts: {post_to_update}")
         try:
             logger.info(f"Выполняем update в saved_posts для ID {post_id}...")
-            result = supabase.table("saved_posts").update(post_to_update).eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+            result = await db.table("saved_posts").update(post_to_update).eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
             logger.info(f"Update выполнен. Status: {result.status_code if hasattr(result, 'status_code') else 'N/A'}")
         except Exception as e:
             logger.error(f"Ошибка при update в saved_posts для ID {post_id}: {e}")
@@ -277,10 +290,11 @@ async def update_post(post_id: str, request: Request, post_data):
             raise HTTPException(status_code=500, detail=f"Не удалось обновить пост. {last_error_details}")
         updated_post = result.data[0]
         logger.info(f"Пользователь {telegram_user_id} обновил пост: {post_id}")
+        invalidate_style_context(int(telegram_user_id))
         response_data = updated_post  # Здесь должен быть SavedPostResponse(**updated_post), если модель импортирована
         final_image_id = updated_post.get("saved_image_id")
         if final_image_id:
-            img_data_res = supabase.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", final_image_id).maybe_single().execute()
+            img_data_res = await db.table("saved_images").select("id, url, preview_url, alt, author, author_url, source").eq("id", final_image_id).maybe_single().execute()
             if img_data_res.data:
                 try:
                     alt_text = img_data_res.data.get("alt_description") or img_data_res.data.get("alt")
@@ -310,27 +324,28 @@ async def update_post(post_id: str, request: Request, post_data):
 
 async def delete_post(post_id: str, request: Request):
     try:
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if not telegram_user_id:
             logger.warning("Запрос удаления поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для удаления поста необходимо авторизоваться через Telegram")
-        post_check = supabase.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
+        post_check = await db.table("saved_posts").select("id").eq("id", post_id).eq("user_id", int(telegram_user_id)).execute()
         if not hasattr(post_check, 'data') or len(post_check.data) == 0:
             logger.warning(f"Попытка удалить чужой или несуществующий пост: {post_id}")
             raise HTTPException(status_code=404, detail="Пост не найден или нет прав на его удаление")
         try:
-            delete_links_res = supabase.table("post_images").delete().eq("post_id", post_id).execute()
+            delete_links_res = await db.table("post_images").delete().eq("post_id", post_id).execute()
             logger.info(f"Удалено {len(delete_links_res.data) if hasattr(delete_links_res, 'data') else 0} связей для удаляемого поста {post_id}")
         except Exception as del_link_err:
             logger.error(f"Ошибка при удалении связей post_images для поста {post_id} перед удалением поста: {del_link_err}")
-        result = supabase.table("saved_posts").delete().eq("id", post_id).execute()
+        result = await db.table("saved_posts").delete().eq("id", post_id).execute()
         if not hasattr(result, 'data'):
             logger.error(f"Ошибка при удалении поста: {result}")
             raise HTTPException(status_code=500, detail="Ошибка при удалении поста")
         logger.info(f"Пользователь {telegram_user_id} удалил пост {post_id}")
+        invalidate_style_context(int(telegram_user_id))
         return {"success": True, "message": "Пост успешно удален"}
     except HTTPException as http_err:
         raise http_err
@@ -338,348 +353,211 @@ async def delete_post(post_id: str, request: Request):
         logger.error(f"Ошибка при удалении поста {post_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера при удалении поста: {str(e)}")
 
+async def _build_post_prompts(request: Request, req) -> Dict[str, Any]:
+    """Собирает промпты и лимит токенов для генерации поста (общая часть обычного и потокового эндпоинтов)."""
+    from backend.main import OPENROUTER_API_KEY, OPENAI_API_KEY
+    topic_idea = req.get("topic_idea")
+    format_style = req.get("format_style")
+    channel_name = req.get("channel_name", "")
+    post_samples = req.get("post_samples") or []
+    telegram_user_id = request.headers.get("X-Telegram-User-Id")
+    
+    # Проверка наличия хотя бы одного API ключа
+    if not OPENROUTER_API_KEY and not OPENAI_API_KEY:
+        logger.warning("Генерация деталей поста невозможна: отсутствуют OPENROUTER_API_KEY и OPENAI_API_KEY")
+        raise HTTPException(status_code=503, detail="API для генерации текста недоступен")
+
+    # Профиль стиля, примеры и последние посты канала — один кэшированный запрос контекста
+    style_context = {"profile": {}, "samples": [], "recent_posts": []}
+    if channel_name and telegram_user_id and telegram_user_id.isdigit() and db:
+        try:
+            style_context = await get_style_context(int(telegram_user_id), channel_name)
+        except Exception as e:
+            logger.warning(f"Не удалось получить контекст стиля для канала @{channel_name}: {e}")
+    if post_samples:
+        # Примеры переданы клиентом — профиль считаем по ним
+        style_profile = compute_style_profile(post_samples)
+    else:
+        post_samples = style_context["samples"]
+        style_profile = style_context["profile"]
+        if post_samples:
+            logger.info(f"Получено {len(post_samples)} примеров постов для канала @{channel_name}")
+    recent_posts = style_context["recent_posts"]
+    if recent_posts:
+        logger.info(f"Найдено {len(recent_posts)} предыдущих постов для контекста")
+
+    # Анализ тональности и временной контекст
+    from datetime import datetime
+    current_time = datetime.now()
+    
+    # Временной контекст
+    if current_time.hour < 12:
+        time_context = "утренний пост (мотивация, планы, свежие новости)"
+    elif current_time.hour < 18:
+        time_context = "дневной пост (полезная информация, обзоры, анализ)"
+    else:
+        time_context = "вечерний пост (размышления, итоги, развлекательный контент)"
+
+    # Тональность и структура из профиля стиля канала
+    tone_instruction, structure_instruction = style_instructions(style_profile)
+
+    format_instruction = POST_FORMAT_INSTRUCTIONS.get(format_style.lower(), "")
+
+    # Последние посты канала: первые 50 символов как краткое описание темы
+    recent_topics = []
+    for post in recent_posts:
+        topic_preview = (post or "")[:50].replace('\n', ' ').strip()
+        if topic_preview:
+            recent_topics.append(topic_preview + "...")
+
+    # Статичные инструкции — в шаблоне, данные канала и запроса добавляются в конец промпта
+    template = POST_WITH_SAMPLES if post_samples else POST
+    sample_text = ""
+    if post_samples:
+        # Примеры в пределах бюджета токенов: длинные и непохожие друг на друга в приоритете
+        sample_text = "\n\n---\n\n".join(select_posts(post_samples[:10], POST_SAMPLES_BUDGET, POST_SAMPLE_MAX_TOKENS))
+    messages = template.render(
+        samples=sample_text,
+        recent_topics="; ".join(recent_topics[:3]),
+        tone_instruction=tone_instruction,
+        structure_instruction=structure_instruction.strip() if post_samples else "",
+        time_context=time_context,
+        format_instruction=format_instruction,
+        channel_name=channel_name,
+        topic_idea=topic_idea,
+        format_style=format_style,
+    )
+    
+    # Лимит ответа: средняя длина примеров в токенах с запасом, но не больше остатка контекстного окна
+    if style_profile.get("avg_tokens"):
+        avg_tokens = style_profile["avg_tokens"]
+        desired_tokens = max(150, min(1200, int(avg_tokens * 1.3)))
+    else:
+        desired_tokens = 600
+    return {
+        "topic_idea": topic_idea,
+        "format_style": format_style,
+        "channel_name": channel_name,
+        "messages": messages,
+        "max_tokens": output_budget(messages, desired_tokens),
+        "template": template.id,
+    }
+
+def _clean_post_text(post_text: str) -> str:
+    """Убирает кавычки по краям и случайно повторенные моделью фрагменты инструкций."""
+    # Удаляем кавычки по краям, если они есть
+    post_text = strip_edge_quotes(post_text)
+    # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
+    for unwanted in ["Ты — опытный контент-маркетолог", "Вот несколько примеров постов", "Формат поста:", "Твоя задача", "В ответе выдай только"]:
+        if post_text.lower().startswith(unwanted.lower()):
+            post_text = post_text.split("\n", 1)[-1].strip()
+    return post_text
+
+async def _fix_placeholder_paragraphs(post_text: str, topic_idea: str) -> str:
+    """
+    Переписывает только абзацы с плейсхолдерами (параллельно, не больше POST_PLACEHOLDER_FIX_MAX).
+    Остальной текст не меняется; абзац, который не удалось исправить, остается как был.
+    """
+    from backend.llm_gateway import complete as llm_complete, LLMGatewayError
+    paragraphs = post_text.split("\n\n")
+    violations = placeholder_paragraphs(paragraphs)
+    if not violations:
+        return post_text
+    numbers = sorted(violations)[:POST_PLACEHOLDER_FIX_MAX]
+    logger.info(f"Плейсхолдеры в абзацах поста {numbers}: {[violations[n] for n in numbers]}, переписываем абзацы")
+
+    async def rewrite(number: int) -> Optional[str]:
+        messages = POST_PARAGRAPH_FIX.render(
+            topic_idea=topic_idea, fragments=", ".join(violations[number]), paragraph=paragraphs[number]
+        )
+        try:
+            completion = await llm_complete(
+                messages, temperature=0.5, max_tokens=400, deadline=POST_PLACEHOLDER_FIX_DEADLINE,
+                template=POST_PARAGRAPH_FIX.id,
+            )
+        except LLMGatewayError as e:
+            logger.warning(f"Не удалось переписать абзац {number} поста: {e}")
+            return None
+        fixed = strip_edge_quotes(completion.text)
+        if not fixed or "\n\n" in fixed or find_placeholders(fixed):
+            return None
+        return fixed
+
+    for number, fixed in zip(numbers, await asyncio.gather(*(rewrite(n) for n in numbers))):
+        if fixed:
+            paragraphs[number] = fixed
+    return "\n\n".join(paragraphs)
+
+def _images_payload(found_images: List[Any]) -> Dict[str, Any]:
+    """found_images и selected_image_data (первое изображение) для ответа клиенту."""
+    return {
+        "found_images": [img.dict() if hasattr(img, 'dict') else img for img in found_images],
+        "selected_image_data": {
+            "url": found_images[0].regular_url,
+            "id": found_images[0].id,
+            "preview_url": found_images[0].preview_url,
+            "alt": found_images[0].description,
+            "author": found_images[0].author_name,
+            "author_url": found_images[0].author_url
+        } if found_images else None
+    }
+
 async def generate_post_details(request: Request, req):
     import traceback
-    from backend.main import generate_image_keywords, search_unsplash_images, get_channel_analysis, IMAGE_RESULTS_COUNT, PostImage, OPENROUTER_API_KEY, OPENAI_API_KEY, logger
-    from openai import AsyncOpenAI
+    from backend.main import IMAGE_RESULTS_COUNT, PostImage, logger
+    from backend.services.image_search_service import search_post_images
+    from backend.llm_gateway import complete as llm_complete, LLMGatewayError
     found_images = []
     api_error_message = None
+    quota = None
     try:
         telegram_user_id = request.headers.get("X-Telegram-User-Id")
         if telegram_user_id:
             from backend.services.supabase_subscription_service import SupabaseSubscriptionService
-            subscription_service = SupabaseSubscriptionService(supabase)
-            can_generate = await subscription_service.can_generate_post(int(telegram_user_id))
-            if not can_generate:
-                usage = await subscription_service.get_user_usage(int(telegram_user_id))
-                reset_at = usage.get("reset_at")
+            subscription_service = SupabaseSubscriptionService(db)
+            # Сброс, проверка и списание лимита — один запрос к БД
+            quota = await subscription_service.consume_quota(int(telegram_user_id), "post")
+            if not quota.get("allowed"):
+                reset_at = quota.get("reset_at")
                 raise HTTPException(status_code=403, detail=f"Достигнут лимит в 2 генерации постов для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.")
         if not telegram_user_id:
             logger.warning("Запрос генерации поста без идентификации пользователя Telegram")
             raise HTTPException(status_code=401, detail="Для генерации постов необходимо авторизоваться через Telegram")
-        topic_idea = req.get("topic_idea")
-        format_style = req.get("format_style")
-        channel_name = req.get("channel_name", "")
-        post_samples = req.get("post_samples") or []
-        if not post_samples and channel_name:
-            try:
-                channel_data = await get_channel_analysis(request, channel_name)
-                if channel_data and "analyzed_posts_sample" in channel_data:
-                    post_samples = channel_data["analyzed_posts_sample"]
-                    logger.info(f"Получено {len(post_samples)} примеров постов для канала @{channel_name}")
-            except Exception as e:
-                logger.warning(f"Не удалось получить примеры постов для канала @{channel_name}: {e}")
-        
-        # Проверка наличия хотя бы одного API ключа
-        if not OPENROUTER_API_KEY and not OPENAI_API_KEY:
-            logger.warning("Генерация деталей поста невозможна: отсутствуют OPENROUTER_API_KEY и OPENAI_API_KEY")
-            raise HTTPException(status_code=503, detail="API для генерации текста недоступен")
-            
-        # Получаем последние посты для контекста
-        recent_posts = []
-        try:
-            recent_posts_response = await get_posts(request, channel_name)
-            if recent_posts_response and len(recent_posts_response) > 0:
-                recent_posts = [post.get("generated_text", "") for post in recent_posts_response[:3] if post.get("generated_text")]
-                logger.info(f"Найдено {len(recent_posts)} предыдущих постов для контекста")
-        except Exception as e:
-            logger.warning(f"Не удалось получить предыдущие посты для контекста: {e}")
-
-        # Анализ тональности и временной контекст
-        from datetime import datetime
-        current_time = datetime.now()
-        
-        # Временной контекст
-        if current_time.hour < 12:
-            time_context = "утренний пост (мотивация, планы, свежие новости)"
-        elif current_time.hour < 18:
-            time_context = "дневной пост (полезная информация, обзоры, анализ)"
-        else:
-            time_context = "вечерний пост (размышления, итоги, развлекательный контент)"
-
-        # Анализ тональности и структуры из примеров
-        tone_instruction = ""
-        structure_instruction = ""
-        if post_samples:
-            # Анализ тональности
-            formal_indicators = sum(1 for sample in post_samples if any(word in sample.lower() for word in ["уважаемые", "господа", "коллеги"]))
-            casual_indicators = sum(1 for sample in post_samples if any(word in sample.lower() for word in ["привет", "друзья", "ребята", "😊", "👋"]))
-            
-            if formal_indicators > casual_indicators:
-                tone_instruction = "Поддерживай официальный, профессиональный тон общения."
-            elif casual_indicators > formal_indicators:
-                tone_instruction = "Используй дружелюбный, неформальный стиль общения."
-            else:
-                tone_instruction = "Используй нейтральный, но доброжелательный тон."
-            
-            # Анализ структуры постов
-            avg_length = sum(len(post) for post in post_samples) // len(post_samples)
-            avg_paragraphs = sum(post.count('\n\n') + 1 for post in post_samples) // len(post_samples)
-            avg_sentences = sum(post.count('.') + post.count('!') + post.count('?') for post in post_samples) // len(post_samples)
-            
-            structure_instruction = f"\nСТРУКТУРА из примеров: средняя длина поста ~{avg_length} символов, ~{avg_paragraphs} абзацев, ~{avg_sentences} предложений. СТРОГО следуй этой структуре!"
-
-        # Адаптивные инструкции для форматов
-        format_instructions = {
-            "обзор": "Структурируй обзор с четкими разделами и выводами",
-            "новость": "Начни с ключевого факта, добавь контекст и значимость",
-            "вопрос": "Сформулируй интригующий вопрос и направь размышления читателя", 
-            "совет": "Дай практичный, применимый совет с конкретными шагами",
-            "история": "Расскажи увлекательную историю с началом, развитием и выводом",
-            "список": "Создай структурированный список с полезными пунктами",
-            "мнение": "Выскажи аргументированную позицию с обоснованием"
-        }
-        
-        format_instruction = format_instructions.get(format_style.lower(), "")
-
-        # Улучшенный system_prompt с акцентом на копирование стиля и контекст
-        if post_samples:
-            system_prompt = f"""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — сгенерировать текст поста на основе идеи и формата, который будет готов к публикации.
-
-КРИТИЧЕСКИ ВАЖНО: если даны примеры постов, ты должен максимально точно копировать их стиль, структуру, форматирование, длину, тональность, особенности подачи. 
-
-СТРУКТУРА И ДЛИНА:
-• Анализируй длину примеров постов и создавай пост ТОЧНО такой же длины (±10%)
-• Копируй количество абзацев и их размер из примеров
-• Сохраняй структуру: если в примерах короткие абзацы — делай короткие, если длинные — делай длинные
-• Повторяй стиль разделения на абзацы (одна строка, двойной перенос и т.д.)
-• Если в примерах посты по 3-5 предложений — пиши столько же, если по 10-15 — следуй этому
-
-НЕ используй никаких других форматов, кроме как в примерах. Не добавляй ничего нового, не меняй структуру, не используй хэштеги, если их нет в примерах.
-
-АБСОЛЮТНО ЗАПРЕЩЕНО: квадратные скобки [], фигурные скобки {{}}, слова "ссылка", "контакт", "название", любые placeholder'ы и незаполненные места.
-
-Контекст времени: {time_context}
-{tone_instruction}
-{f'Особенности формата: {format_instruction}' if format_instruction else ''}
-
-Соблюдай грамматику русского языка: используй тире (—) для пауз, дефисы (-) в составных словах, правильную пунктуацию.
-
-В ответе только готовый текст поста, без пояснений, без повторения инструкции, без примеров, только сам пост."""
-        else:
-            system_prompt = f"""Ты — опытный контент-маркетолог для Telegram-каналов. Твоя задача — сгенерировать текст поста на основе идеи и формата, который будет готов к публикации.
-
-Пост должен быть структурированным, соответствовать теме и формату, быть готовым к публикации без шаблонов и пояснений. Критически важно: максимально точно копируй стиль, тон, манеру изложения, длину, форматирование и особенности из примеров постов, если они есть.
-
-Контекст времени: {time_context}
-{tone_instruction}
-{f'Особенности формата: {format_instruction}' if format_instruction else ''}
-
-Соблюдай грамматику русского языка: используй тире (—) для пауз, дефисы (-) в составных словах, правильную пунктуацию.
-
-В ответе выдай только готовый текст поста, без пояснений, без повторения инструкции, без примеров, только сам пост."""
-        # Улучшенный user_prompt с контекстом и упрощенными запретами
-        user_prompt = f"""Создай пост для Telegram-канала "@{channel_name}" на тему:
-"{topic_idea}"
-
-Формат поста: {format_style}
-
-Напиши полный текст поста, который будет готов к публикации."""
-
-        # Добавляем контекст предыдущих постов
-        if recent_posts:
-            recent_topics = []
-            for post in recent_posts:
-                if post:
-                    # Берем первые 50 символов для краткого описания
-                    topic_preview = post[:50].replace('\n', ' ').strip()
-                    if topic_preview:
-                        recent_topics.append(topic_preview + "...")
-            
-            if recent_topics:
-                user_prompt += f"""
-
-Последние посты канала (для контекста, НЕ повторяй эти темы):
-{'; '.join(recent_topics[:3])}
+        prompt = await _build_post_prompts(request, req)
+        topic_idea = prompt["topic_idea"]
+        format_style = prompt["format_style"]
+        channel_name = prompt["channel_name"]
 
-Создай пост, который логически дополняет развитие канала, но освещает новые аспекты темы."""
-
-        # Усиленные запреты для готовности к публикации
-        user_prompt += """
-
-КРИТИЧЕСКИ ВАЖНО для готовности к публикации: 
-СТРОГО ЗАПРЕЩЕНО использовать:
-• Любые квадратные скобки [] (включая [ссылка], [контакт], [название], [дата], [пример])
-• Любые фигурные скобки {{}}
-• Слова: "ссылка", "контакт", "email", "телефон", "название", "дата", "пример", "шаблон"
-• Фразы: "добавьте свой", "укажите", "заполните", "см. ниже", "см. выше", "подробнее"
-• Любые placeholder'ы и места для заполнения
-
-Создай ГОТОВЫЙ текст с конкретными фактами, цифрами и примерами БЕЗ пустых мест.
-
-ГРАММАТИКА: Соблюдай правила русского языка:
-• Используй тире (—) в предложениях для пауз и противопоставлений
-• Ставь дефисы (-) в сложных словах: "контент-маркетинг", "SMM-продвижение", "интернет-канал"
-• Правильно оформляй перечисления и диалоги
-• Проверяй пунктуацию и орфографию
-• Пиши сложные и составные слова, а также устойчивые выражения с дефисом (например: кто-то, что-то, из-за, по-настоящему, когда-либо, где-нибудь, по-русски и т.д.) — не допускай их написания слитно или с ошибками"""
-
-        # Добавляем примеры постов канала
-        if post_samples:
-            sample_text = "\n\n---\n\n".join(post_samples[:10])
-            user_prompt += f"""
-
-Примеры постов канала (копируй их стиль, структуру, форматирование, длину, тональность):
-{sample_text}"""
-
-        user_prompt += "\n\nВ ответе выдай только готовый текст поста, без пояснений и примеров."
-        
-        # Сначала пробуем OpenRouter API, если он доступен
+        # Генерация через LLM-шлюз: ретраи, circuit breaker и переход на OpenAI внутри llm_complete
         post_text = ""
         used_backup_api = False
+        try:
+            logger.info(f"Отправка запроса на генерацию поста по идее через LLM-шлюз: {topic_idea}")
+            completion = await llm_complete(
+                prompt["messages"],
+                temperature=0.7,
+                max_tokens=prompt["max_tokens"],
+                deadline=POST_GENERATION_DEADLINE,
+                template=prompt["template"],
+            )
+            used_backup_api = completion.used_fallback
+            post_text = await _fix_placeholder_paragraphs(_clean_post_text(completion.text), topic_idea)
+            logger.info(f"Получен текст поста через {completion.provider} ({len(post_text)} символов)")
+        except LLMGatewayError as api_error:
+            api_error_message = f"Ошибка соединения с API: {str(api_error)}"
+            logger.error(f"Ошибка при генерации поста через LLM-шлюз: {api_error}")
+            post_text = "[Текст не сгенерирован из-за ошибки API]"
+            # Пост не сгенерирован — возвращаем лимит, как и потоковая генерация
+            if quota and quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "post")
+                quota = None
         
-        if OPENROUTER_API_KEY:
-            try:
-                logger.info(f"Отправка запроса на генерацию поста по идее через OpenRouter API: {topic_idea}")
-                client = AsyncOpenAI(
-                    base_url="https://openrouter.ai/api/v1",
-                    api_key=OPENROUTER_API_KEY
-                )
-                # --- Новый блок: расчет средней длины постов ---
-                avg_length = 0
-                post_samples = req.get("post_samples") or req.post_samples if hasattr(req, "post_samples") else None
-                if post_samples:
-                    avg_length = int(sum(len(t) for t in post_samples) / len(post_samples))
-                    avg_tokens = max(100, min(1200, avg_length // 3))
-                else:
-                    avg_tokens = 600
-                response = await client.chat.completions.create(
-                        model="google/gemini-2.5-flash-preview",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=avg_tokens,
-                    timeout=60,
-                    extra_headers={
-                        "HTTP-Referer": "https://content-manager.onrender.com",
-                        "X-Title": "Smart Content Assistant"
-                    }
-                )
-                if response and response.choices and len(response.choices) > 0 and response.choices[0].message and response.choices[0].message.content:
-                    post_text = response.choices[0].message.content.strip()
-                    # Удаляем кавычки по краям, если они есть
-                    post_text = re.sub(r'^[\"“"«»\']+|[\"""«»\']+$', '', post_text).strip()
-                    # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
-                    for unwanted in ["Ты — опытный контент-маркетолог", "Вот несколько примеров постов", "Формат поста:", "Твоя задача", "В ответе выдай только"]:
-                        if post_text.lower().startswith(unwanted.lower()):
-                            post_text = post_text.split("\n", 1)[-1].strip()
-                    logger.info(f"Получен текст поста через OpenRouter API ({len(post_text)} символов)")
-                elif response and hasattr(response, 'error') and response.error:
-                    err_details = response.error
-                    api_error_message = getattr(err_details, 'message', str(err_details))
-                    logger.error(f"OpenRouter API вернул ошибку: {api_error_message}")
-                    # Ошибка OpenRouter API - пробуем запасной вариант
-                    raise Exception(f"OpenRouter API вернул ошибку: {api_error_message}")
-                else:
-                    api_error_message = "OpenRouter API вернул некорректный или пустой ответ"
-                    logger.error(f"Некорректный или пустой ответ от OpenRouter API. Ответ: {response}")
-                    # Ошибка OpenRouter API - пробуем запасной вариант
-                    raise Exception("Некорректный или пустой ответ от OpenRouter API")
-            except Exception as api_error:
-                # В случае ошибки с OpenRouter API, проверяем наличие запасного ключа
-                api_error_message = f"Ошибка соединения с OpenRouter API: {str(api_error)}"
-                logger.error(f"Ошибка при запросе к OpenRouter API: {api_error}", exc_info=True)
-                # Пробуем использовать OpenAI API как запасной вариант
-                if OPENAI_API_KEY:
-                    used_backup_api = True
-                    logger.info(f"Попытка использования OpenAI API как запасного варианта для идеи: {topic_idea}")
-                    try:
-                        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-                        openai_response = await openai_client.chat.completions.create(
-                            model="gpt-3.5-turbo",  # Используем GPT-3.5 Turbo как запасной вариант
-                            messages=[
-                                {"role": "system", "content": system_prompt},
-                                {"role": "user", "content": user_prompt}
-                            ],
-                            temperature=0.7,
-                            max_tokens=850
-                        )
-                        if openai_response and openai_response.choices and len(openai_response.choices) > 0 and openai_response.choices[0].message:
-                            post_text = openai_response.choices[0].message.content.strip()
-                            # Удаляем кавычки по краям, если они есть
-                            post_text = re.sub(r'^[\"“"«»\']+|[\"""«»\']+$', '', post_text).strip()
-                            # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
-                            for unwanted in ["Ты — опытный контент-маркетолог", "Вот несколько примеров постов", "Формат поста:", "Твоя задача", "В ответе выдай только"]:
-                                if post_text.lower().startswith(unwanted.lower()):
-                                    post_text = post_text.split("\n", 1)[-1].strip()
-                            logger.info(f"Получен текст поста через запасной OpenAI API ({len(post_text)} символов)")
-                            # Сбрасываем сообщение об ошибке, так как запасной вариант сработал
-                            api_error_message = None
-                        else:
-                            logger.error(f"Некорректный или пустой ответ от запасного OpenAI API")
-                            post_text = "[Текст не сгенерирован из-за ошибок API]"
-                    except Exception as openai_error:
-                        logger.error(f"Ошибка при использовании запасного OpenAI API: {openai_error}", exc_info=True)
-                        post_text = "[Текст не сгенерирован из-за ошибок API]"
-                else:
-                    logger.error("Запасной OPENAI_API_KEY не настроен, невозможно использовать альтернативный API")
-                post_text = "[Текст не сгенерирован из-за ошибки API]"
-        
-        # Если нет OPENROUTER_API_KEY, но есть OPENAI_API_KEY, используем его напрямую
-        elif OPENAI_API_KEY:
-            used_backup_api = True
-            logger.info(f"OPENROUTER_API_KEY отсутствует, используем OpenAI API напрямую для идеи: {topic_idea}")
-            try:
-                openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-                
-                openai_response = await openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo",  # Используем GPT-3.5 Turbo
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=850
-                )
-                
-                if openai_response and openai_response.choices and len(openai_response.choices) > 0 and openai_response.choices[0].message:
-                    post_text = openai_response.choices[0].message.content.strip()
-                    # Удаляем кавычки по краям, если они есть
-                    post_text = re.sub(r'^[\"“"«»\']+|[\"""«»\']+$', '', post_text).strip()
-                    # Фильтрация лишнего: убираем возможные повторения промпта или инструкций
-                    for unwanted in ["Ты — опытный контент-маркетолог", "Вот несколько примеров постов", "Формат поста:", "Твоя задача", "В ответе выдай только"]:
-                        if post_text.lower().startswith(unwanted.lower()):
-                            post_text = post_text.split("\n", 1)[-1].strip()
-                    logger.info(f"Получен текст поста через OpenAI API ({len(post_text)} символов)")
-                else:
-                    logger.error(f"Некорректный или пустой ответ от OpenAI API")
-                    post_text = "[Текст не сгенерирован из-за ошибки API]"
-            except Exception as openai_error:
-                api_error_message = f"Ошибка соединения с OpenAI API: {str(openai_error)}"
-                logger.error(f"Ошибка при запросе к OpenAI API: {openai_error}", exc_info=True)
-                post_text = "[Текст не сгенерирован из-за ошибки API]"
-        
-        # Генерация ключевых слов для поиска изображений
-        image_keywords = await generate_image_keywords(post_text, topic_idea, format_style)
-        logger.info(f"Сгенерированы ключевые слова для поиска изображений: {image_keywords}")
-        
-        # Поиск изображений
-        for keyword in image_keywords[:3]:
-            try:
-                image_count = min(5 - len(found_images), 3)
-                if image_count <= 0:
-                    break
-                images = await search_unsplash_images(keyword, count=image_count, topic=topic_idea, format_style=format_style, post_text=post_text)
-                existing_ids = {img.id for img in found_images}
-                unique_images = [img for img in images if img.id not in existing_ids]
-                found_images.extend(unique_images)
-                if len(found_images) >= 5:
-                    found_images = found_images[:5]
-                    break
-                logger.info(f"Найдено {len(unique_images)} уникальных изображений по ключевому слову '{keyword}'")
-            except Exception as e:
-                logger.error(f"Ошибка при поиске изображений для ключевого слова '{keyword}': {e}")
-                continue
-                
-        if not found_images:
-            try:
-                found_images = await search_unsplash_images(topic_idea, count=5, topic=topic_idea, format_style=format_style)
-                logger.info(f"Найдено {len(found_images)} изображений по основной теме")
-            except Exception as e:
-                logger.error(f"Ошибка при поиске изображений по основной теме: {e}")
-                found_images = []
+        # Поиск изображений: ключевые слова генерируются один раз, запросы к Unsplash идут параллельно
+        try:
+            found_images = await search_post_images(post_text, topic_idea, format_style, limit=IMAGE_RESULTS_COUNT)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске изображений для поста: {e}")
+            found_images = []
                 
         logger.info(f"Подготовлено {len(found_images)} предложенных изображений")
         
@@ -690,27 +568,99 @@ async def generate_post_details(request: Request, req):
         if api_error_message:
             response_message = f"Ошибка генерации текста: {api_error_message}. Изображений найдено: {len(found_images[:IMAGE_RESULTS_COUNT])}"
             
-        # После успешной генерации поста увеличиваем счетчик использования
-        if telegram_user_id:
-            has_subscription = await subscription_service.has_active_subscription(int(telegram_user_id))
-            if not has_subscription:
-                await subscription_service.increment_post_usage(int(telegram_user_id))
-                
         return {
             "generated_text": post_text,
-            "found_images": [img.dict() if hasattr(img, 'dict') else img for img in found_images[:IMAGE_RESULTS_COUNT]],
             "message": response_message,
             "channel_name": channel_name,
-            "selected_image_data": {
-                "url": found_images[0].regular_url if found_images else "",
-                "id": found_images[0].id if found_images else None,
-                "preview_url": found_images[0].preview_url if found_images else "",
-                "alt": found_images[0].description if found_images else "",
-                "author": found_images[0].author_name if found_images else "",
-                "author_url": found_images[0].author_url if found_images else ""
-            } if found_images else None
+            **_images_payload(found_images[:IMAGE_RESULTS_COUNT])
         }
+    except HTTPException as http_err:
+        if http_err.status_code >= 500 and quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "post")
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации деталей поста: {e}")
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера при генерации деталей поста: {str(e)}") 
\ No newline at end of file
+        if quota and quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "post")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера при генерации деталей поста: {str(e)}") 
+
+async def generate_post_details_stream(request: Request, req):
+    """
+    Потоковая генерация поста (Server-Sent Events). События:
+    token — очередной фрагмент текста, text — итоговый очищенный текст (абзацы с плейсхолдерами переписаны),
+    images — найденные изображения, error — ошибка генерации, done — завершение.
+    Поиск изображений по теме поста запускается сразу и идет параллельно с генерацией текста.
+    """
+    from backend.main import IMAGE_RESULTS_COUNT
+    from backend.services.image_search_service import search_post_images
+    from backend.services.supabase_subscription_service import SupabaseSubscriptionService
+    from backend.llm_gateway import stream as llm_stream, LLMGatewayError, PROVIDER_ORDER
+    telegram_user_id = request.headers.get("X-Telegram-User-Id")
+    if not telegram_user_id:
+        logger.warning("Запрос потоковой генерации поста без идентификации пользователя Telegram")
+        raise HTTPException(status_code=401, detail="Для генерации постов необходимо авторизоваться через Telegram")
+    subscription_service = SupabaseSubscriptionService(db)
+    # Лимит списывается до начала потока, чтобы отказ пришел обычным HTTP ответом
+    quota = await subscription_service.consume_quota(int(telegram_user_id), "post")
+    if not quota.get("allowed"):
+        reset_at = quota.get("reset_at")
+        raise HTTPException(status_code=403, detail=f"Достигнут лимит в 2 генерации постов для бесплатной подписки. Следующая попытка будет доступна после: {reset_at}. Лимиты обновляются каждые 3 дня. Оформите подписку для снятия ограничений.")
+    try:
+        prompt = await _build_post_prompts(request, req)
+    except Exception as e:
+        if quota.get("consumed"):
+            await subscription_service.release_quota(int(telegram_user_id), "post")
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Ошибка при подготовке потоковой генерации поста: {e}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера при генерации деталей поста: {str(e)}")
+    topic_idea = prompt["topic_idea"]
+    format_style = prompt["format_style"]
+
+    async def event_stream():
+        # Текста еще нет — ключевые слова для изображений подбираются по теме поста
+        images_task = asyncio.create_task(
+            search_post_images(topic_idea, topic_idea, format_style, limit=IMAGE_RESULTS_COUNT)
+        )
+        info: Dict[str, Any] = {}
+        chunks: List[str] = []
+        generated = False
+        try:
+            logger.info(f"Потоковая генерация поста по идее через LLM-шлюз: {topic_idea}")
+            try:
+                async for delta in llm_stream(
+                    prompt["messages"],
+                    temperature=0.7,
+                    max_tokens=prompt["max_tokens"],
+                    deadline=POST_GENERATION_DEADLINE,
+                    info=info,
+                    template=prompt["template"],
+                ):
+                    chunks.append(delta)
+                    yield sse_event("token", {"text": delta})
+                post_text = await _fix_placeholder_paragraphs(_clean_post_text("".join(chunks)), topic_idea)
+                generated = True
+                logger.info(f"Потоковая генерация поста завершена через {info.get('provider')} ({len(post_text)} символов)")
+                yield sse_event("text", {
+                    "generated_text": post_text,
+                    "used_backup_api": info.get("provider") not in (None, PROVIDER_ORDER[0]),
+                })
+            except LLMGatewayError as api_error:
+                logger.error(f"Ошибка при потоковой генерации поста через LLM-шлюз: {api_error}")
+                yield sse_event("error", {"message": f"Ошибка генерации текста: {str(api_error)}"})
+
+            try:
+                found_images = await images_task
+            except Exception as e:
+                logger.error(f"Ошибка при поиске изображений для поста: {e}")
+                found_images = []
+            yield sse_event("images", _images_payload(found_images[:IMAGE_RESULTS_COUNT]))
+            yield sse_event("done", {"channel_name": prompt["channel_name"]})
+        finally:
+            # Клиент отключился или генерация не удалась — останавливаем поиск и возвращаем лимит
+            images_task.cancel()
+            if not generated and quota.get("consumed"):
+                await subscription_service.release_quota(int(telegram_user_id), "post")
+
+    return sse_response(event_stream())
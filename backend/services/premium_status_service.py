@@ -0,0 +1,62 @@
+# Сервис проверки премиум-статуса с пулом asyncpg и коротким TTL-кэшем
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from backend.db import get_pg_pool
+from backend.main import logger
+
+PREMIUM_CACHE_TTL = float(os.getenv("PREMIUM_CACHE_TTL", "30"))
+
+# user_id -> (момент истечения по time.monotonic(), статус)
+_premium_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+
+ACTIVE_SUBSCRIPTION_QUERY = """
+SELECT id, user_id, start_date, end_date, is_active, payment_id, created_at, updated_at
+FROM user_subscription
+WHERE user_id = $1
+  AND is_active = TRUE
+  AND end_date > NOW()
+ORDER BY end_date DESC
+LIMIT 1
+"""
+
+
+def invalidate_premium_status(user_id: int):
+    """Сбрасывает закэшированный статус пользователя (например, после successful_payment)."""
+    if _premium_cache.pop(int(user_id), None) is not None:
+        logger.info(f"Кэш премиум-статуса сброшен для пользователя {user_id}")
+
+
+async def get_premium_status(user_id: int, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Возвращает {"has_premium", "subscription_end_date", "end_date"} для пользователя.
+    Запрос к БД идет через общий пул asyncpg; результат кэшируется на PREMIUM_CACHE_TTL секунд,
+    но не дольше момента окончания подписки.
+    """
+    user_id = int(user_id)
+    now = time.monotonic()
+    if use_cache:
+        cached = _premium_cache.get(user_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    pool = await get_pg_pool()
+    async with pool.acquire() as conn:
+        subscription = await conn.fetchrow(ACTIVE_SUBSCRIPTION_QUERY, user_id)
+
+    end_date: Optional[datetime] = subscription["end_date"] if subscription else None
+    status = {
+        "has_premium": subscription is not None,
+        "subscription_end_date": end_date.strftime('%Y-%m-%d %H:%M:%S') if end_date else None,
+        "end_date": end_date,
+    }
+
+    ttl = PREMIUM_CACHE_TTL
+    if end_date is not None:
+        end_date_utc = end_date if end_date.tzinfo else end_date.replace(tzinfo=timezone.utc)
+        ttl = min(ttl, max(0.0, (end_date_utc - datetime.now(timezone.utc)).total_seconds()))
+    if ttl > 0:
+        _premium_cache[user_id] = (now + ttl, status)
+    return status
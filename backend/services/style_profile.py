@@ -0,0 +1,162 @@
+# Профиль стиля канала: считается один раз при анализе и хранится в channel_analysis.style_profile
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.db import db
+from backend.main import logger
+from backend.prompt_budget import count_tokens
+from backend.services.analysis_cache import normalize_channel_username
+
+# Увеличивайте версию при изменении состава профиля: старые профили пересчитываются из sample_posts
+STYLE_PROFILE_VERSION = 1
+
+STYLE_CONTEXT_TTL = float(os.getenv("STYLE_CONTEXT_TTL", "300"))
+STYLE_CONTEXT_MAX_ENTRIES = int(os.getenv("STYLE_CONTEXT_MAX_ENTRIES", "2000"))
+# Сколько последних сохраненных постов пользователя попадает в контекст генерации
+RECENT_POSTS_LIMIT = 3
+
+FORMAL_MARKERS = ("уважаемые", "господа", "коллеги")
+CASUAL_MARKERS = ("привет", "друзья", "ребята", "😊", "👋")
+
+_EMOJI_RE = re.compile("[\U0001F300-\U0001FAFF☀-➿⭐⭕]")
+_HASHTAG_RE = re.compile(r"(?<!\w)#\w+")
+_LIST_LINE_RE = re.compile(r"^\s*(?:[-•*▪️✅🔹🔸]|\d+[.)])\s+", re.MULTILINE)
+
+# (user_id, канал) -> (момент истечения по time.monotonic(), контекст генерации)
+_style_context_cache: "OrderedDict[Tuple[int, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def compute_style_profile(texts: List[str]) -> Dict[str, Any]:
+    """
+    Компактный профиль стиля по текстам постов: тональность, длина, структура, эмодзи.
+    Пустой словарь, если текстов нет.
+    """
+    texts = [t for t in texts if t and t.strip()]
+    if not texts:
+        return {}
+    count = len(texts)
+    formal = sum(1 for t in texts if any(m in t.lower() for m in FORMAL_MARKERS))
+    casual = sum(1 for t in texts if any(m in t.lower() for m in CASUAL_MARKERS))
+    if formal > casual:
+        tone = "formal"
+    elif casual > formal:
+        tone = "casual"
+    else:
+        tone = "neutral"
+    lengths = sorted(len(t) for t in texts)
+    total_chars = sum(lengths)
+    emoji_count = sum(len(_EMOJI_RE.findall(t)) for t in texts)
+    return {
+        "version": STYLE_PROFILE_VERSION,
+        "posts_count": count,
+        "tone": tone,
+        "avg_length": total_chars // count,
+        "min_length": lengths[0],
+        "max_length": lengths[-1],
+        "avg_tokens": sum(count_tokens(t) for t in texts) // count,
+        "avg_paragraphs": sum(t.count("\n\n") + 1 for t in texts) // count,
+        "avg_sentences": sum(t.count(".") + t.count("!") + t.count("?") for t in texts) // count,
+        # эмодзи на 1000 символов текста
+        "emoji_density": round(emoji_count * 1000 / total_chars, 2) if total_chars else 0.0,
+        "uses_hashtags": sum(1 for t in texts if _HASHTAG_RE.search(t)) * 2 > count,
+        "uses_lists": sum(1 for t in texts if len(_LIST_LINE_RE.findall(t)) >= 2) * 2 > count,
+    }
+
+
+def style_instructions(profile: Dict[str, Any]) -> Tuple[str, str]:
+    """Инструкции по тону и структуре для промпта генерации поста: (tone_instruction, structure_instruction)."""
+    if not profile:
+        return "", ""
+    tone = profile.get("tone")
+    if tone == "formal":
+        tone_instruction = "Поддерживай официальный, профессиональный тон общения."
+    elif tone == "casual":
+        tone_instruction = "Используй дружелюбный, неформальный стиль общения."
+    else:
+        tone_instruction = "Используй нейтральный, но доброжелательный тон."
+
+    structure_instruction = (
+        f"\nСТРУКТУРА из примеров: средняя длина поста ~{profile.get('avg_length', 0)} символов, "
+        f"~{profile.get('avg_paragraphs', 0)} абзацев, ~{profile.get('avg_sentences', 0)} предложений. "
+        "СТРОГО следуй этой структуре!"
+    )
+    emoji_density = profile.get("emoji_density", 0)
+    if emoji_density >= 5:
+        structure_instruction += " Активно используй эмодзи, как в примерах."
+    elif emoji_density < 0.5:
+        structure_instruction += " Не используй эмодзи."
+    if profile.get("uses_lists"):
+        structure_instruction += " Оформляй перечисления списками."
+    if not profile.get("uses_hashtags"):
+        structure_instruction += " Без хэштегов."
+    return tone_instruction, structure_instruction
+
+
+def invalidate_style_context(user_id: int, channel_name: Optional[str] = None):
+    """Сбрасывает контекст генерации пользователя для канала (или для всех его каналов)."""
+    user_id = int(user_id)
+    if channel_name:
+        _style_context_cache.pop((user_id, normalize_channel_username(channel_name)), None)
+        return
+    for key in [k for k in _style_context_cache if k[0] == user_id]:
+        _style_context_cache.pop(key, None)
+
+
+async def _load_style_context(user_id: int, channel_name: str) -> Dict[str, Any]:
+    analysis_query = (
+        db.table("channel_analysis").select("sample_posts,style_profile")
+        .eq("user_id", user_id).eq("channel_name", channel_name).limit(1).execute()
+    )
+    recent_query = (
+        db.table("saved_posts").select("generated_text")
+        .eq("user_id", user_id).eq("channel_name", channel_name)
+        .order("target_date", desc=True).limit(RECENT_POSTS_LIMIT).execute()
+    )
+    analysis_result, recent_result = await asyncio.gather(analysis_query, recent_query, return_exceptions=True)
+
+    samples: List[str] = []
+    profile: Dict[str, Any] = {}
+    if isinstance(analysis_result, Exception):
+        logger.warning(f"Не удалось получить анализ канала @{channel_name}: {analysis_result}")
+    elif getattr(analysis_result, "data", None):
+        row = analysis_result.data[0]
+        samples = [s for s in (row.get("sample_posts") or []) if isinstance(s, str) and s]
+        profile = row.get("style_profile") or {}
+    if samples and profile.get("version") != STYLE_PROFILE_VERSION:
+        # Анализ сохранен до появления профиля (или старой версии) — считаем по сохраненным примерам
+        profile = compute_style_profile(samples)
+
+    recent_posts: List[str] = []
+    if isinstance(recent_result, Exception):
+        logger.warning(f"Не удалось получить предыдущие посты канала @{channel_name}: {recent_result}")
+    elif getattr(recent_result, "data", None):
+        recent_posts = [p.get("generated_text") for p in recent_result.data if p.get("generated_text")]
+
+    return {"profile": profile, "samples": samples, "recent_posts": recent_posts}
+
+
+async def get_style_context(user_id: int, channel_name: str) -> Dict[str, Any]:
+    """
+    Контекст генерации поста для канала: {"profile", "samples", "recent_posts"}.
+    Загружается двумя параллельными узкими запросами и кэшируется на STYLE_CONTEXT_TTL секунд;
+    сбрасывается при новом анализе канала и при изменении сохраненных постов.
+    """
+    user_id = int(user_id)
+    key = (user_id, normalize_channel_username(channel_name))
+    now = time.monotonic()
+    cached = _style_context_cache.get(key)
+    if cached and cached[0] > now:
+        _style_context_cache.move_to_end(key)
+        return cached[1]
+
+    context = await _load_style_context(user_id, channel_name)
+    if STYLE_CONTEXT_TTL > 0:
+        _style_context_cache[key] = (now + STYLE_CONTEXT_TTL, context)
+        _style_context_cache.move_to_end(key)
+        while len(_style_context_cache) > STYLE_CONTEXT_MAX_ENTRIES:
+            _style_context_cache.popitem(last=False)
+    return context
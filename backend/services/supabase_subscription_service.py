@@ -1,9 +1,13 @@
 from datetime import datetime, timedelta, timezone
+import json
 import logging
 from typing import Dict, Any, Optional
 from dateutil.relativedelta import relativedelta
+import asyncpg
 import httpx
 import os
+from backend.db import get_pg_pool
+from backend.http_clients import get_http_client
 
 # Константы для бесплатных лимитов
 FREE_ANALYSIS_LIMIT = 5
@@ -14,11 +18,34 @@ SUBSCRIPTION_DURATION_MONTHS = 1
 RESET_PERIOD_DAYS = 3  # Сброс каждые 3 дня
 RESET_PERIOD_MINUTES = None  # Отключено, используем дни
 
+# Виды квот для consume_quota: вид -> (колонка счетчика в user_usage_stats, бесплатный лимит)
+QUOTA_KINDS = {
+    "analysis": ("analysis_count", FREE_ANALYSIS_LIMIT),
+    "post": ("post_generation_count", FREE_POST_LIMIT),
+    "idea": ("ideas_generation_count", FREE_IDEAS_LIMIT),
+}
+
+# Функция consume_quota создается миграцией backend/migrations/008_consume_quota.sql
+CONSUME_QUOTA_SQL = "SELECT consume_quota($1, $2, $3, $4)"
+
+# Проверка квоты без списания: подписка и счетчик одним запросом, счетчик с прошедшим reset_at считается нулевым
+PEEK_QUOTA_SQL = """
+SELECT
+    EXISTS (
+        SELECT 1 FROM user_subscription
+        WHERE user_id = $1 AND is_active = TRUE AND end_date > NOW()
+    ) AS has_premium,
+    CASE WHEN u.reset_at IS NULL OR u.reset_at <= NOW() THEN 0 ELSE COALESCE(u.{column}, 0) END AS used,
+    u.reset_at
+FROM (SELECT 1) AS one
+LEFT JOIN user_usage_stats u ON u.user_id = $1
+"""
+
 logger = logging.getLogger("subscription_service")
 
 class SupabaseSubscriptionService:
     def __init__(self, supabase_client):
-        """Инициализирует сервис с клиентом Supabase."""
+        """Инициализирует сервис с асинхронным клиентом Supabase (backend.db.db)."""
         self.supabase = supabase_client
     
     async def get_user_usage(self, user_id: int) -> Dict[str, Any]:
@@ -27,7 +54,7 @@ class SupabaseSubscriptionService:
             now = datetime.now(timezone.utc)
             logger.info(f"Получение статистики для пользователя {user_id}. Текущая дата: {now.isoformat()}")
             
-            result = self.supabase.table("user_usage_stats").select("*").eq("user_id", user_id).execute()
+            result = await self.supabase.table("user_usage_stats").select("*").eq("user_id", user_id).execute()
             
             if result.data and len(result.data) > 0:
                 usage_data = result.data[0]
@@ -82,7 +109,7 @@ class SupabaseSubscriptionService:
             logger.info(f"Создаем новую запись для пользователя {user_id}: {new_record}")
             
             try:
-                insert_result = self.supabase.table("user_usage_stats").insert(new_record).execute()
+                insert_result = await self.supabase.table("user_usage_stats").insert(new_record).execute()
                 if insert_result.data and len(insert_result.data) > 0:
                     logger.info(f"Запись успешно создана для пользователя {user_id}")
                     return insert_result.data[0]
@@ -110,7 +137,7 @@ class SupabaseSubscriptionService:
                 "analysis_count": usage.get("analysis_count", 0) + 1,
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
-            result = self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
+            result = await self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
             if result.data and len(result.data) > 0:
                 return result.data[0]
             return usage
@@ -130,7 +157,7 @@ class SupabaseSubscriptionService:
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
             
-            result = self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
+            result = await self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
             
             if result.data and len(result.data) > 0:
                 return result.data[0]
@@ -145,7 +172,7 @@ class SupabaseSubscriptionService:
         """Получает активную подписку пользователя с проверкой даты окончания."""
         try:
             # Получаем все подписки пользователя, отсортированные по дате окончания
-            result = self.supabase.table("user_subscription").select("*").eq("user_id", user_id).order("end_date", desc=True).execute()
+            result = await self.supabase.table("user_subscription").select("*").eq("user_id", user_id).order("end_date", desc=True).execute()
             
             if not result.data or len(result.data) == 0:
                 return None
@@ -173,7 +200,7 @@ class SupabaseSubscriptionService:
                     now_utc = datetime.now(timezone.utc)
                     if end_date <= now_utc:
                         # Подписка истекла, деактивируем её
-                        self.supabase.table("user_subscription").update({"is_active": False}).eq("id", subscription.get("id")).execute()
+                        await self.supabase.table("user_subscription").update({"is_active": False}).eq("id", subscription.get("id")).execute()
                         logger.info(f"Деактивирована истекшая подписка пользователя {user_id}, end_date={end_date.isoformat()}, now={now_utc.isoformat()}")
                         
                         # Отправляем уведомление пользователю о том, что подписка закончилась
@@ -204,10 +231,10 @@ class SupabaseSubscriptionService:
             }
             
             # Сначала деактивируем все текущие подписки
-            self.supabase.table("user_subscription").update({"is_active": False}).eq("user_id", user_id).execute()
+            await self.supabase.table("user_subscription").update({"is_active": False}).eq("user_id", user_id).execute()
             
             # Создаем новую активную подписку
-            result = self.supabase.table("user_subscription").insert(subscription_data).execute()
+            result = await self.supabase.table("user_subscription").insert(subscription_data).execute()
             
             if result.data and len(result.data) > 0:
                 return result.data[0]
@@ -253,7 +280,7 @@ class SupabaseSubscriptionService:
             "reset_at": next_reset.isoformat(),
             "updated_at": now.isoformat()
         }
-        result = self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
+        result = await self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
         if result.data and len(result.data) > 0:
             return result.data[0]
         # Если запись не найдена, создаём новую
@@ -265,7 +292,7 @@ class SupabaseSubscriptionService:
             "reset_at": next_reset.isoformat(),
             "updated_at": now.isoformat()
         }
-        self.supabase.table("user_usage_stats").insert(new_record).execute()
+        await self.supabase.table("user_usage_stats").insert(new_record).execute()
         return new_record
     
     async def check_reset_counters(self, user_id: int) -> Dict[str, Any]:
@@ -321,7 +348,7 @@ class SupabaseSubscriptionService:
                 "ideas_generation_count": usage.get("ideas_generation_count", 0) + 1,
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
-            result = self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
+            result = await self.supabase.table("user_usage_stats").update(update_data).eq("user_id", user_id).execute()
             if result.data and len(result.data) > 0:
                 return result.data[0]
             return usage
@@ -329,6 +356,83 @@ class SupabaseSubscriptionService:
             logger.error(f"Ошибка при увеличении счетчика генерации идей: {e}")
             return {"user_id": user_id, "ideas_generation_count": 0} 
 
+    async def consume_quota(self, user_id: int, kind: str) -> Dict[str, Any]:
+        """
+        Атомарно сбрасывает счетчики при наступлении reset_at, проверяет лимит и списывает
+        одно использование вида kind ("analysis", "post", "idea") за один запрос к БД.
+        Возвращает {"allowed", "consumed", "has_premium", "reset_at", ...счетчики}.
+        """
+        if kind not in QUOTA_KINDS:
+            raise ValueError(f"Неизвестный вид квоты: {kind}")
+        limit = QUOTA_KINDS[kind][1]
+        try:
+            pool = await get_pg_pool()
+            async with pool.acquire() as conn:
+                raw = await conn.fetchval(CONSUME_QUOTA_SQL, int(user_id), kind, limit, RESET_PERIOD_DAYS)
+            quota = json.loads(raw) if isinstance(raw, str) else dict(raw)
+            logger.info(f"Квота '{kind}' для пользователя {user_id}: allowed={quota.get('allowed')}, consumed={quota.get('consumed')}")
+            return quota
+        except asyncpg.UndefinedFunctionError:
+            logger.warning("Функция consume_quota не найдена в БД (миграция 008 не применена), проверяем лимит в несколько запросов")
+        except Exception as e:
+            logger.error(f"Ошибка при атомарном списании квоты '{kind}' для user_id {user_id}: {e}", exc_info=True)
+        return await self._consume_quota_fallback(int(user_id), kind)
+
+    async def peek_quota(self, user_id: int, kind: str) -> Dict[str, Any]:
+        """
+        Проверяет лимит вида kind без списания и без побочных эффектов (не сбрасывает счетчики,
+        не обновляет подписку и не отправляет уведомлений) — один SELECT через пул asyncpg.
+        Возвращает {"allowed", "has_premium", "reset_at", "used", "limit"}.
+        """
+        if kind not in QUOTA_KINDS:
+            raise ValueError(f"Неизвестный вид квоты: {kind}")
+        column, limit = QUOTA_KINDS[kind]
+        pool = await get_pg_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(PEEK_QUOTA_SQL.format(column=column), int(user_id))
+        has_premium = bool(row["has_premium"])
+        used = int(row["used"] or 0)
+        reset_at = row["reset_at"]
+        return {
+            "user_id": user_id,
+            "kind": kind,
+            "limit": limit,
+            "used": used,
+            "allowed": has_premium or used < limit,
+            "has_premium": has_premium,
+            "reset_at": reset_at.isoformat() if reset_at else None,
+        }
+
+    async def _consume_quota_fallback(self, user_id: int, kind: str) -> Dict[str, Any]:
+        """Неатомарный вариант consume_quota на случай, если SQL-функция недоступна."""
+        column, limit = QUOTA_KINDS[kind]
+        if await self.has_active_subscription(user_id):
+            return {"user_id": user_id, "kind": kind, "limit": limit, "allowed": True, "consumed": False, "has_premium": True, "reset_at": None}
+        usage = await self.get_user_usage(user_id)
+        allowed = usage.get(column, 0) < limit
+        if allowed:
+            increment = {
+                "analysis": self.increment_analysis_usage,
+                "post": self.increment_post_usage,
+                "idea": self.increment_idea_usage,
+            }[kind]
+            usage = await increment(user_id)
+        return {**usage, "kind": kind, "limit": limit, "allowed": allowed, "consumed": allowed, "has_premium": False}
+
+    async def release_quota(self, user_id: int, kind: str):
+        """Возвращает списанное использование, если запрос не удалось выполнить."""
+        column = QUOTA_KINDS[kind][0]
+        try:
+            pool = await get_pg_pool()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    f"UPDATE user_usage_stats SET {column} = GREATEST(COALESCE({column}, 0) - 1, 0), updated_at = NOW() WHERE user_id = $1",
+                    int(user_id)
+                )
+            logger.info(f"Квота '{kind}' возвращена пользователю {user_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при возврате квоты '{kind}' для user_id {user_id}: {e}")
+
     async def send_subscription_expiry_notification(self, user_id: int) -> bool:
         """Отправляет уведомление о том, что подписка закончилась."""
         try:
@@ -340,22 +444,22 @@ class SupabaseSubscriptionService:
                 return False
                 
             telegram_api_url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.post(telegram_api_url, json={
-                        "chat_id": user_id,
-                        "text": message_text,
-                        "parse_mode": "HTML"
-                    })
-                    if response.status_code == 200:
-                        logger.info(f"Уведомление об окончании подписки успешно отправлено пользователю {user_id}")
-                        return True
-                    else:
-                        logger.error(f"Ошибка при отправке уведомления об окончании подписки: {response.status_code} {response.text}")
-                        return False
-                except Exception as e:
-                    logger.error(f"Исключение при отправке уведомления об окончании подписки в Telegram: {e}")
+            client = get_http_client("telegram_api")
+            try:
+                response = await client.post(telegram_api_url, json={
+                    "chat_id": user_id,
+                    "text": message_text,
+                    "parse_mode": "HTML"
+                })
+                if response.status_code == 200:
+                    logger.info(f"Уведомление об окончании подписки успешно отправлено пользователю {user_id}")
+                    return True
+                else:
+                    logger.error(f"Ошибка при отправке уведомления об окончании подписки: {response.status_code} {response.text}")
                     return False
+            except Exception as e:
+                logger.error(f"Исключение при отправке уведомления об окончании подписки в Telegram: {e}")
+                return False
         except Exception as e:
             logger.error(f"Ошибка при отправке уведомления об окончании подписки: {e}")
             return False 
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import httpx
+from backend.http_clients import get_http_client
 from fastapi import HTTPException, APIRouter, Request
 from fastapi.responses import JSONResponse
 
@@ -22,16 +23,16 @@ async def check_user_channel_subscription(user_id: int) -> tuple[bool, str | Non
         "user_id": user_id
     }
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            if not data.get("ok"):
-                error_description = data.get("description", "Неизвестная ошибка от Telegram API")
-                print(f"Ошибка Telegram API при getChatMember для user {user_id} на канал @{TARGET_CHANNEL_USERNAME}: {error_description}")
-                return False, error_description
-            status = data.get("result", {}).get("status")
-            return status in ("member", "administrator", "creator"), None
+        client = get_http_client("telegram_api")
+        resp = await client.get(url, params=params)
+        resp.raise_for_status()
+        data = resp.json()
+        if not data.get("ok"):
+            error_description = data.get("description", "Неизвестная ошибка от Telegram API")
+            print(f"Ошибка Telegram API при getChatMember для user {user_id} на канал @{TARGET_CHANNEL_USERNAME}: {error_description}")
+            return False, error_description
+        status = data.get("result", {}).get("status")
+        return status in ("member", "administrator", "creator"), None
     except httpx.HTTPStatusError as e:
         print(f"HTTP ошибка при запросе к Telegram API (getChatMember): {e}")
         return False, f"Сетевая ошибка при проверке подписки: {e.response.status_code}"
@@ -58,8 +59,8 @@ async def send_subscription_prompt(user_id: int):
         "text": text,
         "disable_web_page_preview": True
     }
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload)
+    client = get_http_client("telegram_api")
+    await client.post(url, json=payload)
 
 info_router = APIRouter()
 
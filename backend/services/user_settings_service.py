@@ -1,7 +1,8 @@
 # Сервис для работы с пользовательскими настройками
 from fastapi import Request, HTTPException
 from typing import Optional
-from backend.main import supabase, logger
+from backend.main import logger
+from backend.db import db
 import uuid
 from datetime import datetime
 
@@ -11,10 +12,10 @@ async def get_user_settings(request: Request):
         if not telegram_user_id:
             logger.warning("Запрос настроек пользователя без идентификации Telegram")
             raise HTTPException(status_code=401, detail="Для доступа к настройкам необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
-        result = supabase.table("user_settings").select("*").eq("user_id", int(telegram_user_id)).maybe_single().execute()
+        result = await db.table("user_settings").select("*").eq("user_id", int(telegram_user_id)).maybe_single().execute()
         if not hasattr(result, 'data') or not result.data:
             logger.info(f"Настройки пользователя {telegram_user_id} не найдены, возвращаем пустой объект")
             return None
@@ -29,11 +30,11 @@ async def update_user_settings(settings_data, request: Request):
         if not telegram_user_id:
             logger.warning("Запрос обновления настроек без идентификации Telegram")
             raise HTTPException(status_code=401, detail="Для обновления настроек необходимо авторизоваться через Telegram")
-        if not supabase:
+        if not db:
             logger.error("Клиент Supabase не инициализирован")
             raise HTTPException(status_code=500, detail="Ошибка: не удалось подключиться к базе данных")
         # Проверяем, есть ли уже настройки для пользователя
-        result = supabase.table("user_settings").select("*").eq("user_id", int(telegram_user_id)).maybe_single().execute()
+        result = await db.table("user_settings").select("*").eq("user_id", int(telegram_user_id)).maybe_single().execute()
         now = datetime.now().isoformat()
         data_to_save = settings_data.dict() if hasattr(settings_data, 'dict') else dict(settings_data)
         data_to_save["user_id"] = int(telegram_user_id)
@@ -42,7 +43,7 @@ async def update_user_settings(settings_data, request: Request):
             # Создаем новые настройки
             data_to_save["id"] = str(uuid.uuid4())
             data_to_save["created_at"] = now
-            insert_result = supabase.table("user_settings").insert(data_to_save).execute()
+            insert_result = await db.table("user_settings").insert(data_to_save).execute()
             if hasattr(insert_result, 'data') and len(insert_result.data) > 0:
                 logger.info(f"Созданы новые настройки для пользователя {telegram_user_id}")
                 return insert_result.data[0]
@@ -51,7 +52,7 @@ async def update_user_settings(settings_data, request: Request):
                 raise HTTPException(status_code=500, detail="Ошибка при создании настроек пользователя")
         else:
             # Обновляем существующие настройки
-            update_result = supabase.table("user_settings").update(data_to_save).eq("user_id", int(telegram_user_id)).execute()
+            update_result = await db.table("user_settings").update(data_to_save).eq("user_id", int(telegram_user_id)).execute()
             if hasattr(update_result, 'data') and len(update_result.data) > 0:
                 logger.info(f"Обновлены настройки для пользователя {telegram_user_id}")
                 return update_result.data[0]
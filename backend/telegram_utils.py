@@ -4,7 +4,7 @@
 """
 
 import logging
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Optional, Tuple, Any, AsyncIterator
 from telethon import TelegramClient, errors
 from telethon.sessions import StringSession
 from telethon.tl.functions.messages import GetHistoryRequest
@@ -14,6 +14,7 @@ import os
 from dotenv import load_dotenv
 import asyncio
 import re
+import time
 from datetime import datetime, timedelta
 from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
 from telethon.tl.types import InputPeerChannel, PeerChannel
@@ -22,8 +23,16 @@ from telethon.errors import (
     AuthKeyError, FloodWaitError, ApiIdInvalidError
 )
 import httpx
+from backend.http_clients import get_http_client
 from bs4 import BeautifulSoup
 
+# lxml заметно быстрее html.parser; без него используем BeautifulSoup
+try:
+    from lxml import html as lxml_html
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
 # --- ПЕРЕМЕЩАЕМ Логгирование В НАЧАЛО --- 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -46,9 +55,6 @@ except ImportError:
     logger.warning("Telethon не установлен. Функции, требующие Telethon, будут недоступны.")
     TELETHON_AVAILABLE = False
 
-# Создание временного клиента Telegram
-client = None
-
 def init_telegram_client() -> Optional[TelegramClient]:
     """Инициализация клиента Telegram."""
     # Проверка наличия API_ID и API_HASH
@@ -68,9 +74,99 @@ def init_telegram_client() -> Optional[TelegramClient]:
         logger.error(f"Ошибка при инициализации клиента Telegram: {e}")
         return None
 
+# --- Долгоживущий клиент Telethon ---
+TELETHON_MAX_CONCURRENCY = int(os.getenv("TELETHON_MAX_CONCURRENCY", "3"))
+TELETHON_ENTITY_CACHE_TTL = float(os.getenv("TELETHON_ENTITY_CACHE_TTL", "86400"))
+# FloodWait дольше этого значения не ждем, а сразу возвращаем ошибку
+TELETHON_FLOOD_WAIT_MAX = float(os.getenv("TELETHON_FLOOD_WAIT_MAX", "30"))
+
+
+class TelethonGateway:
+    """
+    Один клиент Telethon на процесс: подключение и авторизация выполняются один раз,
+    разрешенные каналы кэшируются, а все запросы проходят через общую очередь,
+    которая приостанавливается целиком при FloodWaitError.
+    """
+
+    def __init__(self):
+        self._client: Optional[TelegramClient] = None
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(TELETHON_MAX_CONCURRENCY)
+        self._entity_cache: Dict[str, Tuple[float, Any]] = {}
+        self._flood_until = 0.0
+
+    @property
+    def configured(self) -> bool:
+        return bool(TELETHON_AVAILABLE and TELEGRAM_API_ID and TELEGRAM_API_HASH)
+
+    async def start(self) -> TelegramClient:
+        """Подключает и авторизует клиента, если это еще не сделано (или соединение потеряно)."""
+        if self._client is not None and self._client.is_connected():
+            return self._client
+        async with self._lock:
+            if self._client is None:
+                self._client = init_telegram_client()
+                if self._client is None:
+                    raise RuntimeError("Не удалось инициализировать клиент Telegram. Проверьте API ключи.")
+            if not self._client.is_connected():
+                await self._client.connect()
+                if not await self._client.is_user_authorized():
+                    if not TELEGRAM_BOT_TOKEN:
+                        raise RuntimeError("Требуется авторизация. Токен бота не найден.")
+                    await self._client.sign_in(bot_token=TELEGRAM_BOT_TOKEN)
+                    logger.info("Авторизация через бота успешна")
+                logger.info("Клиент Telethon подключен")
+        return self._client
+
+    async def stop(self):
+        if self._client is not None:
+            try:
+                await self._client.disconnect()
+            except Exception as e:
+                logger.warning(f"Ошибка при отключении клиента Telethon: {e}")
+            self._client = None
+        self._entity_cache.clear()
+
+    async def call(self, request_factory):
+        """
+        Выполняет запрос к Telegram через общую очередь. При FloodWaitError очередь
+        приостанавливается для всех запросов; короткое ожидание выполняется один раз с повтором.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            async with self._semaphore:
+                wait = self._flood_until - loop.time()
+                if wait > TELETHON_FLOOD_WAIT_MAX:
+                    raise FloodWaitError(request=None, capture=int(wait))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                client = await self.start()
+                try:
+                    return await request_factory(client)
+                except FloodWaitError as e:
+                    self._flood_until = max(self._flood_until, loop.time() + e.seconds)
+                    logger.warning(f"FloodWait {e.seconds} с: очередь запросов Telethon приостановлена")
+                    if attempt or e.seconds > TELETHON_FLOOD_WAIT_MAX:
+                        raise
+
+    async def get_entity(self, username: str):
+        """Разрешает канал по имени с кэшированием на TELETHON_ENTITY_CACHE_TTL секунд."""
+        key = username.lower()
+        now = time.monotonic()
+        cached = self._entity_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        entity = await self.call(lambda client: client.get_entity(username))
+        self._entity_cache[key] = (now + TELETHON_ENTITY_CACHE_TTL, entity)
+        return entity
+
+
+telethon_gateway = TelethonGateway()
+
+
 async def get_telegram_posts_via_telethon(channel_username: str, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     """
-    Получение последних постов из Telegram канала через Telethon API.
+    Получение последних постов из Telegram канала через общий клиент Telethon.
     
     Args:
         channel_username: Имя канала без символа '@'
@@ -79,66 +175,42 @@ async def get_telegram_posts_via_telethon(channel_username: str, limit: int = 20
     Returns:
         Tuple[List[Dict[str, Any]], Optional[str]]: Список постов и сообщение об ошибке (если есть)
     """
-    # Инициализация пустого списка постов и сообщения об ошибке
     posts = []
     error = None
     
-    # Проверка имени канала
     if not channel_username:
         return [], "Имя канала не указано"
     
-    # Удаление символа '@' из имени канала, если он есть
     if channel_username.startswith('@'):
         channel_username = channel_username[1:]
     
-    # Инициализация клиента Telegram
-    client = init_telegram_client()
-    if not client:
+    if not telethon_gateway.configured:
         return [], "Не удалось инициализировать клиент Telegram. Проверьте API ключи."
     
     try:
-        # Подключение к Telegram
-        await client.connect()
-        
-        if not await client.is_user_authorized():
-            # Попытка авторизации через бота (если есть токен)
-            if TELEGRAM_BOT_TOKEN:
-                await client.sign_in(bot_token=TELEGRAM_BOT_TOKEN)
-                logger.info("Авторизация через бота успешна")
-            else:
-                error = "Требуется авторизация. Токен бота не найден."
-                logger.warning(error)
-                return [], error
-        
-        # Получение сущности канала
         try:
-            entity = await client.get_entity(channel_username)
+            entity = await telethon_gateway.get_entity(channel_username)
             logger.info(f"Сущность канала получена: {entity.id}")
         except (ChannelPrivateError, ChannelInvalidError) as e:
             error = f"Ошибка доступа к каналу {channel_username}: {str(e)}"
             logger.error(error)
             return [], error
         
-        # Получение сообщений из канала
-        messages = await client.get_messages(entity, limit=limit)
+        messages = await telethon_gateway.call(lambda client: client.get_messages(entity, limit=limit))
         logger.info(f"Получено {len(messages)} сообщений из канала {channel_username}")
         
-        # Обработка сообщений
         for message in messages:
             if message.message:  # Если есть текст сообщения
-                post = {"text": message.message, "date": message.date.isoformat()}
-                
-                # Обработка медиа (фото, документы и т.д.)
+                post = {
+                    "id": message.id,
+                    "text": message.message,
+                    "date": message.date.isoformat(),
+                    "views": message.views,
+                }
                 if message.photo:
-                    # Получение URL фото
                     post["photo"] = True
-                    # Здесь можно добавить логику для получения URL фото
-                
                 if message.document:
-                    # Обработка документов
                     post["document"] = True
-                    # Здесь можно добавить логику для получения информации о документе
-                
                 posts.append(post)
         
         return posts, None
@@ -152,29 +224,17 @@ async def get_telegram_posts_via_telethon(channel_username: str, limit: int = 20
     except AuthKeyError:
         error = "Ошибка авторизации. Возможно, сессия устарела."
         logger.error(error)
+        # Сессия больше не годится — следующий запрос переподключится заново
+        await telethon_gateway.stop()
+    except RuntimeError as e:
+        error = str(e)
+        logger.error(error)
     except Exception as e:
         error = f"Непредвиденная ошибка при получении постов: {str(e)}"
         logger.error(error)
     
-    finally:
-        # Отключение от Telegram
-        if client:
-            await client.disconnect()
-    
     return posts, error
 
-def get_telegram_posts(channel_username: str, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
-    """
-    Синхронная обертка для асинхронной функции get_telegram_posts_via_telethon.
-    """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        result = loop.run_until_complete(get_telegram_posts_via_telethon(channel_username, limit))
-        return result
-    finally:
-        loop.close()
-
 def get_mock_telegram_posts(username: str) -> List[Dict[str, Any]]:
     """
     Возвращает примеры постов, когда API недоступно.
@@ -195,40 +255,183 @@ def get_mock_telegram_posts(username: str) -> List[Dict[str, Any]]:
         }
     ]
 
-# --- Функция для получения постов Telegram через HTTP парсинг ---
-async def get_telegram_posts_via_http(username: str) -> List[str]:
-    """Получение постов канала Telegram через HTTP парсинг."""
+# --- Постраничный HTTP парсинг t.me/s ---
+# Страница t.me/s/<канал> содержит около 20 последних сообщений, более старые
+# запрашиваются курсором ?before=<id>. Так как id сообщений идут подряд, курсоры
+# следующих страниц можно вычислить заранее и загружать страницы параллельно.
+TELEGRAM_HTTP_PAGE_SIZE = 20
+TELEGRAM_HTTP_POSTS_LIMIT = int(os.getenv("TELEGRAM_HTTP_POSTS_LIMIT", "20"))
+TELEGRAM_HTTP_CONCURRENCY = int(os.getenv("TELEGRAM_HTTP_CONCURRENCY", "4"))
+
+_VIEWS_MULTIPLIERS = {"K": 1_000, "M": 1_000_000, "B": 1_000_000_000}
+
+
+def _parse_views(raw: Optional[str]) -> Optional[int]:
+    """Преобразует счетчик просмотров вида '1.2K' в число."""
+    if not raw:
+        return None
+    raw = raw.strip().upper().replace(",", ".")
+    multiplier = _VIEWS_MULTIPLIERS.get(raw[-1:], 1)
+    number = raw[:-1] if multiplier != 1 else raw
     try:
-        url = f"https://t.me/s/{username}"
-        logger.info(f"Запрос HTTP парсинга для канала @{username}: {url}")
-        
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(url)
-            
-        if response.status_code != 200:
-            logger.warning(f"HTTP статус-код для @{username}: {response.status_code}")
-            return []
-            
-        # Используем BeautifulSoup для парсинга HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Ищем блоки с сообщениями
-        message_blocks = soup.select('div.tgme_widget_message_bubble')
-        
-        if not message_blocks:
-            logger.warning(f"Не найдены блоки сообщений для @{username}")
-            return []
-            
-        # Извлекаем текст сообщений
-        posts = []
-        for block in message_blocks:
-            text_block = block.select_one('div.tgme_widget_message_text')
-            if text_block and text_block.text.strip():
-                posts.append(text_block.text.strip())
-        
+        return int(float(number) * multiplier)
+    except ValueError:
+        return None
+
+
+def _post_id(data_post: Optional[str]) -> Optional[int]:
+    if not data_post or "/" not in data_post:
+        return None
+    tail = data_post.rsplit("/", 1)[1]
+    return int(tail) if tail.isdigit() else None
+
+
+def _parse_channel_page_lxml(page_html: str) -> List[Dict[str, Any]]:
+    doc = lxml_html.fromstring(page_html)
+    posts = []
+    for message in doc.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " tgme_widget_message ")][@data-post]'):
+        post_id = _post_id(message.get("data-post"))
+        if post_id is None:
+            continue
+        text_nodes = message.xpath(
+            './/div[contains(@class, "tgme_widget_message_text")]'
+            '[not(ancestor::*[contains(@class, "tgme_widget_message_reply")])]'
+        )
+        text = ""
+        if text_nodes:
+            for br in text_nodes[0].iter("br"):
+                br.tail = "\n" + (br.tail or "")
+            text = text_nodes[0].text_content().strip()
+        dates = message.xpath('.//a[contains(@class, "tgme_widget_message_date")]/time/@datetime')
+        views = message.xpath('.//span[contains(@class, "tgme_widget_message_views")]/text()')
+        posts.append({
+            "id": post_id,
+            "text": text,
+            "date": dates[0] if dates else None,
+            "views": _parse_views(views[0] if views else None),
+            "has_photo": bool(message.xpath('.//*[contains(@class, "tgme_widget_message_photo_wrap")]')),
+            "has_video": bool(message.xpath('.//*[contains(@class, "tgme_widget_message_video")]')),
+            "has_document": bool(message.xpath('.//*[contains(@class, "tgme_widget_message_document")]')),
+        })
+    return posts
+
+
+def _parse_channel_page_bs4(page_html: str) -> List[Dict[str, Any]]:
+    soup = BeautifulSoup(page_html, 'html.parser')
+    posts = []
+    for message in soup.select('div.tgme_widget_message[data-post]'):
+        post_id = _post_id(message.get("data-post"))
+        if post_id is None:
+            continue
+        text_block = None
+        for candidate in message.select('div.tgme_widget_message_text'):
+            if not candidate.find_parent(class_="tgme_widget_message_reply"):
+                text_block = candidate
+                break
+        time_tag = message.select_one('a.tgme_widget_message_date time')
+        views_tag = message.select_one('span.tgme_widget_message_views')
+        posts.append({
+            "id": post_id,
+            "text": text_block.get_text("\n").strip() if text_block else "",
+            "date": time_tag.get("datetime") if time_tag else None,
+            "views": _parse_views(views_tag.text if views_tag else None),
+            "has_photo": message.select_one('.tgme_widget_message_photo_wrap') is not None,
+            "has_video": message.select_one('[class*="tgme_widget_message_video"]') is not None,
+            "has_document": message.select_one('.tgme_widget_message_document') is not None,
+        })
+    return posts
+
+
+def parse_channel_page(page_html: str) -> List[Dict[str, Any]]:
+    """Разбирает HTML страницы t.me/s: id, текст, дата, просмотры и признаки медиа каждого сообщения."""
+    if LXML_AVAILABLE:
+        return _parse_channel_page_lxml(page_html)
+    return _parse_channel_page_bs4(page_html)
+
+
+async def _fetch_channel_page(client: httpx.AsyncClient, username: str, before: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+    """Загружает одну страницу t.me/s. Возвращает None при ошибочном статусе ответа."""
+    url = f"https://t.me/s/{username}"
+    response = await client.get(url, params={"before": before} if before else None)
+    if response.status_code != 200:
+        logger.warning(f"HTTP статус-код для @{username} (before={before}): {response.status_code}")
+        return None
+    return parse_channel_page(response.text)
+
+
+async def iter_telegram_posts_via_http(
+    username: str,
+    limit: int = TELEGRAM_HTTP_POSTS_LIMIT,
+    concurrency: int = TELEGRAM_HTTP_CONCURRENCY,
+    text_only: bool = True,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Асинхронный генератор постов канала (от новых к старым) через HTTP парсинг t.me/s.
+    Страницы загружаются волнами по `concurrency` штук, посты отдаются по мере
+    разбора страниц, поэтому обработка может начаться до загрузки последней страницы.
+    """
+    client = get_http_client("telegram_web")
+    seen_ids = set()
+    yielded = 0
+
+    first_page = await _fetch_channel_page(client, username)
+    if not first_page:
+        return
+    # Все сообщения с id >= frontier уже получены
+    frontier = min(post["id"] for post in first_page)
+    pending_pages = [first_page]
+    stalled = False
+
+    while True:
+        for page in pending_pages:
+            for post in sorted(page, key=lambda p: p["id"], reverse=True):
+                if post["id"] in seen_ids:
+                    continue
+                seen_ids.add(post["id"])
+                if text_only and not post["text"]:
+                    continue
+                yield post
+                yielded += 1
+                if yielded >= limit:
+                    return
+        if frontier <= 1 or stalled:
+            return
+
+        befores = [frontier - i * TELEGRAM_HTTP_PAGE_SIZE for i in range(max(1, concurrency))]
+        befores = [before for before in befores if before > 1]
+        tasks = [asyncio.create_task(_fetch_channel_page(client, username, before)) for before in befores]
+        pending_pages = []
+        new_frontier = frontier
+        try:
+            for before, task in zip(befores, tasks):
+                try:
+                    page = await task
+                except Exception as e:
+                    logger.warning(f"Ошибка загрузки страницы @{username} (before={before}): {e}")
+                    page = None
+                if page is None:
+                    continue
+                # Страница продолжает непрерывный диапазон, только если ее курсор не ниже границы
+                if before >= new_frontier:
+                    new_frontier = min([new_frontier] + [post["id"] for post in page]) if page else 0
+                if page:
+                    pending_pages.append(page)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        # Граница не сдвинулась (например, первая страница волны не загрузилась) — заканчиваем
+        stalled = new_frontier >= frontier
+        frontier = new_frontier
+
+
+async def get_telegram_posts_via_http(username: str, limit: int = TELEGRAM_HTTP_POSTS_LIMIT) -> List[str]:
+    """Получение текстов постов канала Telegram через HTTP парсинг (с постраничной загрузкой)."""
+    try:
+        logger.info(f"Запрос HTTP парсинга для канала @{username}, лимит {limit} постов")
+        posts = [post["text"] async for post in iter_telegram_posts_via_http(username, limit=limit)]
         logger.info(f"Найдено {len(posts)} постов через HTTP парсинг для @{username}")
         return posts
-        
     except Exception as e:
         logger.error(f"Ошибка при HTTP парсинге канала @{username}: {e}")
         raise 
@@ -0,0 +1,79 @@
+# Очистка текстов идей, планов и постов: заранее скомпилированные шаблоны и пакетный API
+import asyncio
+import re
+from typing import Iterable, List, Optional
+
+# Пакеты больше этого размера очищаются в пуле потоков, чтобы не занимать event loop
+BATCH_THREAD_THRESHOLD = 200
+
+_DAY_WORD = r"(?:[Дд]ень|ДЕНЬ)"
+_DAY_HEADER = rf"#{{1,6}}\s*\*?\*?{_DAY_WORD}?\s*\d+\s*{_DAY_WORD}?\*?\*?"
+_MARKDOWN_CHARS = r"\*\*|\*|__|_|#{1,6}"
+# Заголовки вида "### **День 1**", "### **1 день**"
+_DAY_HEADER_RE = re.compile(_DAY_HEADER)
+# Номер дня в начале текста без символов #: "День 3 ...", "3 день ..."
+_DAY_PREFIX_RE = re.compile(rf"\*?\*?{_DAY_WORD}?\s*\d+\s*{_DAY_WORD}?\*?\*?")
+# Символы маркдауна
+_MARKDOWN_CHARS_RE = re.compile(_MARKDOWN_CHARS)
+# Заголовки и символы маркдауна одним проходом (заголовок пробуется первым) — то же, что два прохода подряд
+_MARKDOWN_RE = re.compile(f"{_DAY_HEADER}|{_MARKDOWN_CHARS}")
+# Первые символы, с которых может начинаться номер дня или заголовок
+_PREFIX_START_CHARS = frozenset("#*Дд")
+# Кавычки, которыми модель иногда обрамляет весь ответ
+_EDGE_QUOTES_RE = re.compile(r'^[\"“"«»\']+|[\"""«»\']+$')
+# Плейсхолдеры в ответе анализа, после удаления которых схлопываются пробелы
+_ANALYSIS_PLACEHOLDER_RE = re.compile(
+    r"\[[^\]]{2,40}\]|\((?:[сС]сылка(?: или контакт)?|[кК]онтакт(?:ы)?|[дД]етали|[цЦ]ена|[нН]омер|[иИ]мя|[нН]азвание|[eE]mail|[тТ]елефон)\)"
+)
+_MULTISPACE_RE = re.compile(r"\s{2,}")
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def _could_have_day_prefix(text: str) -> bool:
+    first = text[0]
+    return first in _PREFIX_START_CHARS or first.isdecimal() or first.isspace()
+
+
+def clean_text_formatting(text: Optional[str]) -> str:
+    """Очищает текст от маркдауна и номеров дней, делает первую букву заглавной."""
+    if not text:
+        return ""
+    if _could_have_day_prefix(text):
+        # Номер дня ищется после удаления заголовков, но до удаления символов маркдауна
+        text = _DAY_HEADER_RE.sub("", text)
+        prefix = _DAY_PREFIX_RE.match(text)
+        if prefix:
+            text = text[prefix.end():]
+        text = _MARKDOWN_CHARS_RE.sub("", text)
+    else:
+        text = _MARKDOWN_RE.sub("", text)
+    text = text.strip()
+    if text:
+        text = text[0].upper() + text[1:]
+    return text
+
+
+def clean_text_formatting_batch(texts: Iterable[Optional[str]]) -> List[str]:
+    """Пакетная очистка: тот же результат, что clean_text_formatting для каждой строки."""
+    return [clean_text_formatting(text) for text in texts]
+
+
+async def clean_text_formatting_batch_async(texts: List[Optional[str]]) -> List[str]:
+    """Пакетная очистка для обработчиков и фоновых задач: большие пакеты уходят в пул потоков."""
+    if len(texts) < BATCH_THREAD_THRESHOLD:
+        return clean_text_formatting_batch(texts)
+    return await asyncio.to_thread(clean_text_formatting_batch, texts)
+
+
+def strip_edge_quotes(text: str) -> str:
+    return _EDGE_QUOTES_RE.sub("", text).strip()
+
+
+def strip_analysis_placeholders(text: str) -> str:
+    """Убирает плейсхолдеры вида "[...]" и "(ссылка)" и схлопывает пробелы."""
+    return _MULTISPACE_RE.sub(" ", _ANALYSIS_PLACEHOLDER_RE.sub("", text)).strip()
+
+
+def strip_code_fence(text: str) -> str:
+    """Снимает обертку ```json ... ``` вокруг ответа модели."""
+    return _CODE_FENCE_RE.sub("", text)